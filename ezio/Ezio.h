@@ -1,5 +1,14 @@
+#ifndef EZIO_H
+#define EZIO_H
+
 #include "Python.h"
 #include <stdarg.h>
+#include <time.h>
+
+/*
+ * Everything here has internal linkage, since a project module is built from
+ * several translation units that all include this header.
+ */
 
 /**
  * Does dotted path lookups, with the path elements being varargs.
@@ -73,6 +82,8 @@ static int sequence_copy(PyObject *seq, Py_ssize_t len, PyObject **dest) {
     return 0;
 }
 
+struct ezio_profile_frame;
+
 namespace ezio_templates {
 
     /** Base C++ class for all templates. */
@@ -84,12 +95,102 @@ namespace ezio_templates {
             PyObject *transaction;
             // if not NULL, a Python object that can be the target of dynamic references to `self`
             PyObject *self_ptr;
+            // in a profiling build, the innermost method or call being timed
+            ezio_profile_frame *profile_frame;
 
             ezio_base_template(PyObject *display, PyObject *transaction, PyObject *self_ptr) :
-                display(display), transaction(transaction), self_ptr(self_ptr) {}
+                display(display), transaction(transaction), self_ptr(self_ptr), profile_frame(NULL) {}
     };
 }
 
+/* Kinds of string literal in a packed literal blob. */
+static const int PACKED_LITERAL_STR = 0;
+static const int PACKED_LITERAL_UNICODE = 1;
+
+/** Where to find one string literal in a blob of packed literals:
+  its bytes (UTF-8 for unicodes) are at `offset`, and it goes in slot `index`
+  of the literals array.
+  */
+typedef struct {
+    Py_ssize_t index;
+    Py_ssize_t offset;
+    Py_ssize_t length;
+    int kind;
+} ezio_packed_literal;
+
+/** Create the string literals described by `specs` from `blob`, storing them
+  in `literals`. Returns 0, with an exception set, if any of them can't be created.
+  */
+static inline int unpack_literals(PyObject **literals, const char *blob,
+                                  const ezio_packed_literal *specs, Py_ssize_t num_specs) {
+    Py_ssize_t i;
+    for (i = 0; i < num_specs; i++) {
+        const ezio_packed_literal *spec = &specs[i];
+        PyObject *literal;
+        if (spec->kind == PACKED_LITERAL_UNICODE) {
+            literal = PyUnicode_DecodeUTF8(blob + spec->offset, spec->length, NULL);
+        } else {
+            literal = PyString_FromStringAndSize(blob + spec->offset, spec->length);
+        }
+        if (!literal) {
+            return 0;
+        }
+        literals[spec->index] = literal;
+    }
+    return 1;
+}
+
+/* Attribute of a shared runtime module holding the capsule for its ezio_shared_runtime. */
+#define SHARED_RUNTIME_ATTRIBUTE "_ezio_runtime"
+
+/** The literals and imported objects that a shared runtime module (see
+  ezio.compiler.SharedRuntime) owns on behalf of separately compiled template
+  modules. `key` identifies its contents; template modules index into the
+  arrays, so they only work with the runtime they were compiled against.
+  */
+typedef struct {
+    const char *key;
+    PyObject **literals;
+    PyObject **imports;
+} ezio_shared_runtime;
+
+/** Import the shared runtime module `module_name` and return its contents,
+  checking that they're the ones identified by `key`. Returns NULL, with an
+  exception set, on failure.
+  */
+static inline ezio_shared_runtime *import_shared_runtime(const char *module_name,
+                                                         const char *capsule_name, const char *key) {
+    PyObject *module = PyImport_ImportModule(module_name);
+    if (!module) {
+        return NULL;
+    }
+    PyObject *capsule = PyObject_GetAttrString(module, SHARED_RUNTIME_ATTRIBUTE);
+    Py_DECREF(module);
+    if (!capsule) {
+        return NULL;
+    }
+    ezio_shared_runtime *runtime = (ezio_shared_runtime *) PyCapsule_GetPointer(capsule, capsule_name);
+    Py_DECREF(capsule);
+    if (runtime && strcmp(runtime->key, key)) {
+        PyErr_Format(PyExc_ImportError, "%s has changed since this template was compiled against it", module_name);
+        return NULL;
+    }
+    return runtime;
+}
+
+/** Copy new references to objects owned by a shared runtime into a module's own arrays:
+  for each pair in `indices`, targets[pair[0]] = sources[pair[1]].
+  */
+static inline void bind_shared_objects(PyObject **targets, PyObject **sources,
+                                       const Py_ssize_t (*indices)[2], Py_ssize_t num_indices) {
+    Py_ssize_t i;
+    for (i = 0; i < num_indices; i++) {
+        PyObject *shared = sources[indices[i][1]];
+        Py_XINCREF(shared);
+        targets[indices[i][0]] = shared;
+    }
+}
+
 /* Status codes that can be returned by the coercion/filtering code. */
 static const int COERCED_TO_STR = 0;
 static const int COERCED_TO_UNICODE = 1;
@@ -102,7 +203,7 @@ static const int COERCE_FAILED = 2;
 typedef PyObject* (*Ezio_Filter)(PyObject *operand, void *closure_data);
 
 /** Ezio_Filter that transforms objects into Unicodes. */
-PyObject *default_unicode_filter(PyObject *item, void *closure_data) {
+static inline PyObject *default_unicode_filter(PyObject *item, void *closure_data) {
     if (PyUnicode_Check(item)) {
         Py_INCREF(item);
         return item;
@@ -118,9 +219,10 @@ PyObject *default_unicode_filter(PyObject *item, void *closure_data) {
     }
 }
 
-/** Apply an Ezio_Filter that returns unicodes to a list `transaction`;
-  return the total length of the unicodes (for buffer pre-allocation),
-  and modify `status` to reflect the success or failure of the coercions.
+/** Apply an Ezio_Filter that returns unicodes to the elements of a list
+  `transaction` from index `start` onwards; return the total length of the
+  unicodes (for buffer pre-allocation), and modify `status` to reflect the
+  success or failure of the coercions.
 
   This implementation (and others here) is unsafe in general because
   it re-enters the interpreter without re-checking list bounds.
@@ -130,7 +232,7 @@ PyObject *default_unicode_filter(PyObject *item, void *closure_data) {
   In the future, this is the place where we'll implement HTML escaping,
   by passing an Ezio_Filter that does escaping intelligently.
   */
-Py_ssize_t apply_unicode_filter(PyObject *transaction, int *status,
+static inline Py_ssize_t apply_unicode_filter(PyObject *transaction, Py_ssize_t start, int *status,
                                 Ezio_Filter filter, void *closure_data) {
     if (!(transaction && PyList_CheckExact(transaction))) {
         *status = COERCE_FAILED;
@@ -140,7 +242,7 @@ Py_ssize_t apply_unicode_filter(PyObject *transaction, int *status,
     Py_ssize_t size = PyList_GET_SIZE(transaction);
     Py_ssize_t seqlen = 0;
     Py_ssize_t i;
-    for (i = 0; i < size; i++) {
+    for (i = start; i < size; i++) {
         PyObject *item = PyList_GET_ITEM(transaction, i);
         PyObject *filtered_item = filter(item, closure_data);
         if (filtered_item == NULL) {
@@ -158,13 +260,13 @@ Py_ssize_t apply_unicode_filter(PyObject *transaction, int *status,
 }
 
 
-/** Attempt to coerce all elements of `transaction` to string,
-  unless one of them is a unicode, in which case coerce everything
+/** Attempt to coerce the elements of `transaction` from index `start` onwards
+  to string, unless one of them is a unicode, in which case coerce all of them
   to unicode. This is more or less what standard str.join() does
   (except, of course, that it performs coercion and modifies `transaction`
   in place with the results of the coercions).
   */
-Py_ssize_t coerce_all(PyObject *transaction, int *status) {
+static inline Py_ssize_t coerce_range(PyObject *transaction, Py_ssize_t start, int *status) {
     if (!(transaction && PyList_CheckExact(transaction))) {
         *status = COERCE_FAILED;
         return 0;
@@ -173,12 +275,12 @@ Py_ssize_t coerce_all(PyObject *transaction, int *status) {
     Py_ssize_t size = PyList_GET_SIZE(transaction);
     Py_ssize_t seqlen = 0;
     Py_ssize_t i;
-    for (i = 0; i < size; i++) {
+    for (i = start; i < size; i++) {
         PyObject *item = PyList_GET_ITEM(transaction, i);
         if (!PyString_Check(item)) {
             if (PyUnicode_Check(item)) {
                 // coerce all transaction elements to unicode using the default unicode filter
-                return apply_unicode_filter(transaction, status, default_unicode_filter, NULL);
+                return apply_unicode_filter(transaction, start, status, default_unicode_filter, NULL);
             } else {
                 PyObject *coerced_item = PyObject_Str(item);
                 if (coerced_item != NULL) {
@@ -199,11 +301,16 @@ Py_ssize_t coerce_all(PyObject *transaction, int *status) {
     return seqlen;
 }
 
-/** Assuming `transaction` contains only strings and their total length is
-  `total_length`, concatenate them all and return a new reference to the
-  resulting string.
+/** coerce_range over the whole of `transaction`. */
+static inline Py_ssize_t coerce_all(PyObject *transaction, int *status) {
+    return coerce_range(transaction, 0, status);
+}
+
+/** Assuming the elements of `transaction` from index `start` onwards are
+  strings and their total length is `total_length`, concatenate them all and
+  return a new reference to the resulting string.
   */
-PyObject *concatenate_strings(PyObject *transaction, Py_ssize_t total_length) {
+static inline PyObject *concatenate_strings(PyObject *transaction, Py_ssize_t start, Py_ssize_t total_length) {
     PyObject *res = PyString_FromStringAndSize(NULL, total_length);
     if (res == NULL) {
         return NULL;
@@ -212,7 +319,7 @@ PyObject *concatenate_strings(PyObject *transaction, Py_ssize_t total_length) {
     char *buf = PyString_AS_STRING(res);
     Py_ssize_t size = PyList_GET_SIZE(transaction);
     Py_ssize_t i;
-    for (i = 0; i < size; i++) {
+    for (i = start; i < size; i++) {
         PyObject *item = PyList_GET_ITEM(transaction, i);
         size_t n = PyString_GET_SIZE(item);
         Py_MEMCPY(buf, PyString_AS_STRING(item), n);
@@ -224,7 +331,7 @@ PyObject *concatenate_strings(PyObject *transaction, Py_ssize_t total_length) {
 
 /** Like concatenate_strings, but for unicodes. Mostly copied and pasted from the above.
   */
-PyObject *concatenate_unicodes(PyObject *transaction, Py_ssize_t total_length) {
+static inline PyObject *concatenate_unicodes(PyObject *transaction, Py_ssize_t start, Py_ssize_t total_length) {
     PyObject *res = PyUnicode_FromUnicode(NULL, total_length);
     if (res == NULL) {
         return NULL;
@@ -233,7 +340,7 @@ PyObject *concatenate_unicodes(PyObject *transaction, Py_ssize_t total_length) {
     Py_UNICODE *buf = PyUnicode_AS_UNICODE(res);
     Py_ssize_t size = PyList_GET_SIZE(transaction);
     Py_ssize_t i;
-    for (i = 0; i < size; i++) {
+    for (i = start; i < size; i++) {
         PyObject *item = PyList_GET_ITEM(transaction, i);
         Py_ssize_t n = PyUnicode_GET_SIZE(item);
         Py_UNICODE_COPY(buf, PyUnicode_AS_UNICODE(item), n);
@@ -243,26 +350,27 @@ PyObject *concatenate_unicodes(PyObject *transaction, Py_ssize_t total_length) {
     return res;
 }
 
-/** Combines coerce_all, concatenate_strings, and concatenate_unicodes
-  to make an analogue of str.join() that coerces non-strings to strings
-  (and, like str.join(), coerces everything to unicode if unicode is encountered).
+/** Combines coerce_range, concatenate_strings, and concatenate_unicodes
+  to make an analogue of str.join() over the elements of `transaction` from
+  index `start` onwards, that coerces non-strings to strings (and, like
+  str.join(), coerces everything to unicode if unicode is encountered).
   */
-PyObject *ezio_concatenate(PyObject *transaction) {
+static inline PyObject *ezio_concatenate_range(PyObject *transaction, Py_ssize_t start) {
     if (!(transaction && PyList_CheckExact(transaction))) {
         return NULL;
     }
 
     int status;
-    Py_ssize_t total_length = coerce_all(transaction, &status);
+    Py_ssize_t total_length = coerce_range(transaction, start, &status);
     if (status == COERCE_FAILED) {
         // propagates exceptions raised during coercion:
         return NULL;
     }
 
     if (status == COERCED_TO_STR) {
-        return concatenate_strings(transaction, total_length);
+        return concatenate_strings(transaction, start, total_length);
     } else if (status == COERCED_TO_UNICODE) {
-        return concatenate_unicodes(transaction, total_length);
+        return concatenate_unicodes(transaction, start, total_length);
     } else {
         // internal error
         PyErr_SetString(PyExc_SystemError, "Invalid coercion status.");
@@ -270,12 +378,643 @@ PyObject *ezio_concatenate(PyObject *transaction) {
     }
 }
 
+/** ezio_concatenate_range over the whole of `transaction`. */
+static inline PyObject *ezio_concatenate(PyObject *transaction) {
+    return ezio_concatenate_range(transaction, 0);
+}
+
+/* Smallest buffer ezio_concatenate_presized will start with. */
+static const Py_ssize_t MIN_PRESIZED_LENGTH = 256;
+
+/** Like ezio_concatenate_range, but makes a single pass over `transaction`,
+  coercing and copying as it goes into a string buffer allocated up front
+  from `length_hint`. The buffer grows if the hint was too small, and is
+  trimmed to size at the end. If there is a unicode in `transaction`, this is
+  just ezio_concatenate_range, since everything must then be coerced to unicode,
+  which takes a pass to size the result exactly anyway.
+  */
+static inline PyObject *ezio_concatenate_presized(PyObject *transaction, Py_ssize_t start, Py_ssize_t length_hint) {
+    if (!(transaction && PyList_CheckExact(transaction))) {
+        return NULL;
+    }
+
+    Py_ssize_t size = PyList_GET_SIZE(transaction);
+    Py_ssize_t i;
+    // check the types before allocating, rather than copying into a buffer we might throw away:
+    for (i = start; i < size; i++) {
+        if (PyUnicode_Check(PyList_GET_ITEM(transaction, i))) {
+            return ezio_concatenate_range(transaction, start);
+        }
+    }
+
+    // (never start empty: a zero-length string may be a shared singleton,
+    // which can't be resized)
+    Py_ssize_t capacity = length_hint > MIN_PRESIZED_LENGTH ? length_hint : MIN_PRESIZED_LENGTH;
+    PyObject *res = PyString_FromStringAndSize(NULL, capacity);
+    if (res == NULL) {
+        return NULL;
+    }
+
+    Py_ssize_t used = 0;
+    for (i = start; i < size; i++) {
+        PyObject *item = PyList_GET_ITEM(transaction, i);
+        if (!PyString_Check(item)) {
+            PyObject *coerced_item = PyObject_Str(item);
+            if (coerced_item == NULL) {
+                Py_DECREF(res);
+                return NULL;
+            }
+            // discard the ref to the old value, steal one to the new one
+            Py_DECREF(item);
+            PyList_SET_ITEM(transaction, i, coerced_item);
+            item = coerced_item;
+        }
+
+        Py_ssize_t n = PyString_GET_SIZE(item);
+        if (used + n > capacity) {
+            while (used + n > capacity) {
+                capacity *= 2;
+            }
+            // on failure, this frees `res` and sets it to NULL:
+            if (_PyString_Resize(&res, capacity) < 0) {
+                return NULL;
+            }
+        }
+        Py_MEMCPY(PyString_AS_STRING(res) + used, PyString_AS_STRING(item), n);
+        used += n;
+    }
+
+    if (used != capacity) {
+        _PyString_Resize(&res, used);
+    }
+    return res;
+}
+
+/** A moving estimate of the output of a template class, kept per class and
+  updated after every render: the output length is what the hooks use to
+  presize their output buffers, and both are reported by render_history().
+  (The transaction pools size the fragment lists by their own high water mark.)
+  A zero-initialized (i.e., static) history is empty.
+  */
+typedef struct {
+    unsigned long renders;
+    Py_ssize_t fragments;
+    Py_ssize_t length;
+} ezio_render_history;
+
+/** Fold the fragment count and output length of a render into `history`.
+  The estimates are exponential moving averages, weighting each new render by 1/4.
+  */
+static inline void update_render_history(ezio_render_history *history, Py_ssize_t fragments, Py_ssize_t length) {
+    if (history->renders == 0) {
+        history->fragments = fragments;
+        history->length = length;
+    } else {
+        history->fragments += (fragments - history->fragments) / 4;
+        history->length += (length - history->length) / 4;
+    }
+    history->renders++;
+}
+
+/** Buffer size to preallocate for the next render, given `history`;
+  leaves some headroom so that typical variations don't force a regrowth.
+  */
+static inline Py_ssize_t estimate_output_length(ezio_render_history *history) {
+    return history->length + history->length / 8;
+}
+
+/** Record the contents of `history` in the dict `histories`, keyed by `class_name`,
+  for inspection from Python. Returns 0 on failure and 1 on success.
+  */
+static inline int export_render_history(PyObject *histories, const char *class_name, ezio_render_history *history) {
+    PyObject *item = Py_BuildValue("{s:k,s:n,s:n}",
+            "renders", history->renders,
+            "fragments", history->fragments,
+            "length", history->length);
+    if (item == NULL) {
+        return 0;
+    }
+    int status = PyDict_SetItemString(histories, class_name, item);
+    Py_DECREF(item);
+    return status == 0;
+}
+
+/** Counters of the renders of a template class, kept per class when the module
+  is compiled with CompilerSettings.render_stats. Times are in nanoseconds of
+  the monotonic clock, and include everything the render calls into.
+  A zero-initialized (i.e., static) set of counters is empty.
+  */
+typedef struct {
+    unsigned long long renders;
+    unsigned long long total_ns;
+    unsigned long long max_ns;
+    unsigned long long length;
+    unsigned long long fragments;
+} ezio_render_stats;
+
+/** Current time of the monotonic clock, in nanoseconds. */
+static inline unsigned long long ezio_monotonic_ns(void) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (unsigned long long) now.tv_sec * 1000000000ULL + now.tv_nsec;
+}
+
+/** Count a render that started at `start_ns` and produced `fragments`
+  fragments, `length` characters long in all, in `stats`. (The length is of
+  the result: bytes for a str, code units for a unicode.)
+  */
+static inline void record_render(ezio_render_stats *stats, unsigned long long start_ns,
+        Py_ssize_t fragments, Py_ssize_t length) {
+    unsigned long long elapsed = ezio_monotonic_ns() - start_ns;
+    stats->renders++;
+    stats->total_ns += elapsed;
+    if (elapsed > stats->max_ns) {
+        stats->max_ns = elapsed;
+    }
+    stats->length += length;
+    stats->fragments += fragments;
+}
+
+static inline void reset_render_stats(ezio_render_stats *stats) {
+    memset(stats, 0, sizeof(*stats));
+}
+
+/** Record the counters in `stats` in the dict `all_stats`, keyed by `class_name`,
+  for inspection from Python. Returns 0 on failure and 1 on success.
+  */
+static inline int export_render_stats(PyObject *all_stats, const char *class_name, ezio_render_stats *stats) {
+    PyObject *item = Py_BuildValue("{s:K,s:K,s:K,s:K,s:K}",
+            "renders", stats->renders,
+            "total_ns", stats->total_ns,
+            "max_ns", stats->max_ns,
+            "length", stats->length,
+            "fragments", stats->fragments);
+    if (item == NULL) {
+        return 0;
+    }
+    int status = PyDict_SetItemString(all_stats, class_name, item);
+    Py_DECREF(item);
+    return status == 0;
+}
+
+/** Counters of one profiled site, i.e., a native method or a call to a Python
+  callable, in a module compiled with CompilerSettings.profile. Inclusive time
+  counts everything between entering the site and leaving it; self time leaves
+  out the time spent in profiled sites entered from it.
+  */
+typedef struct {
+    unsigned long long calls;
+    unsigned long long inclusive_ns;
+    unsigned long long self_ns;
+} ezio_profile_site;
+
+/** A profiled site being executed, on the C stack. The frames of a render
+  form a stack through `parent`, whose top the template object keeps.
+  */
+typedef struct ezio_profile_frame {
+    ezio_profile_site *site;
+    unsigned long long start_ns;
+    unsigned long long child_ns;
+    struct ezio_profile_frame *parent;
+} ezio_profile_frame;
+
+/** Start timing `site` in `frame`, making it the innermost frame in `*current`. */
+static inline void profile_enter(ezio_profile_frame *frame, ezio_profile_site *site, ezio_profile_frame **current) {
+    frame->site = site;
+    frame->child_ns = 0;
+    frame->parent = *current;
+    *current = frame;
+    frame->start_ns = ezio_monotonic_ns();
+}
+
+/** Stop timing the innermost frame, `frame`, and charge its time to its site
+  and, as child time, to its parent.
+  */
+static inline void profile_exit(ezio_profile_frame *frame, ezio_profile_frame **current) {
+    unsigned long long elapsed = ezio_monotonic_ns() - frame->start_ns;
+    ezio_profile_site *site = frame->site;
+    site->calls++;
+    site->inclusive_ns += elapsed;
+    site->self_ns += elapsed - frame->child_ns;
+    if (frame->parent) {
+        frame->parent->child_ns += elapsed;
+    }
+    *current = frame->parent;
+}
+
+/** Append the counters of `site` to the list `report`, along with where it is,
+  as a (self time, dict) pair for sort_profile_report. Returns 0 on failure and 1 on success.
+  */
+static inline int export_profile_site(PyObject *report, const char *class_name, const char *kind,
+        const char *name, int lineno, ezio_profile_site *site) {
+    PyObject *item = Py_BuildValue("(K{s:s,s:s,s:s,s:i,s:K,s:K,s:K})", site->self_ns,
+            "template", class_name,
+            "kind", kind,
+            "name", name,
+            "line", lineno,
+            "calls", site->calls,
+            "inclusive_ns", site->inclusive_ns,
+            "self_ns", site->self_ns);
+    if (item == NULL) {
+        return 0;
+    }
+    int status = PyList_Append(report, item);
+    Py_DECREF(item);
+    return status == 0;
+}
+
+/** Sort the pairs made by export_profile_site by descending self time,
+  and replace them with their dicts. Returns 0 on failure and 1 on success.
+  */
+static inline int sort_profile_report(PyObject *report) {
+    if (PyList_Sort(report) < 0 || PyList_Reverse(report) < 0) {
+        return 0;
+    }
+    Py_ssize_t i;
+    for (i = 0; i < PyList_GET_SIZE(report); i++) {
+        PyObject *row = PyTuple_GET_ITEM(PyList_GET_ITEM(report, i), 1);
+        Py_INCREF(row);
+        // releases the pair:
+        PyList_SetItem(report, i, row);
+    }
+    return 1;
+}
+
+/* Number of distinct base types a lookup site remembers. */
+#ifndef EZIO_LOOKUP_SITE_TYPES
+#define EZIO_LOOKUP_SITE_TYPES 4
+#endif
+
+/** Counters of one lookup site, i.e., a name looked up in the display or one
+  element of a dotted path, in a module compiled with CompilerSettings.lookup_telemetry:
+  how often it was found by PyDict_GetItem, found by falling back to PyObject_GetAttr,
+  or not found at all, and the types of the objects it was looked up on.
+  */
+typedef struct {
+    unsigned long long dict_hits;
+    unsigned long long attr_hits;
+    unsigned long long misses;
+    // owned references, the first NULL ends the list:
+    PyTypeObject *types[EZIO_LOOKUP_SITE_TYPES];
+    // whether there were more types than fit:
+    int more_types;
+} ezio_lookup_site;
+
+/** Remember the type of `base` in `site`. */
+static inline void count_lookup_base(ezio_lookup_site *site, PyObject *base) {
+    PyTypeObject *type = Py_TYPE(base);
+    int i;
+    for (i = 0; i < EZIO_LOOKUP_SITE_TYPES; i++) {
+        if (site->types[i] == type) {
+            return;
+        }
+        if (site->types[i] == NULL) {
+            // keep the type alive, so another one can't take its address:
+            Py_INCREF(type);
+            site->types[i] = type;
+            return;
+        }
+    }
+    site->more_types = 1;
+}
+
+/** Count the lookup of a name in `display`, which found `found` (or NULL), in `site`. */
+static inline void count_display_lookup(ezio_lookup_site *site, PyObject *display, PyObject *found) {
+    count_lookup_base(site, display);
+    if (found) {
+        site->dict_hits++;
+    } else {
+        site->misses++;
+    }
+}
+
+/** PyObject_GetAttr, except that a missing attribute returns NULL without
+  setting an exception. For objects with the generic getattr (most new-style
+  instances) this follows PyObject_GenericGetAttr without formatting the
+  AttributeError at all; for the rest, it's cleared.
+  */
+static inline PyObject *getattr_quietly(PyObject *obj, PyObject *name) {
+    PyTypeObject *type = Py_TYPE(obj);
+    PyObject *result;
+    if (type->tp_getattro == PyObject_GenericGetAttr && PyString_CheckExact(name)
+            && type->tp_dict != NULL) {
+        PyObject *descr = _PyType_Lookup(type, name);
+        descrgetfunc getter = NULL;
+        if (descr != NULL) {
+            Py_INCREF(descr);
+            if (PyType_HasFeature(Py_TYPE(descr), Py_TPFLAGS_HAVE_CLASS)) {
+                getter = Py_TYPE(descr)->tp_descr_get;
+                // data descriptors (e.g., properties) come before the instance dict:
+                if (getter != NULL && PyDescr_IsData(descr)) {
+                    result = getter(descr, obj, (PyObject *) type);
+                    Py_DECREF(descr);
+                    goto DONE;
+                }
+            }
+        }
+        PyObject **dictptr = _PyObject_GetDictPtr(obj);
+        if (dictptr != NULL && *dictptr != NULL) {
+            PyObject *dict = *dictptr;
+            Py_INCREF(dict);
+            result = PyDict_GetItem(dict, name);
+            Py_XINCREF(result);
+            Py_DECREF(dict);
+            if (result != NULL) {
+                Py_XDECREF(descr);
+                return result;
+            }
+        }
+        if (getter != NULL) {
+            result = getter(descr, obj, (PyObject *) type);
+            Py_DECREF(descr);
+            goto DONE;
+        }
+        // a plain class attribute, or nothing at all:
+        return descr;
+    }
+    result = PyObject_GetAttr(obj, name);
+DONE:
+    if (result == NULL && PyErr_ExceptionMatches(PyExc_AttributeError)) {
+        PyErr_Clear();
+    }
+    return result;
+}
+
+/** Look up `name` on `base` as an element of a dotted path: the dict item,
+  or failing that, the attribute. Returns a new reference, or NULL; with `quiet`,
+  a missing attribute returns NULL without setting an exception. If `site` isn't
+  NULL, the lookup is counted in it.
+  */
+static inline PyObject *lookup_path_element(PyObject *base, PyObject *name, ezio_lookup_site *site, int quiet) {
+    if (site) {
+        count_lookup_base(site, base);
+    }
+    PyObject *result = PyDict_GetItem(base, name);
+    if (result != NULL) {
+        if (site) {
+            site->dict_hits++;
+        }
+        Py_INCREF(result);
+        return result;
+    }
+    result = quiet ? getattr_quietly(base, name) : PyObject_GetAttr(base, name);
+    if (site) {
+        if (result != NULL) {
+            site->attr_hits++;
+        } else {
+            site->misses++;
+        }
+    }
+    return result;
+}
+
+/**
+ * Does dotted path lookups as resolve_path does, counting the lookup of
+ * the path's ith element in sites[i], unless `sites` is NULL. With `quiet`,
+ * a path that isn't there returns NULL without setting an exception.
+ */
+static inline PyObject *resolve_path_counted(PyObject *base, ezio_lookup_site *sites, int quiet,
+        Py_ssize_t path_length, ...) {
+    Py_ssize_t counter;
+    va_list argslist;
+
+    if (base == NULL) return NULL;
+    // hold a reference to each element while looking up the next:
+    Py_INCREF(base);
+
+    va_start(argslist, path_length);
+    for (counter = 0; counter < path_length && base != NULL; counter++) {
+        PyObject *name = va_arg(argslist, PyObject *);
+        PyObject *next = lookup_path_element(base, name, sites ? &sites[counter] : NULL, quiet);
+        Py_DECREF(base);
+        base = next;
+    }
+    va_end(argslist);
+    return base;
+}
+
+/** Append the counters of `site` to the list `report`, as a dict, along with
+  where it is. Returns 0 on failure and 1 on success.
+  */
+static inline int export_lookup_site(PyObject *report, const char *class_name, const char *kind,
+        const char *name, int lineno, ezio_lookup_site *site) {
+    PyObject *types = PyList_New(0);
+    if (types == NULL) {
+        return 0;
+    }
+    int i;
+    for (i = 0; i < EZIO_LOOKUP_SITE_TYPES && site->types[i]; i++) {
+        PyObject *type_name = PyString_FromString(site->types[i]->tp_name);
+        if (type_name == NULL || PyList_Append(types, type_name) < 0) {
+            Py_XDECREF(type_name);
+            Py_DECREF(types);
+            return 0;
+        }
+        Py_DECREF(type_name);
+    }
+    PyObject *item = Py_BuildValue("{s:s,s:s,s:s,s:i,s:K,s:K,s:K,s:N,s:O}",
+            "template", class_name,
+            "kind", kind,
+            "name", name,
+            "line", lineno,
+            "dict_hits", site->dict_hits,
+            "attr_hits", site->attr_hits,
+            "misses", site->misses,
+            "types", types,
+            "more_types", site->more_types ? Py_True : Py_False);
+    if (item == NULL) {
+        return 0;
+    }
+    int status = PyList_Append(report, item);
+    Py_DECREF(item);
+    return status == 0;
+}
+
+/** Zero the counters of `site`, and forget the types it has seen. */
+static inline void reset_lookup_site(ezio_lookup_site *site) {
+    int i;
+    for (i = 0; i < EZIO_LOOKUP_SITE_TYPES; i++) {
+        Py_XDECREF((PyObject *) site->types[i]);
+    }
+    memset(site, 0, sizeof(*site));
+}
+
+/* Number of missing lookups a module remembers between drains. */
+#ifndef EZIO_MISSING_LOOKUPS_SIZE
+#define EZIO_MISSING_LOOKUPS_SIZE 1024
+#endif
+
+/** A lookup that found nothing, and was defaulted, in a module compiled with
+  CompilerSettings.default_missing_lookups. The strings are static.
+  */
+typedef struct {
+    const char *class_name;
+    int lineno;
+    const char *name;
+} ezio_missing_lookup;
+
+/** A ring buffer of the most recent missing lookups of a module, and the
+  number of them ever logged and drained. A zero-initialized (i.e., static)
+  log is empty.
+  */
+typedef struct {
+    ezio_missing_lookup entries[EZIO_MISSING_LOOKUPS_SIZE];
+    unsigned long long logged;
+    unsigned long long drained;
+} ezio_missing_lookups;
+
+/** Log a missing lookup in `log`, overwriting the oldest if it's full;
+  allocates nothing, and can't fail.
+  */
+static inline void log_missing_lookup(ezio_missing_lookups *log, const char *class_name, int lineno,
+        const char *name) {
+    ezio_missing_lookup *entry = &log->entries[log->logged % EZIO_MISSING_LOOKUPS_SIZE];
+    entry->class_name = class_name;
+    entry->lineno = lineno;
+    entry->name = name;
+    log->logged++;
+}
+
+/** Empty `log`, returning a new reference to a tuple of the list of its missing
+  lookups, oldest first, as (template, line, name) tuples, and the number of
+  them overwritten since the last drain; or NULL on failure.
+  */
+static inline PyObject *drain_missing_lookup_log(ezio_missing_lookups *log) {
+    unsigned long long start = log->drained;
+    if (log->logged - start > EZIO_MISSING_LOOKUPS_SIZE) {
+        start = log->logged - EZIO_MISSING_LOOKUPS_SIZE;
+    }
+    PyObject *misses = PyList_New((Py_ssize_t) (log->logged - start));
+    if (misses == NULL) {
+        return NULL;
+    }
+    unsigned long long i;
+    for (i = start; i < log->logged; i++) {
+        ezio_missing_lookup *entry = &log->entries[i % EZIO_MISSING_LOOKUPS_SIZE];
+        PyObject *item = Py_BuildValue("(sis)", entry->class_name, entry->lineno, entry->name);
+        if (item == NULL) {
+            Py_DECREF(misses);
+            return NULL;
+        }
+        PyList_SET_ITEM(misses, (Py_ssize_t) (i - start), item);
+    }
+    PyObject *result = Py_BuildValue("(NK)", misses, start - log->drained);
+    log->drained = log->logged;
+    return result;
+}
+
+/** Discard the elements of `transaction` from index `start` onwards.
+
+  Unlike PyList_SetSlice, this never reallocates the list's buffer,
+  so capturing and releasing a region of the transaction (as #call does)
+  leaves the list's capacity intact for the writes that follow.
+  The caveat about re-entering the interpreter from apply_unicode_filter
+  applies here as well.
+  */
+static inline void truncate_transaction(PyObject *transaction, Py_ssize_t start) {
+    Py_ssize_t size = PyList_GET_SIZE(transaction);
+    PyObject **items = ((PyListObject *) transaction)->ob_item;
+    Py_ssize_t i;
+    // shrink the list before releasing anything, so it's consistent
+    // if a destructor runs arbitrary code:
+    Py_SIZE(transaction) = start;
+    for (i = start; i < size; i++) {
+        Py_DECREF(items[i]);
+        items[i] = NULL;
+    }
+}
+
+/** Append `item` to `transaction`, creating a new reference to it.
+
+  Equivalent to PyList_Append, except that it fills spare capacity
+  directly; PyList_Append would shrink a presized empty list back down
+  on the first append, throwing away the capacity reserved by
+  acquire_transaction.
+  */
+static inline int transaction_append(PyObject *transaction, PyObject *item) {
+    PyListObject *list = (PyListObject *) transaction;
+    Py_ssize_t size = Py_SIZE(list);
+    if (size < list->allocated) {
+        Py_INCREF(item);
+        list->ob_item[size] = item;
+        Py_SIZE(list) = size + 1;
+        return 0;
+    }
+    return PyList_Append(transaction, item);
+}
+
+/* Maximum number of idle transaction lists kept by a pool;
+   renders of the same template only overlap through re-entrance,
+   so this can be small. */
+#ifndef EZIO_TRANSACTION_POOL_SIZE
+#define EZIO_TRANSACTION_POOL_SIZE 2
+#endif
+
+/* Lists with more capacity than this (in fragments) are freed rather than
+   pooled, and presizing never goes beyond it, so a single giant render
+   doesn't pin its memory forever. */
+#ifndef EZIO_TRANSACTION_MAX_CAPACITY
+#define EZIO_TRANSACTION_MAX_CAPACITY 16384
+#endif
+
+/** A pool of idle transaction lists, kept per template class,
+  along with the largest number of fragments a render has produced.
+  A zero-initialized (i.e., static) pool is empty and ready to use.
+  */
+typedef struct {
+    PyObject *lists[EZIO_TRANSACTION_POOL_SIZE];
+    Py_ssize_t num_lists;
+    Py_ssize_t high_water;
+} ezio_transaction_pool;
+
+/** Return a new reference to an empty list from `pool`, or NULL on failure.
+  If the pool is empty, the new list is presized to the pool's high water mark.
+  */
+static inline PyObject *acquire_transaction(ezio_transaction_pool *pool) {
+    if (pool->num_lists > 0) {
+        pool->num_lists--;
+        return pool->lists[pool->num_lists];
+    }
+
+    PyObject *transaction = PyList_New(pool->high_water);
+    if (transaction == NULL) {
+        return NULL;
+    }
+    // keep the buffer that PyList_New allocated, but mark it as unused:
+    Py_SIZE(transaction) = 0;
+    return transaction;
+}
+
+/** Empty a list obtained from acquire_transaction and return it to `pool`,
+  or free it if the pool is full or the list has grown too large.
+  Steals the reference to `transaction`.
+  */
+static inline void release_transaction(ezio_transaction_pool *pool, PyObject *transaction) {
+    Py_ssize_t size = PyList_GET_SIZE(transaction);
+    if (size > pool->high_water) {
+        pool->high_water = size < EZIO_TRANSACTION_MAX_CAPACITY ? size : EZIO_TRANSACTION_MAX_CAPACITY;
+    }
+
+    if (pool->num_lists < EZIO_TRANSACTION_POOL_SIZE
+            && ((PyListObject *) transaction)->allocated <= EZIO_TRANSACTION_MAX_CAPACITY) {
+        // this releases the fragments, which can run arbitrary code (e.g., a __del__
+        // that renders this same class, and releases into this pool), so check again after:
+        truncate_transaction(transaction, 0);
+        if (pool->num_lists < EZIO_TRANSACTION_POOL_SIZE) {
+            pool->lists[pool->num_lists] = transaction;
+            pool->num_lists++;
+            return;
+        }
+    }
+    Py_DECREF(transaction);
+}
+
 /**
   This is equivalent to PyObject_GetItem, but it promotes a common case.
   Copied and pasted from ceval.c's (i.e., the interpreter's) handling of the
   BINARY_SUBSCR opcode.
   */
-PyObject *optimized_getitem(PyObject *expr, PyObject *subscript) {
+static inline PyObject *optimized_getitem(PyObject *expr, PyObject *subscript) {
     PyObject *x;
     if (PyList_CheckExact(expr) && PyInt_CheckExact(subscript)) {
         /* INLINE: list[int] */
@@ -297,12 +1036,13 @@ PyObject *optimized_getitem(PyObject *expr, PyObject *subscript) {
 
 /**
   Implement the unary `not` operation as a C-API call returning a borrowed reference.
-  We could explicitly declare this inline if we wanted.
   */
-PyObject *unary_not(PyObject *expr) {
+static inline PyObject *unary_not(PyObject *expr) {
     int result = PyObject_IsTrue(expr);
     if (result == 0) return Py_True;
     else if (result == 1) return Py_False;
     // the error condition is -1
     return NULL;
 }
+
+#endif
@@ -0,0 +1 @@
+from .builder import compile_string
@@ -0,0 +1,141 @@
+"""
+Bulk rendering for offline jobs (static pages, sitemaps, emails), spread
+across a pool of worker processes.
+
+A compiled template holds the GIL for the whole of a render, so threads
+don't help; instead, each worker process imports the template module once,
+then renders chunks of displays with the module's batch hook,
+<class>_respond_many. The hook is looked up in the calling process first, so
+a template that can't be imported fails there, rather than in every worker.
+Displays (and self_ptr) are sent to the workers by pickling, so they must be
+picklable.
+
+The main entry points here are render and render_to_files.
+"""
+
+from __future__ import with_statement
+
+import collections
+import importlib
+import multiprocessing
+
+DEFAULT_CHUNK_SIZE = 64
+
+# the template class and self_ptr of a worker process, set by _init_worker:
+_worker_template = None
+_worker_self_ptr = None
+# its batch hook, resolved by the first chunk the worker renders:
+_worker_respond_many = None
+
+def _get_respond_many(module_name, class_name):
+    """Import the template module and look up the batch hook of `class_name`."""
+    return getattr(importlib.import_module(module_name), '%s_respond_many' % (class_name,))
+
+def _init_worker(module_name, class_name, self_ptr):
+    """Pool initializer. This mustn't fail (the pool would replace the worker
+    forever), so the import is left to _worker_hook, in the first task.
+    """
+    global _worker_template, _worker_self_ptr
+    _worker_template = (module_name, class_name)
+    _worker_self_ptr = self_ptr
+
+def _worker_hook():
+    """The batch hook of this worker's template class; any failure to
+    import it is raised from the task, and so reaches the caller.
+    """
+    global _worker_respond_many
+    if _worker_respond_many is None:
+        _worker_respond_many = _get_respond_many(*_worker_template)
+    return _worker_respond_many
+
+def _render_chunk(displays):
+    return _worker_hook()(displays, _worker_self_ptr)
+
+def _render_chunk_to_files(paths_and_displays):
+    paths = [path for path, _ in paths_and_displays]
+    displays = [display for _, display in paths_and_displays]
+    for path, output in zip(paths, _worker_hook()(displays, _worker_self_ptr)):
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        with open(path, 'wb') as outfile:
+            outfile.write(output)
+    return paths
+
+def _chunks(iterable, chunk_size):
+    """Group the items of `iterable` into lists of at most `chunk_size` items."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _module_name(template_module):
+    """Accept either a module object or its dotted name."""
+    return getattr(template_module, '__name__', template_module)
+
+def _map_in_order(func, template_module, class_name, items, processes, chunk_size, max_in_flight, self_ptr):
+    """Apply `func` to chunks of `items` in a worker pool, returning an iterator
+    over the results for each chunk in order, with at most `max_in_flight` chunks
+    outstanding. `items` is consumed lazily, so it can be an arbitrarily long
+    iterator. Raises ImportError or AttributeError right away if the template
+    class can't be found.
+    """
+    module_name = _module_name(template_module)
+    _get_respond_many(module_name, class_name)
+    return _map_chunks(func, module_name, class_name, items, processes, chunk_size, max_in_flight, self_ptr)
+
+def _map_chunks(func, module_name, class_name, items, processes, chunk_size, max_in_flight, self_ptr):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * processes
+    assert chunk_size > 0 and max_in_flight > 0
+
+    pool = multiprocessing.Pool(processes, _init_worker, (module_name, class_name, self_ptr))
+    try:
+        in_flight = collections.deque()
+        for chunk in _chunks(items, chunk_size):
+            if len(in_flight) == max_in_flight:
+                yield in_flight.popleft().get()
+            in_flight.append(pool.apply_async(func, (chunk,)))
+        while in_flight:
+            yield in_flight.popleft().get()
+        pool.close()
+    finally:
+        # also reached if the caller stops iterating early, or a render fails:
+        pool.terminate()
+        pool.join()
+
+def render(template_module, class_name, displays, processes=None, chunk_size=DEFAULT_CHUNK_SIZE,
+        max_in_flight=None, self_ptr=None):
+    """Render each of `displays` against a template class, in a pool of worker
+    processes, and return an iterator over the outputs, in the same order as
+    `displays`. Raises ImportError or AttributeError right away if the template
+    class can't be found.
+
+    Args:
+        template_module - compiled template module, or its dotted name
+        class_name - name of the template class within the module
+        displays - iterable of display dicts
+        processes - number of worker processes (defaults to the number of CPUs)
+        chunk_size - number of displays sent to a worker at a time
+        max_in_flight - maximum number of chunks submitted but not yet yielded
+            (defaults to twice the number of processes); this bounds memory use
+        self_ptr - passed as self_ptr to every render
+    """
+    chunks = _map_in_order(_render_chunk, template_module, class_name, displays, processes,
+            chunk_size, max_in_flight, self_ptr)
+    return (output for outputs in chunks for output in outputs)
+
+def render_to_files(template_module, class_name, paths_and_displays, processes=None,
+        chunk_size=DEFAULT_CHUNK_SIZE, max_in_flight=None, self_ptr=None):
+    """Like render, but takes an iterable of (path, display) pairs and has the
+    workers write each output directly to its path (unicode output is encoded as
+    UTF-8); the iterator returned yields the paths in order as they are written.
+    """
+    chunks = _map_in_order(_render_chunk_to_files, template_module, class_name, paths_and_displays,
+            processes, chunk_size, max_in_flight, self_ptr)
+    return (path for paths in chunks for path in paths)
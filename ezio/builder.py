@@ -1,24 +1,39 @@
 """
 Build tools, including stuff for project management.
 
-The main entry points here are compile_single_file and build_project.
+The main entry points here are compile_single_file, compile_string, build_shared_runtime,
+and build_project.
 """
 
 from __future__ import with_statement
 
 import ast
+import collections
+import fcntl
+import glob
+import hashlib
+import imp
+import json
+import multiprocessing
 import os
 import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from StringIO import StringIO
 
-import distutils.core
+import distutils.sysconfig
 
 from . import tmpl2py
+from . import toolchain
 from . import py2moremeaningfulpy
 from .tsort import topological_sort
-from .compiler import CodeGenerator, generate_c_file
+from .compiler import ClassSummary, CodeGenerator, SharedRuntime, generate_c_file, generate_shared_runtime_c_file, \
+    generate_split_c_files, resolve_line_directives
+from .constants import CompilerSettings
 
 EXTENDS_REGEX = re.compile('^#extends (.*)$')
 
@@ -27,28 +42,109 @@ MODULE_NAME = 'templates'
 _dirname, _filename = os.path.split(__file__)
 EZIO_DIR = os.path.join(_dirname, '..', 'ezio')
 
-def buildext(filename, add_pg_option=False):
-    """Programmatically compile a file of C(++) source code to a Python C extension.
+# records the build key of the last successful build, next to the extension module:
+BUILD_STAMP_EXTENSION = '.ezio_build'
+# describes the contents of a shared runtime module, next to it:
+SHARED_RUNTIME_EXTENSION = '.ezio_runtime'
+# records the build key and the ClassSummary of each class of a project, next to its C file:
+CLASS_SUMMARY_EXTENSION = '.ezio_class'
+
+# overrides the default location of the modules built by compile_string:
+MODULE_CACHE_ENV_VAR = 'EZIO_MODULE_CACHE'
+DEFAULT_MODULE_CACHE_DIR = os.path.join('~', '.cache', 'ezio', 'modules')
+
+# computed once per process, by compiler_fingerprint:
+_compiler_fingerprint = None
+
+# modules imported by compile_string, by build key, and a lock per build key,
+# so that threads compiling the same source wait for one build:
+_string_modules = {}
+_string_module_locks = collections.defaultdict(threading.Lock)
+_string_module_locks_lock = threading.Lock()
+
+class BuildStats(object):
+    """Collects wall time per phase of the compilation pipeline, for each template
+    and for the module as a whole, and the sizes of the generated code.
+    """
+
+    def __init__(self):
+        # template name -> phase name -> seconds:
+        self.template_phases = collections.defaultdict(dict)
+        self.module_phases = {}
+        # C filename -> number of lines:
+        self.c_file_lines = {}
+        self.registry_sizes = {}
+
+    @contextmanager
+    def timed(self, phase, template_name=None):
+        """Time the enclosed code as `phase` of `template_name`, or of the whole module."""
+        phases = self.template_phases[template_name] if template_name is not None else self.module_phases
+        start = time.time()
+        yield
+        phases[phase] = phases.get(phase, 0.0) + time.time() - start
+
+    def record_registries(self, literal_registry, path_registry, import_registry, expression_registry):
+        """Count the entries of a set of registries; the classes of a project
+        each have their own, and the sizes recorded are the totals.
+        """
+        sizes = {
+            'literals': len(literal_registry.literals),
+            'paths': len(path_registry.subpath_to_fname),
+            'imports': import_registry.num_objects,
+            'expressions': expression_registry.num_objects,
+        }
+        for name, size in sizes.iteritems():
+            self.registry_sizes[name] = self.registry_sizes.get(name, 0) + size
+
+    def record_c_file(self, filename, code):
+        self.c_file_lines[filename] = code.count('\n') + 1
+
+    def report(self, build_report=None, extension_filename=None):
+        """Everything collected, plus the C++ compile times from the build report
+        of buildext and the size of the extension module, as a JSON-serializable dict.
+        """
+        result = {
+            'templates': self.template_phases,
+            'module': self.module_phases,
+            'c_file_lines': self.c_file_lines,
+            'registries': self.registry_sizes,
+        }
+        if build_report is not None:
+            result['compile'] = build_report['compile']
+            result['link_seconds'] = build_report['link_seconds']
+        if extension_filename is not None:
+            result['extension_bytes'] = os.path.getsize(extension_filename)
+        return result
+
+def buildext(filenames, add_pg_option=False, jobs=None, object_cache=None, profile='default', pgo_workload=None,
+        object_dir=None):
+    """Programmatically compile C(++) source code to a Python C extension,
+    next to the first source file and named after it.
 
     Args:
-        filename - c/c++ source file
+        filenames - c/c++ source file, or list of source files to be linked into one extension
         add_pg_option - compile with support for gprof
+        jobs - number of source files to compile in parallel (defaults to the number of CPUs)
+        object_cache - toolchain.ObjectCache to compile through (defaults to the user's cache)
+        profile - name of the optimization profile, see toolchain.BUILD_PROFILES
+        pgo_workload - command line (as a list) to run against an instrumented build
+                       of the extension; if given, the extension is then rebuilt
+                       with profile-guided optimization
+        object_dir - compile the object files into this directory, bypassing the object cache
+    Returns: the build report from toolchain.build_extension
     """
-    # XXX black magic; we need to supply, e.g., "tools/templates/simple" rather than "simple"
-    # as the module name, in order to make --inplace build the C module under tools/templates
-    # rather than the cwd
-    module_name_with_path, _ = os.path.splitext(filename)
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+    module_name_with_path, _ = os.path.splitext(filenames[0])
+    output = module_name_with_path + distutils.sysconfig.get_config_var('SO')
 
-    tempdir = tempfile.mkdtemp()
+    if pgo_workload is not None:
+        return toolchain.build_extension_with_pgo(filenames, output, pgo_workload, profile=profile, jobs=jobs)
 
     pg_option = ['-pg'] if add_pg_option else []
-    distutils.core.setup(
-        script_name='setup.py',
-        script_args=['build_ext', '--inplace', '--build-temp=%s' % tempdir],
-        ext_modules=[distutils.core.Extension(module_name_with_path, [filename], include_dirs=[EZIO_DIR], extra_compile_args=pg_option)]
-    )
-
-    shutil.rmtree(tempdir)
+    ezio_toolchain = toolchain.Toolchain(profile, extra_compile_args=pg_option, extra_link_args=pg_option)
+    return toolchain.build_extension(filenames, output, toolchain=ezio_toolchain,
+            object_cache=object_cache, jobs=jobs, object_dir=object_dir)
 
 def process_filename(filename):
     """Extract the module name and the target C filename from the .tmpl source file name,
@@ -66,34 +162,221 @@ def project_dirname_to_c_filename(dirname):
     Entangled with build_project below."""
     return os.path.join(dirname, MODULE_NAME + ".cpp")
 
-def compile_single_file(filename):
-    """Compile a .tmpl file, with no dependencies, to a single C file."""
+def project_dirname_to_header_filename(dirname):
+    """Get the filename of the header at the root of all the C files of a project."""
+    return os.path.join(dirname, MODULE_NAME + ".h")
+
+def project_class_to_header_filename(dirname, classname):
+    """Get the filename of the header defining one class of a project."""
+    return os.path.join(dirname, '%s_%s.h' % (MODULE_NAME, classname))
+
+def project_class_to_c_filename(dirname, classname):
+    """Get the filename of the C file for one class of a project."""
+    return os.path.join(dirname, '%s_%s.cpp' % (MODULE_NAME, classname))
+
+def project_class_to_summary_filename(dirname, classname):
+    """Get the filename recording what the C file for one class of a project was built from."""
+    return os.path.join(dirname, '%s_%s%s' % (MODULE_NAME, classname, CLASS_SUMMARY_EXTENSION))
+
+def project_dirname_to_c_filenames(dirname):
+    """Get the filenames of all the C files for a project, the shared one first."""
+    build_order, _ = produce_dependency_ordering(dirname)
+    return [project_dirname_to_c_filename(dirname)] + \
+        [project_class_to_c_filename(dirname, classname) for classname in build_order]
+
+def compile_single_file(filename, compiler_settings=None, shared_runtime=None, stats=None):
+    """Compile a .tmpl file, with no dependencies, to a single C file.
+    If a SharedRuntime is given, the module gets any literals and imports
+    it has in common with the runtime from there. If a BuildStats is given,
+    the build is recorded in it.
+    """
     module_name, out_file_name = process_filename(filename)
+    if stats is None:
+        stats = BuildStats()
 
     with open(filename) as infile:
-        parsetree = tmpl2moremeaningfulpy(module_name, infile)
-
-    generator = CodeGenerator()
-    code = generator.run(module_name, parsetree)
+        parsetree = tmpl2moremeaningfulpy(module_name, infile, stats, compiler_settings)
+
+    generator = CodeGenerator(compiler_settings=compiler_settings, shared_runtime=shared_runtime,
+        template_filename=os.path.abspath(filename))
+    with stats.timed('codegen', module_name):
+        generator.visit(parsetree)
+    with stats.timed('get_lines'):
+        code = generate_c_file(module_name, generator.registry, generator.path_registry, generator.import_registry,
+            generator.expression_registry, [generator], shared_runtime=shared_runtime)
+        code = resolve_line_directives(code, os.path.abspath(out_file_name))
+    stats.record_registries(generator.registry, generator.path_registry, generator.import_registry,
+        generator.expression_registry)
+    stats.record_c_file(out_file_name, code)
 
     with open(out_file_name, 'w') as out_file:
         out_file.write(code)
 
     return out_file_name
 
-def compile_class(filename, **kwargs):
+def compile_string(source, name, compiler_settings=None, cache_dir=None, profile='default'):
+    """Compile the source code of a template, with no dependencies, and import it,
+    without touching the source tree: the C++ file and the extension module go
+    in a directory of their own in the module cache, named by a hash of everything
+    that goes into the build, so compiling the same source again (in this process
+    or any other) just imports the cached module. The module is named after the
+    template and the hash, so that different sources compiled under the same
+    name (or the name of some other module) never share a module object.
+
+    Args:
+        source - the text of the template
+        name - name of the template class, and the prefix of the module's name
+        compiler_settings - CompilerSettings
+        cache_dir - the module cache (defaults to $EZIO_MODULE_CACHE or ~/.cache/ezio/modules)
+        profile - name of the optimization profile, see toolchain.BUILD_PROFILES
+    Returns: the module
+    """
+    hasher = hashlib.sha1(compiler_fingerprint() + settings_fingerprint(compiler_settings))
+    hasher.update(repr((name, profile)))
+    hasher.update(source)
+    build_key = hasher.hexdigest()
+
+    module = _string_modules.get(build_key)
+    if module is not None:
+        return module
+
+    with _string_module_locks_lock:
+        build_lock = _string_module_locks[build_key]
+    with build_lock:
+        module = _string_modules.get(build_key)
+        if module is None:
+            if cache_dir is None:
+                cache_dir = os.environ.get(MODULE_CACHE_ENV_VAR) or DEFAULT_MODULE_CACHE_DIR
+            module_name = string_module_name(name, build_key)
+            output = _build_string_module(source, name, module_name, build_key, compiler_settings,
+                os.path.expanduser(cache_dir), profile)
+            module = _string_modules[build_key] = imp.load_dynamic(module_name, output)
+    return module
+
+def string_module_name(name, build_key):
+    """Name of the module compile_string builds for the template `name`."""
+    return '%s_%s' % (name, build_key[:16])
+
+def _build_string_module(source, name, module_name, build_key, compiler_settings, cache_dir, profile):
+    """Build the module for compile_string, unless it's already in the cache; returns its filename."""
+    module_dir = os.path.join(cache_dir, build_key)
+    output = os.path.join(module_dir, module_name + distutils.sysconfig.get_config_var('SO'))
+    if os.path.exists(output):
+        return output
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # somebody else got there first:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    # other processes building the same source wait here, then find it built:
+    lock_file_name = module_dir + '.lock'
+    with open(lock_file_name, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(output):
+            _remove_lock_file(lock_file_name)
+            return output
+
+        parsetree = tmpl2moremeaningfulpy(name, StringIO(source), compiler_settings=compiler_settings)
+        code = CodeGenerator(compiler_settings=compiler_settings).run(module_name, parsetree)
+
+        work_dir = tempfile.mkdtemp(prefix='build_', dir=cache_dir)
+        try:
+            c_file_name = os.path.join(work_dir, module_name + '.cpp')
+            with open(c_file_name, 'w') as outfile:
+                outfile.write(code)
+            toolchain.build_extension([c_file_name], os.path.join(work_dir, os.path.basename(output)),
+                toolchain=toolchain.Toolchain(profile), jobs=1, object_dir=work_dir)
+            # a directory without the module is left over from an interrupted build
+            # (or is somebody else's); the lock is ours, so nobody is publishing into it:
+            if os.path.isdir(module_dir):
+                shutil.rmtree(module_dir)
+            # publish the whole directory at once, so nobody sees a partial build:
+            os.rename(work_dir, module_dir)
+        finally:
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+        # anybody who opens the lock file from now on finds the module first:
+        _remove_lock_file(lock_file_name)
+    return output
+
+def _remove_lock_file(lock_file_name):
+    try:
+        os.unlink(lock_file_name)
+    except OSError:
+        # a process that waited on the same lock removed it already:
+        if os.path.exists(lock_file_name):
+            raise
+
+def compile_class(filename, stats=None, parsetree=None, **kwargs):
     """Compile a .tmpl file, with any dependencies specified in the kwargs,
-    and return the resulting code generator object.
+    and return the resulting code generator object. If the template has
+    already been parsed, pass its `parsetree`.
     """
     module_name, _ = process_filename(filename)
+    if stats is None:
+        stats = BuildStats()
 
-    with open(filename) as infile:
-        parsetree = tmpl2moremeaningfulpy(module_name, infile)
+    if parsetree is None:
+        with open(filename) as infile:
+            parsetree = tmpl2moremeaningfulpy(module_name, infile, stats, kwargs.get('compiler_settings'))
 
+    kwargs.setdefault('template_filename', os.path.abspath(filename))
     generator = CodeGenerator(**kwargs)
-    generator.visit(parsetree)
+    with stats.timed('codegen', module_name):
+        generator.visit(parsetree)
     return generator
 
+def shared_runtime_filenames(directory, runtime_module_name):
+    """Get the C filename and the description filename of a shared runtime module,
+    given the directory it lives in and its dotted name.
+    """
+    _, _, base_name = runtime_module_name.rpartition('.')
+    base_name_with_path = os.path.join(directory, base_name)
+    return base_name_with_path + '.cpp', base_name_with_path + SHARED_RUNTIME_EXTENSION
+
+def build_shared_runtime(filenames, runtime_module_name, compiler_settings=None, min_templates=2):
+    """Generate a shared runtime module for the .tmpl files `filenames`, owning
+    every literal and import statement that at least `min_templates` of them have
+    in common, and write it next to the first of them, along with its description.
+
+    `runtime_module_name` is the dotted name the module will be imported under.
+
+    Returns: the C filename, and the SharedRuntime to compile the templates against
+    """
+    literal_counts, statement_counts = {}, {}
+    literals, import_statements = [], []
+    for filename in filenames:
+        generator = compile_class(filename, compiler_settings=compiler_settings)
+        # count each template once, keeping the order of first appearance:
+        for literal_key in set(generator.registry.literal_key_to_index):
+            literal_counts[literal_key] = literal_counts.get(literal_key, 0) + 1
+        for literal in generator.registry.literals:
+            if literal_counts[generator.registry._value_to_key(literal)] == min_templates:
+                literals.append(literal)
+        for statement_key in set(generator.import_registry.statement_key_to_indices):
+            statement_counts[statement_key] = statement_counts.get(statement_key, 0) + 1
+        for statement_key, _, _ in generator.import_registry.statements:
+            if statement_counts[statement_key] == min_templates and statement_key not in import_statements:
+                import_statements.append(statement_key)
+
+    shared_runtime = SharedRuntime(runtime_module_name, literals, import_statements)
+
+    c_file_name, description_filename = shared_runtime_filenames(os.path.dirname(filenames[0]), runtime_module_name)
+    with open(c_file_name, 'w') as outfile:
+        outfile.write(generate_shared_runtime_c_file(shared_runtime))
+    with open(description_filename, 'w') as outfile:
+        shared_runtime.dump(outfile)
+    return c_file_name, shared_runtime
+
+def load_shared_runtime(description_filename):
+    """Read the description of a shared runtime module written by build_shared_runtime."""
+    with open(description_filename) as infile:
+        return SharedRuntime.load(infile)
+
 def find_superclass(filename):
     """Scan a file for an #extends declaration, return the declared superclass or None."""
     with open(filename) as infile:
@@ -143,51 +426,275 @@ def produce_dependency_ordering(project_dir):
         raise ValueError('Circular dependency detected.')
     return build_order, class_to_superclass
 
-def build_project(project_dir):
+def _parse_template(args):
+    """Parse one template for parse_templates, in a worker process."""
+    filename, compiler_settings = args
+    module_name, _ = process_filename(filename)
+    stats = BuildStats()
+    with open(filename) as infile:
+        parsetree = tmpl2moremeaningfulpy(module_name, infile, stats, compiler_settings)
+    return parsetree, stats.template_phases[module_name]
+
+def parse_templates(filenames, compiler_settings=None, stats=None, jobs=None):
+    """Run the front end (tmpl2moremeaningfulpy) on each of `filenames`, `jobs`
+    at a time in separate processes (defaults to the number of CPUs), and return
+    the parse trees in the same order. If a BuildStats is given, the phases of
+    each template are recorded in it.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    work = [(filename, compiler_settings) for filename in filenames]
+    if jobs > 1 and len(filenames) > 1:
+        # lexing and parsing are pure Python, so it takes processes to run several at once:
+        pool = multiprocessing.Pool(min(jobs, len(filenames)))
+        try:
+            results = pool.map(_parse_template, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_parse_template, work)
+
+    parsetrees = []
+    for filename, (parsetree, phases) in zip(filenames, results):
+        if stats is not None:
+            module_name, _ = process_filename(filename)
+            stats.template_phases[module_name].update(phases)
+        parsetrees.append(parsetree)
+    return parsetrees
+
+def _read_class_summary(project_dir, classname, build_key):
+    """Return the description of a class (see ClassSummary.describe) recorded by the
+    last build of the project, if it was built with `build_key` from the same
+    template, and its C file is still the one generated then (watch mode, say,
+    may have replaced it since); otherwise return None.
+    """
+    try:
+        with open(project_class_to_summary_filename(project_dir, classname)) as infile:
+            record = json.load(infile)
+        c_file_hash = _hash_file(project_class_to_c_filename(project_dir, classname))
+    except (IOError, ValueError):
+        return None
+    template_filename = os.path.abspath(os.path.join(project_dir, classname + '.tmpl'))
+    if (record.get('key'), record.get('template'), record.get('c_file')) != (build_key, template_filename, c_file_hash):
+        return None
+    return record['class']
+
+def _write_class_summary(project_dir, classname, build_key, compiled_class):
+    record = {
+        'key': build_key,
+        'template': os.path.abspath(os.path.join(project_dir, classname + '.tmpl')),
+        'c_file': _hash_file(project_class_to_c_filename(project_dir, classname)),
+        'class': ClassSummary.describe(compiled_class),
+    }
+    with open(project_class_to_summary_filename(project_dir, classname), 'w') as outfile:
+        json.dump(record, outfile)
+
+def build_project(project_dir, compiler_settings=None, stats=None, jobs=None, reuse_classes=True):
     """Naive pipeline to build all classes in order,
-    then output all the generated C++ to a file,
-    then return the resulting filename.
+    then output the generated C++ as a root header, a header and a C file
+    per class, and a shared C file, then return the C filenames (shared file first).
+    The templates are parsed `jobs` at a time (see parse_templates) before
+    any code is generated. If a BuildStats is given, the build is recorded in it.
+
+    A class whose build key (see class_build_keys) is the same as in the last
+    build keeps its C file: it's neither parsed nor compiled again, unless
+    `reuse_classes` is False.
     """
     build_order, class_to_superclass = produce_dependency_ordering(project_dir)
+    if stats is None:
+        stats = BuildStats()
 
     assert len(build_order) > 0, "Can't build empty project."
 
-    classname_to_def = {}
-    compiled_classes = []
+    class_to_key = class_build_keys(project_dir, compiler_settings)
+    class_to_description = {}
+    for classname in (build_order if reuse_classes else []):
+        description = _read_class_summary(project_dir, classname, class_to_key[classname])
+        if description is not None:
+            class_to_description[classname] = description
 
-    literal_registry = path_registry = import_registry = expression_registry = None
+    # Parsing is independent per class, but code generation needs the superclass's
+    # definition, so it runs in order:
+    stale_classes = [classname for classname in build_order if classname not in class_to_description]
+    pathnames = dict((classname, os.path.join(project_dir, classname + '.tmpl')) for classname in build_order)
+    parsetrees = dict(zip(stale_classes,
+        parse_templates([pathnames[classname] for classname in stale_classes], compiler_settings, stats, jobs)))
 
+    classname_to_def = {}
+    compiled_classes = []
     for classname in build_order:
-        filename = classname + '.tmpl'
-        pathname = os.path.join(project_dir, filename)
+        superclass_def = classname_to_def.get(class_to_superclass.get(classname))
+        if classname in class_to_description:
+            compiled_class = ClassSummary.from_description(class_to_description[classname], superclass_def,
+                compiler_settings)
+        else:
+            # each class has registries of its own, so its code doesn't depend on the other classes':
+            compiled_class = compile_class(pathnames[classname], stats=stats, parsetree=parsetrees[classname],
+                superclass_definition=superclass_def, compiler_settings=compiler_settings)
+            stats.record_registries(compiled_class.registry, compiled_class.path_registry,
+                compiled_class.import_registry, compiled_class.expression_registry)
+        classname_to_def[classname] = compiled_class.class_definition
+        compiled_classes.append(compiled_class)
+
+    c_file_names = write_project_files(project_dir, MODULE_NAME, compiled_classes, stats)
+    # only once the C files are written:
+    for classname in stale_classes:
+        _write_class_summary(project_dir, classname, class_to_key[classname],
+            compiled_classes[build_order.index(classname)])
+    return c_file_names
+
+def write_project_files(project_dir, module_name, compiled_classes, stats=None,
+        shared_c_file_name=None):
+    """Generate the split C++ files for the compiled classes (CodeGenerators or
+    ClassSummaries) of a project, module `module_name`, and write them to the
+    project directory (the shared C file to `shared_c_file_name`, if given);
+    return the C filenames, shared file first.
+    """
+    if stats is None:
+        stats = BuildStats()
+    if shared_c_file_name is None:
+        shared_c_file_name = project_dirname_to_c_filename(project_dir)
+
+    header_name = project_dirname_to_header_filename(project_dir)
+    class_names = [compiled_class.class_definition.class_name for compiled_class in compiled_classes]
+    class_header_names = dict((classname, os.path.basename(project_class_to_header_filename(project_dir, classname)))
+        for classname in class_names)
+    with stats.timed('get_lines'):
+        header_code, shared_code, class_files = generate_split_c_files(module_name,
+            os.path.basename(header_name), class_header_names, compiled_classes)
+
+    files_and_code = [(header_name, header_code), (shared_c_file_name, shared_code)]
+    c_file_names = [shared_c_file_name]
+    for classname, class_header_code, class_code in class_files:
+        c_file_name = project_class_to_c_filename(project_dir, classname)
+        files_and_code.append((project_class_to_header_filename(project_dir, classname), class_header_code))
+        # (a class summarized from an earlier build keeps its C file)
+        if class_code is not None:
+            files_and_code.append((c_file_name, class_code))
+        c_file_names.append(c_file_name)
+    for filename, code in files_and_code:
+        code = resolve_line_directives(code, os.path.abspath(filename))
+        stats.record_c_file(filename, code)
+        with open(filename, 'w') as outfile:
+            outfile.write(code)
+
+    return c_file_names
+
+def _hash_file(filename):
+    with open(filename, 'rb') as infile:
+        return hashlib.sha1(infile.read()).hexdigest()
+
+def compiler_fingerprint():
+    """Hash identifying this version of EZIO (i.e., the compiler's own source
+    and the runtime header) and of the Python it builds for. EZIO doesn't change
+    under a running process, so this is only computed once.
+    """
+    global _compiler_fingerprint
+    if _compiler_fingerprint is None:
+        hasher = hashlib.sha1(sys.version)
+        ezio_sources = glob.glob(os.path.join(EZIO_DIR, '*.py')) + [os.path.join(EZIO_DIR, 'Ezio.h')]
+        for source in sorted(ezio_sources):
+            hasher.update(os.path.basename(source))
+            hasher.update(_hash_file(source))
+        _compiler_fingerprint = hasher.hexdigest()
+    return _compiler_fingerprint
+
+def settings_fingerprint(compiler_settings=None):
+    """Hash of all the knobs and switches in a CompilerSettings."""
+    if compiler_settings is None:
+        compiler_settings = CompilerSettings()
+    knobs = sorted((name, repr(getattr(compiler_settings, name)))
+            for name in dir(compiler_settings) if not name.startswith('_'))
+    return hashlib.sha1(repr(knobs)).hexdigest()
+
+def class_build_keys(project_dir, compiler_settings=None):
+    """Compute a build key for every class in a project; the key of a class
+    covers its own source, the key of its superclass (and hence the whole
+    superclass chain), the compiler settings, and the EZIO version.
+    Returns a dict of class names to keys.
+    """
+    build_order, class_to_superclass = produce_dependency_ordering(project_dir)
+    common_key = compiler_fingerprint() + settings_fingerprint(compiler_settings)
 
+    class_to_key = {}
+    # superclasses precede their subclasses in build_order:
+    for classname in build_order:
+        hasher = hashlib.sha1(common_key)
+        hasher.update(_hash_file(os.path.join(project_dir, classname + '.tmpl')))
         superclass_name = class_to_superclass.get(classname)
-        superclass_def = classname_to_def.get(superclass_name)
+        if superclass_name is not None:
+            hasher.update(class_to_key[superclass_name])
+        class_to_key[classname] = hasher.hexdigest()
+    return class_to_key
 
-        class_generator = compile_class(pathname, superclass_definition=superclass_def,
-            literal_registry=literal_registry, path_registry=path_registry, import_registry=import_registry)
+def target_build_key(target, compiler_settings=None, build_options=()):
+    """Compute the build key for a .tmpl file or a project directory; if the key is
+    unchanged since the last build, the extension module doesn't need to be rebuilt.
 
-        classname_to_def[classname] = class_generator.class_definition
-        compiled_classes.append(class_generator)
+    `build_options` are any other options affecting the build (e.g., the optimization profile).
+    """
+    if os.path.isdir(target):
+        class_to_key = class_build_keys(target, compiler_settings)
+        hasher = hashlib.sha1(repr(sorted(class_to_key.items())))
+    else:
+        hasher = hashlib.sha1(compiler_fingerprint() + settings_fingerprint(compiler_settings))
+        hasher.update(_hash_file(target))
+    hasher.update(repr(tuple(build_options)))
+    return hasher.hexdigest()
+
+def target_to_c_filename(target):
+    """Get the C++ filename for a .tmpl file or a project directory."""
+    if os.path.isdir(target):
+        return project_dirname_to_c_filename(target)
+    _, c_file_name = process_filename(target)
+    return c_file_name
 
-        # persist the registries across compilations of individual classes:
-        literal_registry = class_generator.registry
-        path_registry = class_generator.path_registry
-        import_registry = class_generator.import_registry
-        expression_registry = class_generator.expression_registry
+def target_to_extension_filename(target):
+    """Get the filename of the extension module built for a .tmpl file or a project directory."""
+    base_name, _ = os.path.splitext(target_to_c_filename(target))
+    return base_name + distutils.sysconfig.get_config_var('SO')
 
-    c_file_code = generate_c_file(MODULE_NAME, literal_registry, path_registry,
-            import_registry, expression_registry, compiled_classes)
-    c_file_name = project_dirname_to_c_filename(project_dir)
-    with open(c_file_name, 'w') as outfile:
-        outfile.write(c_file_code)
+def _build_stamp_filename(target):
+    base_name, _ = os.path.splitext(target_to_c_filename(target))
+    return base_name + BUILD_STAMP_EXTENSION
 
-    return c_file_name
+def is_up_to_date(target, build_key):
+    """Check whether the extension module for `target` was built with `build_key`."""
+    if not os.path.exists(target_to_extension_filename(target)):
+        return False
+
+    try:
+        with open(_build_stamp_filename(target)) as infile:
+            return json.load(infile).get('key') == build_key
+    except (IOError, ValueError):
+        return False
+
+def record_build(target, build_key):
+    """Note that the extension module for `target` has been built with `build_key`."""
+    with open(_build_stamp_filename(target), 'w') as outfile:
+        json.dump({'key': build_key}, outfile)
 
-def tmpl2moremeaningfulpy(tmplname, filelike):
+def tmpl2moremeaningfulpy(tmplname, filelike, stats=None, compiler_settings=None):
     """Return the "more meaningful" AST generated from a template. Its name
-    will be tmplname.
+    will be tmplname. If a BuildStats is given, the phases are timed in it.
     """
-    pytext = tmpl2py.tmpl2py(filelike)
-    ast_ = ast.parse(pytext)
-    return py2moremeaningfulpy.py2moremeaningfulpy(tmplname, ast_)
+    if stats is None:
+        stats = BuildStats()
+    if compiler_settings is None:
+        compiler_settings = CompilerSettings()
+
+    if compiler_settings.direct_ast_frontend:
+        with stats.timed('tmpl2ast', tmplname):
+            ast_ = tmpl2py.tmpl2ast(filelike)
+        with stats.timed('py2moremeaningfulpy', tmplname):
+            # nothing else has the AST, so it needn't be copied
+            return py2moremeaningfulpy.py2moremeaningfulpy(tmplname, ast_, copy=False)
+    with stats.timed('tmpl2py', tmplname):
+        py_out = tmpl2py.tmpl2PyOut(filelike)
+        pytext = py_out.mainloop()
+    with stats.timed('ast_parse', tmplname):
+        ast_ = py_out.renumber(ast.parse(pytext))
+    with stats.timed('py2moremeaningfulpy', tmplname):
+        return py2moremeaningfulpy.py2moremeaningfulpy(tmplname, ast_)
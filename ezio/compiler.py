@@ -5,8 +5,12 @@ C extension modules.
 from __future__ import with_statement
 
 import _ast
+import ast
 import copy
+import hashlib
 import itertools
+import json
+import re
 import sys
 from contextlib import contextmanager
 
@@ -16,17 +20,62 @@ from ezio.constants import BUILTIN_MODULE_NAME, BUILTINS_WHITELIST, CURRENT_METH
 DISPLAY_NAME = "display"
 TRANSACTION_NAME = "transaction"
 LITERALS_ARRAY_NAME = "string_literals"
+LITERALS_BLOB_NAME = "packed_literals"
+LITERALS_SPECS_NAME = "packed_literal_specs"
 IMPORT_ARRAY_NAME = 'imported_names'
 EXPRESSIONS_ARRAY_NAME = 'expressions'
 EXPRESSIONS_EXCEPTION_HANDLER = 'HANDLE_EXCEPTIONS_EXPRESSIONS'
 MAIN_FUNCTION_NAME = "respond"
+# suffix for the hook that renders a whole sequence of displays:
+BATCH_HOOK_SUFFIX = "respond_many"
 TERMINAL_EXCEPTION_HANDLER = "REPORT_EXCEPTION_TO_PYTHON"
 # put all the template classes in this namespace,
 # so they don't conflict with C names from Python.h:
 CPP_NAMESPACE = "ezio_templates"
 BASE_TEMPLATE_NAME = 'ezio_base_template'
-
-RESERVED_WORDS = set([DISPLAY_NAME, TRANSACTION_NAME, LITERALS_ARRAY_NAME, IMPORT_ARRAY_NAME, MAIN_FUNCTION_NAME])
+# suffix for the function initializing the registries of a class, in a split build:
+CLASS_INIT_SUFFIX = 'init_registries'
+# suffix for the per-class pool of transaction lists used by the hooks:
+TRANSACTION_POOL_SUFFIX = 'transaction_pool'
+# suffix for the per-class moving estimate of output size used by the hooks:
+RENDER_HISTORY_SUFFIX = 'render_history'
+# module-level function exposing the render histories to Python:
+RENDER_HISTORY_FUNCTION_NAME = 'render_history'
+# suffix for the per-class render counters kept with CompilerSettings.render_stats:
+RENDER_STATS_SUFFIX = 'render_stats'
+# module-level functions exposing and clearing the render counters:
+RENDER_STATS_FUNCTION_NAME = 'stats'
+RESET_RENDER_STATS_FUNCTION_NAME = 'reset_stats'
+# suffix for the per-class counters of the profiled sites, with CompilerSettings.profile:
+PROFILE_SITES_SUFFIX = 'profile_sites'
+# module-level functions reporting and clearing them:
+PROFILE_FUNCTION_NAME = 'profile'
+RESET_PROFILE_FUNCTION_NAME = 'reset_profile'
+# the frame each native method is timed in, in a profiling build:
+METHOD_PROFILE_FRAME_NAME = 'ezio_method_frame'
+# suffix for the per-class counters of the lookup sites, with CompilerSettings.lookup_telemetry:
+LOOKUP_SITES_SUFFIX = 'lookup_sites'
+# module-level functions reporting and clearing them:
+LOOKUP_STATS_FUNCTION_NAME = 'lookup_stats'
+RESET_LOOKUP_STATS_FUNCTION_NAME = 'reset_lookup_stats'
+# the module's log of lookups defaulted with CompilerSettings.default_missing_lookups,
+# and the module-level function that drains it:
+MISSING_LOOKUPS_NAME = 'missing_lookup_log'
+DRAIN_MISSING_LOOKUPS_FUNCTION_NAME = 'drain_missing_lookups'
+# pointer to the contents of the shared runtime module, if a template module uses one:
+SHARED_RUNTIME_NAME = 'shared_runtime'
+# tables of (own index, shared runtime index) pairs:
+SHARED_LITERALS_TABLE_NAME = 'shared_literal_indices'
+SHARED_IMPORTS_TABLE_NAME = 'shared_import_indices'
+# attribute of the shared runtime module holding its capsule (as in Ezio.h):
+SHARED_RUNTIME_ATTRIBUTE = '_ezio_runtime'
+
+# stands in for a #line directive back to the generated file itself, whose line
+# numbers aren't known until the file is complete (see resolve_line_directives):
+END_OF_TEMPLATE_LINES = '#line __EZIO_END_OF_TEMPLATE_LINES__'
+
+RESERVED_WORDS = set([DISPLAY_NAME, TRANSACTION_NAME, LITERALS_ARRAY_NAME, IMPORT_ARRAY_NAME, MAIN_FUNCTION_NAME,
+    SHARED_RUNTIME_NAME])
 
 # AST node classes to the corresponding operator ID used by PyObject_RichCompare:
 CMPOP_TO_OPID = {
@@ -70,6 +119,12 @@ def assert_supported(condition, message=None):
         exception_args = (message,) if message is not None else ()
         raise EZIOUnsupportedException(*exception_args)
 
+def storage_class(exported):
+    """Storage class for generated module-level definitions; they're static unless
+    they have to be visible to the other translation units of a split build.
+    """
+    return '' if exported else 'static '
+
 class LineBufferMixin(object):
     """Mixin for classes that maintain a collection of indented lines.
     Use it like this:
@@ -124,21 +179,63 @@ class LineBufferMixin(object):
                 raise ValueError(line)
         return result
 
+def c_string_literal(value):
+    """Render a bytestring as a C string literal; anything other than printable ASCII
+    is octal-escaped (as is '?', to avoid trigraphs), so that embedded NULs survive.
+    """
+    pieces = []
+    for char in value:
+        if char in '\\"?' or not (' ' <= char <= '~'):
+            # always three digits, so that a following digit can't extend the escape:
+            pieces.append('\\%03o' % (ord(char),))
+        else:
+            pieces.append(char)
+    return '"%s"' % (''.join(pieces),)
+
+def resolve_line_directives(code, c_filename):
+    """Replace the END_OF_TEMPLATE_LINES markers in the code generated for
+    `c_filename` with #line directives back to the lines of that file.
+    """
+    if END_OF_TEMPLATE_LINES not in code:
+        return code
+    lines = code.split('\n')
+    for index, line in enumerate(lines):
+        if line == END_OF_TEMPLATE_LINES:
+            # the line after the directive is line index + 2, counting from 1:
+            lines[index] = '#line %d %s' % (index + 2, c_string_literal(c_filename))
+    return '\n'.join(lines)
+
+def add_shared_index_table(buf, table_name, index_pairs):
+    """Define a table of (own index, shared runtime index) pairs, for bind_shared_objects in Ezio.h."""
+    if not index_pairs:
+        return
+    buf.add_line("static const Py_ssize_t %s[][2] = {" % (table_name,))
+    with buf.increased_indent():
+        for own_index, shared_index in index_pairs:
+            buf.add_line("{%d, %d}," % (own_index, shared_index))
+    buf.add_line("};")
+
 class LiteralRegistry(LineBufferMixin):
     """Encapsulates the creation of Python string/int/bool objects for templating.
 
     Some use cases: string literals in the template, integers used as constant arguments.
+
+    String literals are packed into a single static byte array, with a table
+    of their offsets and lengths, and created in one loop at import time.
+
+    Given a SharedRuntime, literals it owns aren't created at all; the module
+    takes references to the runtime's objects instead.
     """
 
-    def __init__(self):
+    def __init__(self, shared_runtime=None):
         super(LiteralRegistry, self).__init__()
+        self.shared_runtime = shared_runtime
         self.literals = []
         self.literal_key_to_index = {}
 
         self.dispatch_map = {
             'int': self.generate_int,
             'float': self.generate_float,
-            'str': self.generate_str,
         }
 
     def _canonicalize_type(self, value):
@@ -168,17 +265,16 @@ class LiteralRegistry(LineBufferMixin):
             # just have it decode the base-10 representation
             return 'PyLong_FromString("%r", NULL, 10)' % (value,)
 
-    def generate_str(self, value):
-        # http://stackoverflow.com/questions/4000678/using-python-to-generate-a-c-string-literal-of-json
-        formatted_value = '"' + value.replace('\\', r'\\').replace('"', r'\"').replace("\n", r'\n') + '"'
+    def pack_str(self, value):
+        """Return the bytes to pack for a string literal, and its kind (see Ezio.h)."""
         # TODO: add a compiler setting to make all literals unicode --- otherwise unicode-only
         # filtering/escaping will have to convert the literals to unicode at join time
-        if isinstance(formatted_value, str):
-            return "PyString_FromString(%s)" % (formatted_value,)
-        elif isinstance(formatted_value, unicode):
-            return "PyUnicode_FromString(%s)" % (formatted_value.encode('utf-8'),)
+        if isinstance(value, str):
+            return value, 'PACKED_LITERAL_STR'
+        elif isinstance(value, unicode):
+            return value.encode('utf-8'), 'PACKED_LITERAL_UNICODE'
         else:
-            raise ValueError(type(formatted_value))
+            raise ValueError(type(value))
 
     def register(self, literal):
         """Intern `literal` and return its index in the intern table."""
@@ -197,13 +293,52 @@ class LiteralRegistry(LineBufferMixin):
         return "%s[%d]" % (LITERALS_ARRAY_NAME, index)
 
     def finalize(self):
+        # registries can outlive a single build (see ezio.watch), so start over every time:
+        self.lines = []
         self.add_line("static PyObject *%s[%d];" % (LITERALS_ARRAY_NAME, len(self.literals)))
+
+        # lay out the string literals end to end, one per line of C:
+        blob_lines, specs, shared_indices = [], [], []
+        offset = 0
+        for pos, literal in enumerate(self.literals):
+            shared_index = self.shared_runtime.literal_index(literal) if self.shared_runtime else None
+            if shared_index is not None:
+                shared_indices.append((pos, shared_index))
+                continue
+            if self._canonicalize_type(literal) != 'str':
+                continue
+            packed, kind = self.pack_str(literal)
+            blob_lines.append(c_string_literal(packed))
+            specs.append('{%d, %d, %d, %s},' % (pos, offset, len(packed), kind))
+            offset += len(packed)
+
+        self.add_line("static const char %s[] =" % (LITERALS_BLOB_NAME,))
+        with self.increased_indent():
+            for blob_line in blob_lines:
+                self.add_line(blob_line)
+            self.add_line('"";')
+        self.add_line("static const ezio_packed_literal %s[] = {" % (LITERALS_SPECS_NAME,))
+        with self.increased_indent():
+            for spec in specs:
+                self.add_line(spec)
+            # keep the array nonempty:
+            self.add_line('{0, 0, 0, PACKED_LITERAL_STR}')
+        self.add_line("};")
+        add_shared_index_table(self, SHARED_LITERALS_TABLE_NAME, shared_indices)
+
         self.add_line("static void init_string_literals(void) {")
         with self.increased_indent():
+            if shared_indices:
+                self.add_line("bind_shared_objects(%s, %s->literals, %s, %d);" %
+                    (LITERALS_ARRAY_NAME, SHARED_RUNTIME_NAME, SHARED_LITERALS_TABLE_NAME, len(shared_indices)))
+            self.add_line("if (!unpack_literals(%s, %s, %s, %d)) return;" %
+                (LITERALS_ARRAY_NAME, LITERALS_BLOB_NAME, LITERALS_SPECS_NAME, len(specs)))
+            shared_positions = set(pos for pos, _ in shared_indices)
             for pos, literal in enumerate(self.literals):
                 canonical_type = self._canonicalize_type(literal)
-                cexpr_for_literal = self.dispatch_map[canonical_type](literal)
-                self.add_line("%s[%d] = %s;" % (LITERALS_ARRAY_NAME, pos, cexpr_for_literal))
+                if canonical_type in self.dispatch_map and pos not in shared_positions:
+                    cexpr_for_literal = self.dispatch_map[canonical_type](literal)
+                    self.add_line("%s[%d] = %s;" % (LITERALS_ARRAY_NAME, pos, cexpr_for_literal))
         self.add_line("}")
 
 class ExpressionRegistry(LineBufferMixin):
@@ -231,8 +366,8 @@ class ExpressionRegistry(LineBufferMixin):
         self.lvalue_to_resolver[lvalue] = resolving_code
 
     def finalize(self):
-        self.add_line("static PyObject *%s[%d];" % \
-            (EXPRESSIONS_ARRAY_NAME, len(self.lvalue_to_resolver)))
+        self.lines = []
+        self.add_line("static PyObject *%s[%d];" % (EXPRESSIONS_ARRAY_NAME, len(self.lvalue_to_resolver)))
         self.add_line("static void init_expressions(void) {")
         with self.increased_indent():
             for resolver in self.lvalue_to_resolver.itervalues():
@@ -247,12 +382,19 @@ class ExpressionRegistry(LineBufferMixin):
         self.add_line("}")
 
 class ImportRegistry(LineBufferMixin):
-    """Encapsulates tracking of imported names, and the code to perform the imports."""
+    """Encapsulates tracking of imported names, and the code to perform the imports.
 
-    def __init__(self):
+    Given a SharedRuntime, import statements it has already executed aren't
+    executed again; the module takes references to the runtime's objects instead.
+    """
+
+    def __init__(self, shared_runtime=None):
         super(ImportRegistry, self).__init__()
-        # list of string of C-API code for executing the imports
-        self.imports = []
+        self.shared_runtime = shared_runtime
+        # list of (statement key, indices of the objects it imports, C-API code executing it);
+        # the key identifies the objects, regardless of the names they're bound to:
+        self.statements = []
+        self.statement_key_to_indices = {}
         self.symbols_to_index = {}
         self.num_objects = 0
 
@@ -269,13 +411,18 @@ class ImportRegistry(LineBufferMixin):
         self.num_objects += 1
         return index, self._get_array_accessor(index)
 
+    def _add_statement(self, key, indices, import_lines):
+        self.statements.append((key, indices, import_lines))
+        self.statement_key_to_indices.setdefault(key, indices)
+
     def register_import(self, module, asname=None):
         """Register a normal import statement, e.g., `import a.b.c`, `import a.b.c. as d`."""
         index, accessor = self.make_space()
+        import_lines = []
         if not asname:
-            self.imports.append('%s = PyImport_ImportModuleEx("%s", NULL, NULL, NULL);'
+            import_lines.append('%s = PyImport_ImportModuleEx("%s", NULL, NULL, NULL);'
                     % (accessor, module))
-            self.imports.append('if (!%s) return;' % (accessor,))
+            import_lines.append('if (!%s) return;' % (accessor,))
             # bind the first element of the path
             # TODO we could "cheat" and bind every subpath
             resolvable_path = module.split('.')[0]
@@ -283,14 +430,17 @@ class ImportRegistry(LineBufferMixin):
         else:
             # take a shortcut and just jump to the end of the path
             # (this corresponds to the trick of __import__(module); sys.modules[module] )
-            self.imports.append('%s = PyImport_ImportModule("%s");' % (accessor, module))
-            self.imports.append('if (!%s) return;' % (accessor,))
+            import_lines.append('%s = PyImport_ImportModule("%s");' % (accessor, module))
+            import_lines.append('if (!%s) return;' % (accessor,))
             # bind the as-name:
             self.symbols_to_index[(asname,)] = index
+        # `import a.b` gets the top-level package, `import a.b as c` gets the module itself:
+        self._add_statement(('import', module, bool(asname)), [index], import_lines)
 
     def register_fromimport(self, module, fromlist, aslist):
         """Register a from-import statement, e.g., `from a.b import c, d as e`."""
-        _index, accessor = self.make_space()
+        index, accessor = self.make_space()
+        import_lines = []
 
         if module == BUILTIN_MODULE_NAME:
             # avoid creating a huge ugly unneeded tuple
@@ -298,17 +448,34 @@ class ImportRegistry(LineBufferMixin):
         else:
             packed_fromlist = ', '.join(['PyString_FromString("%s")' % (item,) for item in fromlist])
             tupled_fromlist = 'PyTuple_Pack(%d, %s)' % (len(fromlist), packed_fromlist)
-        self.imports.append('%s = PyImport_ImportModuleEx("%s", NULL, NULL, %s);' %
+        import_lines.append('%s = PyImport_ImportModuleEx("%s", NULL, NULL, %s);' %
                 (accessor, module, tupled_fromlist))
 
+        indices = [index]
         if aslist is None:
             aslist = [None] * len(fromlist)
         for fromname, asname in zip(fromlist, aslist):
             from_index, from_accessor = self.make_space()
-            self.imports.append('%s = PyObject_GetAttr(%s, PyString_FromString("%s"));' %
+            import_lines.append('%s = PyObject_GetAttr(%s, PyString_FromString("%s"));' %
                     (from_accessor, accessor, fromname))
-            self.imports.append('if (!%s) return;' % (from_accessor,))
+            import_lines.append('if (!%s) return;' % (from_accessor,))
             self.symbols_to_index[(asname or fromname,)] = from_index
+            indices.append(from_index)
+        self._add_statement(('from', module, tuple(fromlist)), indices, import_lines)
+
+    def register_statement(self, key):
+        """Register the import statement identified by `key` (as in self.statements),
+        unless it's already registered; binds no names.
+        """
+        if key in self.statement_key_to_indices:
+            return
+        symbols_to_index = dict(self.symbols_to_index)
+        kind, module, names = key
+        if kind == 'import':
+            self.register_import(module, asname=module if names else None)
+        else:
+            self.register_fromimport(module, list(names), aslist=None)
+        self.symbols_to_index = symbols_to_index
 
     def resolve_import_path(self, path):
         """Produces the C-language expression corresponding to an import path, or None."""
@@ -318,13 +485,26 @@ class ImportRegistry(LineBufferMixin):
         return self._get_array_accessor(index)
 
     def finalize(self):
+        self.lines = []
         # TODO: import failures are hidden and silent
         if self.num_objects:
             self.lines.append('static PyObject *%s[%d];' % (IMPORT_ARRAY_NAME, self.num_objects))
 
-        self.lines.append('static void init_imports(void) {')
+        import_lines, shared_indices = [], []
+        for key, indices, statement_lines in self.statements:
+            shared = self.shared_runtime.import_indices(key) if self.shared_runtime else None
+            if shared is not None:
+                shared_indices.extend(zip(indices, shared))
+            else:
+                import_lines.extend(statement_lines)
+        add_shared_index_table(self, SHARED_IMPORTS_TABLE_NAME, shared_indices)
+
+        self.add_line('static void init_imports(void) {')
         with self.increased_indent():
-            for import_line in self.imports:
+            if shared_indices:
+                self.add_line('bind_shared_objects(%s, %s->imports, %s, %d);' %
+                    (IMPORT_ARRAY_NAME, SHARED_RUNTIME_NAME, SHARED_IMPORTS_TABLE_NAME, len(shared_indices)))
+            for import_line in import_lines:
                 self.add_line(import_line)
         self.add_line('}')
 
@@ -352,6 +532,7 @@ class PathRegistry(LineBufferMixin):
         return self.subpath_to_fname[subpath]
 
     def finalize(self):
+        self.lines = []
         for subpath, fname in self.subpath_to_fname.iteritems():
             # generate a function that follows 'subpath' on 'base'
             # and returns a new reference to whatever it finds (or NULL)
@@ -398,6 +579,60 @@ class PathRegistry(LineBufferMixin):
             self.indent -= 1
             self.add_line("}")
 
+class SharedRuntime(object):
+    """Describes a shared runtime module, which creates literals and performs imports
+    once, on behalf of many separately compiled template modules. Template modules
+    compiled against it get its objects through a capsule (see ezio_shared_runtime
+    in Ezio.h), by their indices in its registries.
+    """
+
+    def __init__(self, module_name, literals=(), import_statements=()):
+        """
+        Args:
+            module_name - dotted name the runtime module will be imported under
+            literals - the literals it owns
+            import_statements - keys of the import statements it executes (see ImportRegistry)
+        """
+        self.module_name = module_name
+        self.literal_registry = LiteralRegistry()
+        for literal in literals:
+            self.literal_registry.register(literal)
+        self.import_registry = ImportRegistry()
+        for statement_key in import_statements:
+            self.import_registry.register_statement(statement_key)
+
+        # identifies the contents, which the template modules index into:
+        contents = (self.module_name, self.literal_registry.literals,
+            [key for key, _, _ in self.import_registry.statements])
+        self.key = hashlib.sha1(repr(contents)).hexdigest()
+
+    @property
+    def capsule_name(self):
+        return '%s.%s' % (self.module_name, SHARED_RUNTIME_ATTRIBUTE)
+
+    def literal_index(self, literal):
+        """Index of `literal` among the runtime's literals, or None."""
+        return self.literal_registry.literal_key_to_index.get(self.literal_registry._value_to_key(literal))
+
+    def import_indices(self, statement_key):
+        """Indices of the objects imported by a statement among the runtime's imports, or None."""
+        return self.import_registry.statement_key_to_indices.get(statement_key)
+
+    def dump(self, outfile):
+        json.dump({
+            'module_name': self.module_name,
+            'literals': [repr(literal) for literal in self.literal_registry.literals],
+            'imports': [key for key, _, _ in self.import_registry.statements],
+        }, outfile)
+
+    @classmethod
+    def load(cls, infile):
+        description = json.load(infile)
+        import_statements = [(str(kind), str(module), names if isinstance(names, bool) else tuple(map(str, names)))
+            for kind, module, names in description['imports']]
+        return cls(str(description['module_name']), [ast.literal_eval(literal) for literal in description['literals']],
+            import_statements)
+
 def extract_params_with_defaults(args):
     num_required_args = len(args.args) - len(args.defaults)
     return args.args[num_required_args:]
@@ -477,10 +712,15 @@ class ClassDefinition(LineBufferMixin):
             superclass_constructor_call,))
         # no destructor, this thing doesn't own any dynamically allocated memory
         # (really it only exists because we need its vtable)
+        self.num_header_lines = len(self.lines)
 
         self.methods = {}
 
     def finalize(self):
+        # a subclass compiled since the last call may have made some methods virtual,
+        # so regenerate the method declarations every time:
+        del self.lines[self.num_header_lines:]
+        self.indent = self.initial_indent + 1
         for method in self.methods.itervalues():
             method_definition = 'virtual PyObject *' if method['virtual'] else 'PyObject *'
             method_definition += method['name']
@@ -491,6 +731,61 @@ class ClassDefinition(LineBufferMixin):
         self.add_line('};')
 
 
+class ClassSummary(object):
+    """What a split build needs to know about a class compiled in an earlier
+    build, short of its code: its definition, and the sites it counts. Stands
+    in for the class's CodeGenerator in generate_split_c_files, which then
+    leaves the class's own C file as it is.
+    """
+
+    def __init__(self, class_definition, compiler_settings, profile_sites=(), lookup_sites=()):
+        self.class_definition = class_definition
+        self.compiler_settings = compiler_settings
+        self.profile_sites = list(profile_sites)
+        self.lookup_sites = list(lookup_sites)
+
+    @staticmethod
+    def describe(compiled_class):
+        """Describe a compiled class (a CodeGenerator or a ClassSummary)
+        as a JSON-serializable dict.
+        """
+        return {
+            'class_name': compiled_class.class_definition.class_name,
+            'methods': [(method['name'], method['params'], sorted(method['defaults']))
+                for method in compiled_class.class_definition.methods.itervalues()],
+            'profile_sites': compiled_class.profile_sites,
+            'lookup_sites': compiled_class.lookup_sites,
+        }
+
+    @classmethod
+    def from_description(cls, description, superclass_def, compiler_settings):
+        """Rebuild the summary from the output of describe, as read back
+        from JSON, given the definition of the superclass, if any.
+        """
+        class_definition = ClassDefinition(str(description['class_name']), superclass_def)
+        for name, params, defaults in description['methods']:
+            # this marks the methods of the superclasses it overrides virtual again:
+            class_definition.add_method(str(name), map(str, params), frozenset(map(str, defaults)))
+        sites = [[(str(kind), str(name), lineno) for kind, name, lineno in description[key]]
+            for key in ('profile_sites', 'lookup_sites')]
+        if compiler_settings is None:
+            compiler_settings = CompilerSettings()
+        return cls(class_definition, compiler_settings, *sites)
+
+
+def describe_expression(node):
+    """Name an expression for the profile and lookup reports: its dotted path, if it is one."""
+    if isinstance(node, _ast.Name):
+        return node.id
+    elif isinstance(node, _ast.Attribute):
+        return '%s.%s' % (describe_expression(node.value), node.attr)
+    elif isinstance(node, _ast.Call):
+        return '%s()' % (describe_expression(node.func),)
+    elif isinstance(node, _ast.Subscript):
+        return '%s[]' % (describe_expression(node.value),)
+    return '<%s>' % (type(node).__name__,)
+
+
 def generate_initial_segment():
     buf = LineBufferMixin()
     buf.add_line('#include "Python.h"')
@@ -499,10 +794,164 @@ def generate_initial_segment():
     return buf
 
 
-def generate_final_segment(module_name, function_names):
+def generate_render_history_function(class_names):
+    """Generate the module-level function that returns the render histories
+    of all the classes in the module, as a dict of class name to a dict of estimates.
+    """
+    buf = LineBufferMixin()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (RENDER_HISTORY_FUNCTION_NAME,))
+    with buf.increased_indent():
+        buf.add_line('PyObject *histories = PyDict_New();')
+        buf.add_line('if (!histories) { return NULL; }')
+        for class_name in class_names:
+            buf.add_line('if (!export_render_history(histories, "%s", &%s::%s_%s)) { Py_DECREF(histories); return NULL; }' %
+                (class_name, CPP_NAMESPACE, class_name, RENDER_HISTORY_SUFFIX))
+        buf.add_line('return histories;')
+    buf.add_line('}')
+    buf.add_line()
+    return buf
+
+
+def generate_render_stats_functions(class_names):
+    """Generate the module-level functions that return the render counters of
+    the given classes, as a dict of class name to a dict of counters, and that
+    zero them. Only classes compiled with CompilerSettings.render_stats have any.
+    """
+    buf = LineBufferMixin()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (RENDER_STATS_FUNCTION_NAME,))
+    with buf.increased_indent():
+        buf.add_line('PyObject *all_stats = PyDict_New();')
+        buf.add_line('if (!all_stats) { return NULL; }')
+        for class_name in class_names:
+            buf.add_line('if (!export_render_stats(all_stats, "%s", &%s::%s_%s)) { Py_DECREF(all_stats); return NULL; }' %
+                (class_name, CPP_NAMESPACE, class_name, RENDER_STATS_SUFFIX))
+        buf.add_line('return all_stats;')
+    buf.add_line('}')
+    buf.add_line()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (RESET_RENDER_STATS_FUNCTION_NAME,))
+    with buf.increased_indent():
+        for class_name in class_names:
+            buf.add_line('reset_render_stats(&%s::%s_%s);' % (CPP_NAMESPACE, class_name, RENDER_STATS_SUFFIX))
+        buf.add_line('Py_RETURN_NONE;')
+    buf.add_line('}')
+    buf.add_line()
+    return buf
+
+
+def declare_site_counters(compiled_class, exported=False, extern=False):
+    """Declarations of the arrays of counters of the sites `compiled_class`
+    profiles and counts lookups at, if any.
+    """
+    storage = 'extern ' if extern else storage_class(exported)
+    class_name = compiled_class.class_definition.class_name
+    declarations = []
+    for type_name, suffix, sites in [('ezio_profile_site', PROFILE_SITES_SUFFIX, compiled_class.profile_sites),
+            ('ezio_lookup_site', LOOKUP_SITES_SUFFIX, compiled_class.lookup_sites)]:
+        if sites:
+            declarations.append('%s%s %s_%s[%d];' % (storage, type_name, class_name, suffix, len(sites)))
+    return declarations
+
+def generate_site_counters(compiled_class, exported=False):
+    """Generate the definitions of the arrays of counters of the sites
+    `compiled_class` profiles and counts lookups at, if any.
+    """
+    buf = LineBufferMixin()
+    for declaration in declare_site_counters(compiled_class, exported):
+        buf.add_line(declaration)
+    return buf
+
+
+def generate_profile_functions(compiled_classes):
+    """Generate the module-level functions that report the counters of the sites
+    the classes profile, as a list of dicts sorted by descending self time, and
+    that zero them. Only classes compiled with CompilerSettings.profile have any.
+    """
+    buf = LineBufferMixin()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (PROFILE_FUNCTION_NAME,))
+    with buf.increased_indent():
+        buf.add_line('PyObject *report = PyList_New(0);')
+        buf.add_line('if (!report) { return NULL; }')
+        for compiled_class in compiled_classes:
+            class_name = compiled_class.class_definition.class_name
+            for index, (kind, name, lineno) in enumerate(compiled_class.profile_sites):
+                buf.add_line('if (!export_profile_site(report, "%s", "%s", %s, %d, &%s::%s_%s[%d])) { Py_DECREF(report); return NULL; }' %
+                    (class_name, kind, c_string_literal(name), lineno, CPP_NAMESPACE, class_name, PROFILE_SITES_SUFFIX, index))
+        buf.add_line('if (!sort_profile_report(report)) { Py_DECREF(report); return NULL; }')
+        buf.add_line('return report;')
+    buf.add_line('}')
+    buf.add_line()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (RESET_PROFILE_FUNCTION_NAME,))
+    with buf.increased_indent():
+        for compiled_class in compiled_classes:
+            if compiled_class.profile_sites:
+                buf.add_line('memset(%s::%s_%s, 0, sizeof(%s::%s_%s));' % ((CPP_NAMESPACE,
+                    compiled_class.class_definition.class_name, PROFILE_SITES_SUFFIX) * 2))
+        buf.add_line('Py_RETURN_NONE;')
+    buf.add_line('}')
+    buf.add_line()
+    return buf
+
+
+def generate_lookup_stats_functions(compiled_classes):
+    """Generate the module-level functions that report the counters of the lookup
+    sites of the classes, as a list of dicts in template order, and that zero them.
+    Only classes compiled with CompilerSettings.lookup_telemetry have any.
+    """
+    buf = LineBufferMixin()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (LOOKUP_STATS_FUNCTION_NAME,))
+    with buf.increased_indent():
+        buf.add_line('PyObject *report = PyList_New(0);')
+        buf.add_line('if (!report) { return NULL; }')
+        for compiled_class in compiled_classes:
+            class_name = compiled_class.class_definition.class_name
+            for index, (kind, name, lineno) in enumerate(compiled_class.lookup_sites):
+                buf.add_line('if (!export_lookup_site(report, "%s", "%s", %s, %d, &%s::%s_%s[%d])) { Py_DECREF(report); return NULL; }' %
+                    (class_name, kind, c_string_literal(name), lineno, CPP_NAMESPACE, class_name, LOOKUP_SITES_SUFFIX, index))
+        buf.add_line('return report;')
+    buf.add_line('}')
+    buf.add_line()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (RESET_LOOKUP_STATS_FUNCTION_NAME,))
+    with buf.increased_indent():
+        counted_classes = [compiled_class for compiled_class in compiled_classes if compiled_class.lookup_sites]
+        if counted_classes:
+            buf.add_line('Py_ssize_t i;')
+        for compiled_class in counted_classes:
+            buf.add_line('for (i = 0; i < %d; i++) { reset_lookup_site(&%s::%s_%s[i]); }' % (len(compiled_class.lookup_sites),
+                CPP_NAMESPACE, compiled_class.class_definition.class_name, LOOKUP_SITES_SUFFIX))
+        buf.add_line('Py_RETURN_NONE;')
+    buf.add_line('}')
+    buf.add_line()
+    return buf
+
+
+def generate_drain_missing_lookups_function(compiled_classes):
+    """Generate the module-level function that drains the log of missing lookups,
+    returning (list of (template, line, name), number lost to overflow). Only
+    classes compiled with CompilerSettings.default_missing_lookups log any.
+    """
+    buf = LineBufferMixin()
+    buf.add_line('static PyObject *%s(PyObject *self, PyObject *unused) {' % (DRAIN_MISSING_LOOKUPS_FUNCTION_NAME,))
+    with buf.increased_indent():
+        if logs_missing_lookups(compiled_classes):
+            buf.add_line('return drain_missing_lookup_log(&%s);' % (MISSING_LOOKUPS_NAME,))
+        else:
+            buf.add_line('return Py_BuildValue("(Ni)", PyList_New(0), 0);')
+    buf.add_line('}')
+    buf.add_line()
+    return buf
+
+
+def logs_missing_lookups(compiled_classes):
+    return any(compiled_class.compiler_settings.default_missing_lookups for compiled_class in compiled_classes)
+
+
+def generate_final_segment(module_name, function_names, shared_runtime=None, init_function_names=None):
     """Generate the final segment of the C++ file, which contains
-    the module initialization code.
+    the module initialization code. It calls `init_function_names`, which
+    default to the init functions of the registries of a single-file module.
     """
+    if init_function_names is None:
+        init_function_names = ['init_string_literals', 'init_imports', 'init_expressions']
     buf = LineBufferMixin()
 
     buf.add_line("static PyMethodDef k_module_methods[] = {")
@@ -510,6 +959,22 @@ def generate_final_segment(module_name, function_names):
     for function_name in function_names:
         buf.add_line('{"%s", (PyCFunction)%s::%s, METH_VARARGS, "Perform templating for %s"},' %
             (function_name, CPP_NAMESPACE, function_name, function_name))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Get the output size estimates for each template class"},' %
+        (RENDER_HISTORY_FUNCTION_NAME, RENDER_HISTORY_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Get the render counters for each template class"},' %
+        (RENDER_STATS_FUNCTION_NAME, RENDER_STATS_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Zero the render counters of every template class"},' %
+        (RESET_RENDER_STATS_FUNCTION_NAME, RESET_RENDER_STATS_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Get the time spent in each profiled method and call, slowest first"},' %
+        (PROFILE_FUNCTION_NAME, PROFILE_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Zero the counters of every profiled method and call"},' %
+        (RESET_PROFILE_FUNCTION_NAME, RESET_PROFILE_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Get the counts of dict hits, getattr fallbacks, and misses at each lookup site"},' %
+        (LOOKUP_STATS_FUNCTION_NAME, LOOKUP_STATS_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Zero the counters of every lookup site"},' %
+        (RESET_LOOKUP_STATS_FUNCTION_NAME, RESET_LOOKUP_STATS_FUNCTION_NAME))
+    buf.add_line('{"%s", (PyCFunction)%s, METH_NOARGS, "Get and forget the names and paths looked up and defaulted since the last call"},' %
+        (DRAIN_MISSING_LOOKUPS_FUNCTION_NAME, DRAIN_MISSING_LOOKUPS_FUNCTION_NAME))
     buf.add_line("{NULL, NULL, 0, NULL}")
     buf.indent -= 1
     buf.add_line("};")
@@ -519,9 +984,12 @@ def generate_final_segment(module_name, function_names):
     buf.add_line("PyMODINIT_FUNC init%s(void) {" % module_name)
     buf.indent += 1
     buf.add_line('Py_InitModule("%s", k_module_methods);' % module_name)
-    buf.add_line('init_string_literals();')
-    buf.add_line('init_imports();')
-    buf.add_line('init_expressions();')
+    if shared_runtime is not None:
+        # the registries take references to its objects:
+        buf.add_line('if (!(%s = import_shared_runtime("%s", "%s", "%s"))) return;' %
+            (SHARED_RUNTIME_NAME, shared_runtime.module_name, shared_runtime.capsule_name, shared_runtime.key))
+    for init_function_name in init_function_names:
+        buf.add_line('%s();' % (init_function_name,))
     buf.indent -= 1
     buf.add_line('}')
     buf.add_line('')
@@ -529,7 +997,7 @@ def generate_final_segment(module_name, function_names):
     return buf
 
 
-def generate_hook(function_name, class_name, public=True):
+def generate_hook(function_name, class_name, public=True, exported=False, render_stats=False):
     """Generate the static "hook" function that unpacks the Python arguments,
     dispatches to the C++ code, then returns the result to Python.
 
@@ -537,9 +1005,24 @@ def generate_hook(function_name, class_name, public=True):
         public - if False, generate the "old-style" hook that takes in a
                  transaction list as second argument, then defers string join
                  to the caller
+        exported - if True, give the hook and the render history external linkage,
+                 so that the module's method table can live in another translation unit
+        render_stats - if True, time each render and count it in the class's
+                 render counters (only public hooks know the length of their output)
     """
     buf = LineBufferMixin()
-    buf.add_line('static PyObject *%s(PyObject *self, PyObject *args) {' % (function_name,))
+    pool_name = '%s_%s' % (class_name, TRANSACTION_POOL_SUFFIX)
+    history_name = '%s_%s' % (class_name, RENDER_HISTORY_SUFFIX)
+    stats_name = '%s_%s' % (class_name, RENDER_STATS_SUFFIX)
+    render_stats = render_stats and public
+    if public:
+        # transaction lists are recycled across calls to the hook:
+        buf.add_line('static ezio_transaction_pool %s;' % (pool_name,))
+    # the render history is exported to Python even for private hooks, so always declare it:
+    buf.add_line('%sezio_render_history %s;' % (storage_class(exported), history_name))
+    if render_stats:
+        buf.add_line('%sezio_render_stats %s;' % (storage_class(exported), stats_name))
+    buf.add_line('%sPyObject *%s(PyObject *self, PyObject *args) {' % (storage_class(exported), function_name))
     buf.indent += 1
 
     buf.add_line('PyObject *display, *transaction, *self_ptr;')
@@ -550,17 +1033,27 @@ def generate_hook(function_name, class_name, public=True):
         unpack = '"OOO", &display, &transaction, &self_ptr'
     buf.add_line('if (!PyArg_ParseTuple(args, %s)) { return NULL; }' % (unpack,))
     if public:
-        # create a new list for the transaction
-        buf.add_line('if (!(transaction = PyList_New(0))) { return NULL; }')
+        # get an empty list for the transaction
+        buf.add_line('if (!(transaction = acquire_transaction(&%s))) { return NULL; }' % (pool_name,))
 
     buf.add_line('if (self_ptr == Py_None) { self_ptr = NULL; }')
     buf.add_line('%s::%s template_obj(display, transaction, self_ptr);' % (CPP_NAMESPACE, class_name,))
+    if render_stats:
+        buf.add_line('unsigned long long start_ns = ezio_monotonic_ns();')
     buf.add_line('PyObject *status = template_obj.%s();' % (MAIN_FUNCTION_NAME,))
     buf.add_line('if (status) {')
     with buf.increased_indent():
         if public:
-            buf.add_line('PyObject *result = ezio_concatenate(transaction);')
-            buf.add_line('Py_DECREF(transaction);')
+            buf.add_line('PyObject *result = ezio_concatenate_presized(transaction, 0, estimate_output_length(&%s));' %
+                (history_name,))
+            buf.add_line('if (result) {')
+            with buf.increased_indent():
+                buf.add_line('Py_ssize_t length = PyString_Check(result) ? PyString_GET_SIZE(result) : PyUnicode_GET_SIZE(result);')
+                buf.add_line('update_render_history(&%s, PyList_GET_SIZE(transaction), length);' % (history_name,))
+                if render_stats:
+                    buf.add_line('record_render(&%s, start_ns, PyList_GET_SIZE(transaction), length);' % (stats_name,))
+            buf.add_line('}')
+            buf.add_line('release_transaction(&%s, transaction);' % (pool_name,))
             # this wil propagate exceptions during concatenation:
             buf.add_line('return result;')
         else:
@@ -569,7 +1062,7 @@ def generate_hook(function_name, class_name, public=True):
     buf.add_line('}')
     # exit path for when templating encountered an exception
     if public:
-        buf.add_line('Py_DECREF(transaction);')
+        buf.add_line('release_transaction(&%s, transaction);' % (pool_name,))
     buf.add_line('return NULL;')
 
     buf.indent -= 1
@@ -578,17 +1071,114 @@ def generate_hook(function_name, class_name, public=True):
     return buf
 
 
-def generate_c_file(module_name, literal_registry, path_registry, import_registry, expression_registry, compiled_classes):
+def generate_batch_hook(function_name, class_name, exported=False, render_stats=False):
+    """Generate the static hook that renders a sequence of displays in one call,
+    reusing a single template object and transaction list for all of them.
+
+    From Python, this looks like:
+        respond_many(displays, self_ptr) -> list of outputs
+        respond_many(displays, self_ptr, outfile) -> None, each output is passed to outfile.write()
+
+    Must be preceded by the output of generate_hook for the same class,
+    whose transaction pool, render history, and render counters (with
+    `render_stats`, which counts each display as a render) this shares.
+    """
+    pool_name = '%s_%s' % (class_name, TRANSACTION_POOL_SUFFIX)
+    history_name = '%s_%s' % (class_name, RENDER_HISTORY_SUFFIX)
+    stats_name = '%s_%s' % (class_name, RENDER_STATS_SUFFIX)
+
+    buf = LineBufferMixin()
+    buf.add_line('%sPyObject *%s(PyObject *self, PyObject *args) {' % (storage_class(exported), function_name))
+    with buf.increased_indent():
+        buf.add_line('PyObject *displays, *self_ptr, *outfile = NULL;')
+        buf.add_line('if (!PyArg_ParseTuple(args, "OO|O", &displays, &self_ptr, &outfile)) { return NULL; }')
+        buf.add_line('if (self_ptr == Py_None) { self_ptr = NULL; }')
+        buf.add_line('if (outfile == Py_None) { outfile = NULL; }')
+        buf.add_line()
+        buf.add_line('PyObject *display_tuple = NULL, *results = NULL, *write_method = NULL, *transaction = NULL;')
+        buf.add_line('int failed = 0;')
+        # a snapshot of the displays (for a list, PySequence_Fast would return the list itself),
+        # so that code run by a render or by write() can't change them out from under the loop:
+        buf.add_line('if (!(display_tuple = PySequence_Tuple(displays))) { goto CLEANUP; }')
+        buf.add_line('if (outfile) {')
+        with buf.increased_indent():
+            buf.add_line('if (!(write_method = PyObject_GetAttrString(outfile, "write"))) { goto CLEANUP; }')
+        buf.add_line('} else {')
+        with buf.increased_indent():
+            buf.add_line('if (!(results = PyList_New(PyTuple_GET_SIZE(display_tuple)))) { goto CLEANUP; }')
+        buf.add_line('}')
+        buf.add_line('if (!(transaction = acquire_transaction(&%s))) { goto CLEANUP; }' % (pool_name,))
+        buf.add_line()
+        # block-scope the template object, so the gotos above don't jump over its initialization:
+        buf.add_line('{')
+        with buf.increased_indent():
+            buf.add_line('%s::%s template_obj(NULL, transaction, self_ptr);' % (CPP_NAMESPACE, class_name,))
+            buf.add_line('Py_ssize_t num_displays = PyTuple_GET_SIZE(display_tuple);')
+            buf.add_line('Py_ssize_t i;')
+            buf.add_line('for (i = 0; i < num_displays; i++) {')
+            with buf.increased_indent():
+                buf.add_line('template_obj.display = PyTuple_GET_ITEM(display_tuple, i);')
+                if render_stats:
+                    buf.add_line('unsigned long long start_ns = ezio_monotonic_ns();')
+                buf.add_line('if (!template_obj.%s()) { failed = 1; break; }' % (MAIN_FUNCTION_NAME,))
+                buf.add_line('PyObject *result = ezio_concatenate_presized(transaction, 0, estimate_output_length(&%s));' %
+                    (history_name,))
+                buf.add_line('if (!result) { failed = 1; break; }')
+                buf.add_line('Py_ssize_t length = PyString_Check(result) ? PyString_GET_SIZE(result) : PyUnicode_GET_SIZE(result);')
+                buf.add_line('update_render_history(&%s, PyList_GET_SIZE(transaction), length);' % (history_name,))
+                if render_stats:
+                    buf.add_line('record_render(&%s, start_ns, PyList_GET_SIZE(transaction), length);' % (stats_name,))
+                # empty the transaction for the next display, keeping its capacity:
+                buf.add_line('truncate_transaction(transaction, 0);')
+                buf.add_line('if (write_method) {')
+                with buf.increased_indent():
+                    buf.add_line('PyObject *write_status = PyObject_CallFunctionObjArgs(write_method, result, NULL);')
+                    buf.add_line('Py_DECREF(result);')
+                    buf.add_line('if (!write_status) { failed = 1; break; }')
+                    buf.add_line('Py_DECREF(write_status);')
+                buf.add_line('} else {')
+                with buf.increased_indent():
+                    # steals the reference to the result:
+                    buf.add_line('PyList_SET_ITEM(results, i, result);')
+                buf.add_line('}')
+            buf.add_line('}')
+        buf.add_line('}')
+        buf.add_line('release_transaction(&%s, transaction);' % (pool_name,))
+        buf.add_line()
+        buf.add_line('CLEANUP:')
+        buf.add_line('Py_XDECREF(display_tuple);')
+        # failures before the transaction was acquired jump here without setting `failed`:
+        buf.add_line('if (failed || !transaction) {')
+        with buf.increased_indent():
+            buf.add_line('Py_XDECREF(write_method);')
+            buf.add_line('Py_XDECREF(results);')
+            buf.add_line('return NULL;')
+        buf.add_line('}')
+        buf.add_line('if (write_method) { Py_DECREF(write_method); Py_RETURN_NONE; }')
+        buf.add_line('return results;')
+    buf.add_line('}')
+
+    return buf
+
+
+def generate_c_file(module_name, literal_registry, path_registry, import_registry, expression_registry, compiled_classes,
+        shared_runtime=None):
     """Generate a complete C++ source file; string literals, path lookup functions,
     imports, all code for all classes, hooks, final segment.
+
+    If the registries were created with a SharedRuntime, pass it as `shared_runtime`.
     """
     cpp_file = LineBufferMixin()
     cpp_file.add_fixup(generate_initial_segment())
+    if shared_runtime is not None:
+        cpp_file.add_line('static ezio_shared_runtime *%s;' % (SHARED_RUNTIME_NAME,))
     cpp_file.add_fixup(literal_registry)
     if path_registry is not None:
         cpp_file.add_fixup(path_registry)
     cpp_file.add_fixup(import_registry)
     cpp_file.add_fixup(expression_registry)
+    if logs_missing_lookups(compiled_classes):
+        cpp_file.add_line('static ezio_missing_lookups %s;' % (MISSING_LOOKUPS_NAME,))
 
     # concatenate all class definitions and their method definitions,
     # enclosing them in a C++ namespace:
@@ -598,18 +1188,209 @@ def generate_c_file(module_name, literal_registry, path_registry, import_registr
         # add the class definition:
         cpp_file.add_fixup(compiled_class.class_definition)
         # and the code for the defined methods:
+        cpp_file.add_fixup(generate_site_counters(compiled_class))
         cpp_file.add_fixup(compiled_class)
 
         class_name = compiled_class.class_definition.class_name
+        render_stats = compiled_class.compiler_settings.render_stats
         hook_name = "%s_%s" % (class_name, MAIN_FUNCTION_NAME)
-        cpp_file.add_fixup(generate_hook(hook_name, class_name, public=True))
+        cpp_file.add_fixup(generate_hook(hook_name, class_name, public=True, render_stats=render_stats))
         hook_names.append(hook_name)
+        batch_hook_name = "%s_%s" % (class_name, BATCH_HOOK_SUFFIX)
+        cpp_file.add_fixup(generate_batch_hook(batch_hook_name, class_name, render_stats=render_stats))
+        hook_names.append(batch_hook_name)
     cpp_file.add_line("}")
 
-    cpp_file.add_fixup(generate_final_segment(module_name, hook_names))
+    class_names = [compiled_class.class_definition.class_name for compiled_class in compiled_classes]
+    cpp_file.add_fixup(generate_render_history_function(class_names))
+    cpp_file.add_fixup(generate_render_stats_functions([compiled_class.class_definition.class_name
+        for compiled_class in compiled_classes if compiled_class.compiler_settings.render_stats]))
+    cpp_file.add_fixup(generate_profile_functions(compiled_classes))
+    cpp_file.add_fixup(generate_lookup_stats_functions(compiled_classes))
+    cpp_file.add_fixup(generate_drain_missing_lookups_function(compiled_classes))
+    cpp_file.add_fixup(generate_final_segment(module_name, hook_names, shared_runtime))
+
+    return '\n'.join(cpp_file.get_lines())
+
+def generate_shared_runtime_c_file(shared_runtime):
+    """Generate the C++ source file for a shared runtime module, which creates
+    its literals, performs its imports, and exports them in a capsule.
+    """
+    _, _, module_name = shared_runtime.module_name.rpartition('.')
+
+    cpp_file = LineBufferMixin()
+    cpp_file.add_fixup(generate_initial_segment())
+    cpp_file.add_fixup(shared_runtime.literal_registry)
+    cpp_file.add_fixup(shared_runtime.import_registry)
+    cpp_file.add_line('static ezio_shared_runtime %s = {"%s", %s, %s};' %
+        (SHARED_RUNTIME_NAME, shared_runtime.key, LITERALS_ARRAY_NAME, IMPORT_ARRAY_NAME))
+    cpp_file.add_line()
+    cpp_file.add_line("static PyMethodDef k_module_methods[] = {{NULL, NULL, 0, NULL}};")
+    cpp_file.add_line()
+
+    cpp_file.add_line("PyMODINIT_FUNC init%s(void) {" % (module_name,))
+    with cpp_file.increased_indent():
+        cpp_file.add_line('PyObject *module = Py_InitModule("%s", k_module_methods);' % (module_name,))
+        cpp_file.add_line('if (!module) return;')
+        # only export the objects if they were all created:
+        for init_function in ('init_string_literals', 'init_imports'):
+            cpp_file.add_line('%s();' % (init_function,))
+            cpp_file.add_line('if (PyErr_Occurred()) return;')
+        cpp_file.add_line('PyModule_AddObject(module, SHARED_RUNTIME_ATTRIBUTE, PyCapsule_New(&%s, "%s", NULL));' %
+            (SHARED_RUNTIME_NAME, shared_runtime.capsule_name))
+    cpp_file.add_line('}')
+    cpp_file.add_line('')
 
     return '\n'.join(cpp_file.get_lines())
 
+def _include_guard(header_name):
+    return 'EZIO_%s' % (re.sub(r'\W', '_', header_name).upper(),)
+
+def _class_init_function_name(class_name):
+    return '%s_%s' % (class_name, CLASS_INIT_SUFFIX)
+
+def generate_split_header(header_name, compiled_classes):
+    """Generate the header at the root of every translation unit of a split build:
+    the runtime, and the little that all of the module's classes share. It only
+    depends on the compiler settings, so editing templates leaves it alone.
+    """
+    header = LineBufferMixin()
+    include_guard = _include_guard(header_name)
+    header.add_line('#ifndef %s' % (include_guard,))
+    header.add_line('#define %s' % (include_guard,))
+    header.add_fixup(generate_initial_segment())
+    if logs_missing_lookups(compiled_classes):
+        header.add_line('extern ezio_missing_lookups %s;' % (MISSING_LOOKUPS_NAME,))
+        header.add_line()
+    header.add_line('#endif')
+    return '\n'.join(header.get_lines())
+
+def generate_class_header(header_name, include_name, class_definition):
+    """Generate the header defining one class of a split build, which includes
+    `include_name`: the header of its superclass, or the root header.
+    Regenerate it whenever any class changes, since a subclass can make
+    methods of its superclasses virtual.
+    """
+    header = LineBufferMixin()
+    include_guard = _include_guard(header_name)
+    header.add_line('#ifndef %s' % (include_guard,))
+    header.add_line('#define %s' % (include_guard,))
+    header.add_line('#include "%s"' % (include_name,))
+    header.add_line()
+    header.add_line("namespace %s {" % (CPP_NAMESPACE,))
+    header.add_fixup(class_definition)
+    header.add_line("}")
+    header.add_line('#endif')
+    return '\n'.join(header.get_lines())
+
+def generate_class_c_file(header_name, compiled_class):
+    """Generate the translation unit for one class of a split build: its own
+    registries (so the indices in its code don't depend on any other class),
+    its methods, its hooks, and a function initializing its registries.
+    It includes nothing but the header of the class, `header_name`.
+    """
+    class_name = compiled_class.class_definition.class_name
+    render_stats = compiled_class.compiler_settings.render_stats
+
+    class_file = LineBufferMixin()
+    class_file.add_line('#include "%s"' % (header_name,))
+    class_file.add_line()
+    class_file.add_fixup(compiled_class.registry)
+    class_file.add_fixup(compiled_class.path_registry)
+    class_file.add_fixup(compiled_class.import_registry)
+    class_file.add_fixup(compiled_class.expression_registry)
+    class_file.add_line()
+    class_file.add_line("namespace %s {" % (CPP_NAMESPACE,))
+    class_file.add_fixup(generate_site_counters(compiled_class, exported=True))
+    class_file.add_fixup(compiled_class)
+    class_file.add_fixup(generate_hook("%s_%s" % (class_name, MAIN_FUNCTION_NAME), class_name,
+        public=True, exported=True, render_stats=render_stats))
+    class_file.add_fixup(generate_batch_hook("%s_%s" % (class_name, BATCH_HOOK_SUFFIX), class_name,
+        exported=True, render_stats=render_stats))
+    class_file.add_line('void %s(void) {' % (_class_init_function_name(class_name),))
+    with class_file.increased_indent():
+        class_file.add_line('init_string_literals();')
+        class_file.add_line('init_imports();')
+        class_file.add_line('init_expressions();')
+    class_file.add_line('}')
+    class_file.add_line("}")
+    return '\n'.join(class_file.get_lines())
+
+def generate_split_shared_c_file(module_name, header_name, compiled_classes):
+    """Generate the translation unit of a split build that holds the module
+    itself: the method table, the module-level report functions, and the
+    module initialization, which initializes each class in turn.
+
+    This only needs the names, settings, and sites of `compiled_classes`,
+    not their code.
+    """
+    shared_file = LineBufferMixin()
+    shared_file.add_line('#include "%s"' % (header_name,))
+    shared_file.add_line()
+    if logs_missing_lookups(compiled_classes):
+        shared_file.add_line('ezio_missing_lookups %s;' % (MISSING_LOOKUPS_NAME,))
+
+    # declare what the class translation units define:
+    hook_names, init_function_names = [], []
+    shared_file.add_line("namespace %s {" % (CPP_NAMESPACE,))
+    for compiled_class in compiled_classes:
+        class_name = compiled_class.class_definition.class_name
+        shared_file.add_line('extern ezio_render_history %s_%s;' % (class_name, RENDER_HISTORY_SUFFIX))
+        if compiled_class.compiler_settings.render_stats:
+            shared_file.add_line('extern ezio_render_stats %s_%s;' % (class_name, RENDER_STATS_SUFFIX))
+        for declaration in declare_site_counters(compiled_class, extern=True):
+            shared_file.add_line(declaration)
+        for suffix in (MAIN_FUNCTION_NAME, BATCH_HOOK_SUFFIX):
+            hook_name = "%s_%s" % (class_name, suffix)
+            shared_file.add_line('PyObject *%s(PyObject *self, PyObject *args);' % (hook_name,))
+            hook_names.append(hook_name)
+        init_function_name = _class_init_function_name(class_name)
+        shared_file.add_line('void %s(void);' % (init_function_name,))
+        init_function_names.append('%s::%s' % (CPP_NAMESPACE, init_function_name))
+    shared_file.add_line("}")
+    shared_file.add_line()
+
+    class_names = [compiled_class.class_definition.class_name for compiled_class in compiled_classes]
+    shared_file.add_fixup(generate_render_history_function(class_names))
+    shared_file.add_fixup(generate_render_stats_functions([compiled_class.class_definition.class_name
+        for compiled_class in compiled_classes if compiled_class.compiler_settings.render_stats]))
+    shared_file.add_fixup(generate_profile_functions(compiled_classes))
+    shared_file.add_fixup(generate_lookup_stats_functions(compiled_classes))
+    shared_file.add_fixup(generate_drain_missing_lookups_function(compiled_classes))
+    shared_file.add_fixup(generate_final_segment(module_name, hook_names, init_function_names=init_function_names))
+    return '\n'.join(shared_file.get_lines())
+
+def generate_split_c_files(module_name, header_name, class_header_names, compiled_classes):
+    """Generate the same module as generate_c_file, but as separate translation units
+    that can be compiled in parallel: a root header (see generate_split_header);
+    a header per class, defining it; a source file per class, defining its registries,
+    methods and hooks; and a shared source file with the module initialization code.
+    A class's files only contain what it uses, so an edit to one class leaves
+    the others' preprocessed sources (and so their object files) unchanged,
+    unless it changes their superclasses.
+
+    Args:
+        module_name - name of the extension module
+        header_name - name of the root header, as included
+        class_header_names - class name -> name of its header, as included
+        compiled_classes - CodeGenerators, or ClassSummaries of classes whose C files
+            are unchanged since an earlier build, superclasses before their subclasses
+    Returns: root header code, shared code, list of (class name, header code, class code);
+        the class code is None for ClassSummaries
+    """
+    class_files = []
+    for compiled_class in compiled_classes:
+        class_definition = compiled_class.class_definition
+        class_header_name = class_header_names[class_definition.class_name]
+        superclass_def = class_definition.superclass_def
+        include_name = class_header_names[superclass_def.class_name] if superclass_def else header_name
+        class_files.append((class_definition.class_name,
+            generate_class_header(class_header_name, include_name, class_definition),
+            generate_class_c_file(class_header_name, compiled_class)
+                if isinstance(compiled_class, CodeGenerator) else None))
+    return generate_split_header(header_name, compiled_classes), \
+        generate_split_shared_c_file(module_name, header_name, compiled_classes), class_files
+
 class NameStatus(object):
     """Encapsulates the status of a name we have compile-time information about."""
 
@@ -658,7 +1439,7 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
 
     def __init__(self, class_definition=None, literal_registry=None, path_registry=None,
             import_registry=None, compiler_settings=None, unique_id_counter=None,
-            superclass_definition=None, expression_registry=None):
+            superclass_definition=None, expression_registry=None, shared_runtime=None, template_filename=None):
         super(CodeGenerator, self).__init__()
 
         # this one can stay null if we don't have one already;
@@ -668,13 +1449,27 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         self.superclass_definition = superclass_definition
 
         assert not(bool(literal_registry) ^ bool(path_registry)), 'Must supply both literal and path registries, or neither'
-        self.registry = LiteralRegistry() if literal_registry is None else literal_registry
+        # literals and imports can come from a shared runtime module, but only for new registries:
+        self.shared_runtime = shared_runtime
+        self.registry = LiteralRegistry(shared_runtime) if literal_registry is None else literal_registry
         self.path_registry = PathRegistry(self.registry) if path_registry is None else path_registry
-        self.import_registry = ImportRegistry() if import_registry is None else import_registry
+        self.import_registry = ImportRegistry(shared_runtime) if import_registry is None else import_registry
         self.compiler_settings = CompilerSettings() if compiler_settings is None else compiler_settings
         self.unique_id_counter = itertools.count() if unique_id_counter is None else unique_id_counter
         self.expression_registry = ExpressionRegistry() if expression_registry is None else expression_registry
 
+        # the template being compiled, for #line directives; the last line of it one was emitted for,
+        # and the line the next one is due for, once there's code to attribute to it:
+        self.template_filename = template_filename
+        self.template_lineno = None
+        self.pending_template_lineno = None
+
+        # with CompilerSettings.profile, the (kind, name, template line) of each site
+        # timed, indexing the class's array of ezio_profile_site counters:
+        self.profile_sites = []
+        # likewise with CompilerSettings.lookup_telemetry, for each lookup site:
+        self.lookup_sites = []
+
         # our reimplementation of VFSSL:
         # static lookup among imported names, function arguments,
         # and the variable names in for loops, in REVERSE order
@@ -705,7 +1500,38 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
             literal_registry=self.registry, path_registry=self.path_registry,
             import_registry=self.import_registry, compiler_settings=copy.copy(self.compiler_settings),
             unique_id_counter=self.unique_id_counter, superclass_definition=self.superclass_definition,
-            expression_registry=self.expression_registry)
+            expression_registry=self.expression_registry, template_filename=self.template_filename)
+
+    def visit(self, node, variable_name=None):
+        # (a class has no code of its own to attribute; its methods mark themselves)
+        if isinstance(node, _ast.stmt) and not isinstance(node, _ast.ClassDef):
+            self._mark_template_line(node)
+        return super(CodeGenerator, self).visit(node, variable_name=variable_name)
+
+    def add_line(self, line=""):
+        if self.pending_template_lineno is not None:
+            if self.pending_template_lineno != self.template_lineno:
+                # (unindented, like all preprocessor directives)
+                self.lines.append('#line %d %s' % (self.pending_template_lineno,
+                    c_string_literal(self.template_filename)))
+                self.template_lineno = self.pending_template_lineno
+            self.pending_template_lineno = None
+        super(CodeGenerator, self).add_line(line)
+
+    def _mark_template_line(self, node):
+        """Attribute the code generated from here on to the template line `node` came from."""
+        if self.template_filename is None or not self.compiler_settings.line_directives:
+            return
+        lineno = getattr(node, 'lineno', None)
+        if lineno is not None:
+            self.pending_template_lineno = lineno
+
+    def _end_template_lines(self):
+        """Attribute the code generated from here on to the generated file again."""
+        self.pending_template_lineno = None
+        if self.template_lineno is not None:
+            self.lines.append(END_OF_TEMPLATE_LINES)
+            self.template_lineno = None
 
     def visit_Module(self, module_node, variable_name=None):
         assert variable_name is None, 'Cannot compile module for assignment.'
@@ -780,15 +1606,24 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
 
     def visit_FunctionDef(self, function_def, method=False):
         self.function_def_name = function_def.name
+        self._mark_template_line(function_def)
         argslist_str, arg_namespace = self._generate_argslist_for_declaration(function_def.args, method=method)
         self.add_line("PyObject* %s::%s(%s) {" % (self.class_definition.class_name, function_def.name, argslist_str))
         self.indent += 1
+        profile_site = self._add_profile_site('def', function_def.name, function_def)
+        if profile_site:
+            self.add_line('ezio_profile_frame %s;' % (METHOD_PROFILE_FRAME_NAME,))
+            self.add_line('profile_enter(&%s, &%s, &this->profile_frame);' % (METHOD_PROFILE_FRAME_NAME, profile_site))
 
         params_with_defaults = extract_params_with_defaults(function_def.args)
         for param, default_expr in zip(params_with_defaults, function_def.args.defaults):
             # compile code to generate the default value:
             subgenerator = self.make_subgenerator()
             subgenerator.compiler_settings.template_mode = False
+            # defaults are evaluated at import, outside of any render:
+            subgenerator.compiler_settings.profile = False
+            subgenerator.compiler_settings.lookup_telemetry = False
+            subgenerator.compiler_settings.default_missing_lookups = False
             subgenerator.exception_handler_stack.append(EXPRESSIONS_EXCEPTION_HANDLER)
             expression_lvalue = self.expression_registry.register()
             subgenerator.visit(default_expr, variable_name=expression_lvalue)
@@ -816,17 +1651,22 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
             self.visit(stmt)
         # insert the fixup to clean up assignments
         self.add_fixup(self.assignment_cleanup)
+        if profile_site:
+            self.add_line('profile_exit(&%s, &this->profile_frame);' % (METHOD_PROFILE_FRAME_NAME,))
         # XXX Py_None is being used as a C-truthy sentinel for success
         self.add_line("return Py_None;")
         self.add_line('%s:' % exception_handler)
         # insert the cleanup fixup *again*
         self.add_fixup(self.assignment_cleanup)
+        if profile_site:
+            self.add_line('profile_exit(&%s, &this->profile_frame);' % (METHOD_PROFILE_FRAME_NAME,))
         self.add_line("return NULL;")
         self.indent -= 1
         # remove the argument and assignment namespaces:
         self.namespaces.pop()
         self.namespaces.pop()
         self.add_line("}")
+        self._end_template_lines()
 
         self.exception_handler_stack.pop()
 
@@ -1054,8 +1894,9 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
             self.add_line("if (%s == NULL) { goto %s; }" % (temp_callable_name, exception_handler))
             # now dispatch to it; NULL is the sentinel value to stop reading the arguments:
             packed_args = ', '.join(args_tempvars) + (', NULL' if args_tempvars else ' NULL')
-            self.add_line("%s = PyObject_CallFunctionObjArgs(%s, %s);" %
-                (result_name, temp_callable_name, packed_args))
+            with self._profiled_call(call_node):
+                self.add_line("%s = PyObject_CallFunctionObjArgs(%s, %s);" %
+                    (result_name, temp_callable_name, packed_args))
             self.add_line("if (%s == NULL) { goto %s; }" % (result_name, exception_handler))
             if not variable_name:
                 self._template_write(result_name)
@@ -1064,7 +1905,7 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
 
         # clean up our owned references to the arguments if appropriate
         # if this isn't a C function and write=True, the new reference to the resulting element
-        # gets stolen by the list (PyList_Append); if write=False, it's the caller's responsibility
+        # gets stolen by the list (transaction_append); if write=False, it's the caller's responsibility
         # to clean it up
         for (arg, newref) in argname_and_newrefs:
             if newref:
@@ -1122,8 +1963,9 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
             argtuple, kwargdict, tempvars_and_newrefs = self._generate_argstuple_and_kwdict_for_invocation(call_node)
 
             new_ref_to_callable = self.visit(call_node.func, variable_name=temp_callable_name)
-            self.add_line("%s = PyObject_Call(%s, %s, %s);" %
-                (result_name, temp_callable_name, argtuple, kwargdict))
+            with self._profiled_call(call_node):
+                self.add_line("%s = PyObject_Call(%s, %s, %s);" %
+                    (result_name, temp_callable_name, argtuple, kwargdict))
             self.add_line("if (%s == NULL) { goto %s; }" % (result_name, cleanup_label))
             if not variable_name:
                 self._template_write(result_name)
@@ -1145,6 +1987,54 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         if variable_name:
             return True
 
+    def _add_profile_site(self, kind, name, node):
+        """With CompilerSettings.profile, register a site to time, and return
+        the C expression for its counters; otherwise return None.
+        """
+        if not self.compiler_settings.profile:
+            return None
+        index = len(self.profile_sites)
+        self.profile_sites.append((kind, name, getattr(node, 'lineno', 0)))
+        return '%s_%s[%d]' % (self.class_definition.class_name, PROFILE_SITES_SUFFIX, index)
+
+    def _missing_lookup_default(self):
+        """C expression for (a borrowed reference to) what missing lookups evaluate to."""
+        return self.registry.cexpr_for_index(self.registry.register(self.compiler_settings.missing_lookup_default))
+
+    def _log_missing_lookup(self, name, node):
+        """C statement logging that `name` wasn't found."""
+        return 'log_missing_lookup(&%s, "%s", %d, %s);' % (MISSING_LOOKUPS_NAME,
+            self.class_definition.class_name, getattr(node, 'lineno', 0), c_string_literal(name))
+
+    def _add_lookup_site(self, kind, name, node):
+        """With CompilerSettings.lookup_telemetry, register a lookup site,
+        and return the C expression for its counters; otherwise return None.
+        """
+        if not self.compiler_settings.lookup_telemetry:
+            return None
+        index = len(self.lookup_sites)
+        self.lookup_sites.append((kind, name, getattr(node, 'lineno', 0)))
+        return '%s_%s[%d]' % (self.class_definition.class_name, LOOKUP_SITES_SUFFIX, index)
+
+    @contextmanager
+    def _profiled_call(self, call_node):
+        """Contextmanager to time the call to a Python callable that the enclosed
+        lines make, with CompilerSettings.profile.
+        """
+        profile_site = self._add_profile_site('call', describe_expression(call_node.func), call_node)
+        if not profile_site:
+            yield
+            return
+        frame_name = 'call_frame_%d' % (self.unique_id_counter.next(),)
+        self.add_line('{')
+        self.indent += 1
+        self.add_line('ezio_profile_frame %s;' % (frame_name,))
+        self.add_line('profile_enter(&%s, &%s, &this->profile_frame);' % (frame_name, profile_site))
+        yield
+        self.add_line('profile_exit(&%s, &this->profile_frame);' % (frame_name,))
+        self.indent -= 1
+        self.add_line('}')
+
     def _unpack_tuple(self, tuple_var, tuple_node, cleanup_handler):
         temp_array = self._make_tempvar()
         temp_array_declaration = LineBufferMixin(initial_indent=self.indent)
@@ -1323,7 +2213,7 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         if not self.compiler_settings.template_mode:
             return
 
-        self.add_line("PyList_Append(this->%s, %s);" % (TRANSACTION_NAME, cexpr))
+        self.add_line("transaction_append(this->%s, %s);" % (TRANSACTION_NAME, cexpr))
         if newref:
             self.add_line('Py_DECREF(%s);' % (cexpr,))
 
@@ -1384,9 +2274,16 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         literal_id = self.registry.register(name)
         self.add_line("%s = PyDict_GetItem(this->%s, %s[%d]);" %
             (target, DISPLAY_NAME, LITERALS_ARRAY_NAME, literal_id))
+        lookup_site = self._add_lookup_site('display', name, name_node)
+        if lookup_site:
+            self.add_line("count_display_lookup(&%s, this->%s, %s);" % (lookup_site, DISPLAY_NAME, target))
 
-        self.add_line('if (!%s) { PyErr_SetString(PyExc_KeyError, "%s"); goto %s; }' %
-           (target, name, self.exception_handler_stack[-1]))
+        if self.compiler_settings.default_missing_lookups:
+            self.add_line('if (!%s) { %s %s = %s; }' % (target, self._log_missing_lookup(name, name_node),
+                target, self._missing_lookup_default()))
+        else:
+            self.add_line('if (!%s) { PyErr_SetString(PyExc_KeyError, "%s"); goto %s; }' %
+               (target, name, self.exception_handler_stack[-1]))
         if variable_name:
             # return a new reference:
             self.add_line('Py_INCREF(%s);' % (variable_name,))
@@ -1467,7 +2364,20 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
 
             new_ref = self.visit(terminal_node, variable_name=temp_base_var)
 
-            if self.compiler_settings.use_variadic_path_resolution:
+            quiet = self.compiler_settings.default_missing_lookups
+            if self.compiler_settings.lookup_telemetry or quiet:
+                # a site per element of the path, named by the path up to it:
+                prefix = describe_expression(terminal_node)
+                lookup_sites = []
+                for name in path:
+                    prefix = '%s.%s' % (prefix, name)
+                    lookup_sites.append(self._add_lookup_site('path', prefix, attribute_node))
+                name_indices = [self.registry.register(name) for name in path]
+                path_varargs = "".join(" ,%s[%d]" % (LITERALS_ARRAY_NAME, index) for index in name_indices)
+                sites = '&' + lookup_sites[0] if lookup_sites[0] else 'NULL'
+                c_expr = "resolve_path_counted(%s, %s, %d, %d %s)" % (temp_base_var, sites, int(quiet),
+                    len(name_indices), path_varargs)
+            elif self.compiler_settings.use_variadic_path_resolution:
                 name_indices = [self.registry.register(name) for name in path]
                 path_varargs = "".join(" ,%s[%d]" % (LITERALS_ARRAY_NAME, index) for index in name_indices)
                 c_expr = "resolve_path(%s, %d %s)" % (temp_base_var, len(name_indices), path_varargs)
@@ -1477,7 +2387,16 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
 
             if new_ref:
                 self.add_line("Py_DECREF(%s);" % (temp_base_var,))
-            self.add_line("if (!(%s = %s)) { goto %s; }" % (result_var, c_expr, self.exception_handler_stack[-1]))
+            if quiet:
+                # NULL without an exception means the path isn't there:
+                self.add_line("if (!(%s = %s)) {" % (result_var, c_expr))
+                with self.increased_indent():
+                    self.add_line("if (PyErr_Occurred()) { goto %s; }" % (self.exception_handler_stack[-1],))
+                    self.add_line(self._log_missing_lookup(prefix, attribute_node))
+                    self.add_line("%s = %s; Py_INCREF(%s);" % (result_var, self._missing_lookup_default(), result_var))
+                self.add_line("}")
+            else:
+                self.add_line("if (!(%s = %s)) { goto %s; }" % (result_var, c_expr, self.exception_handler_stack[-1]))
 
             if variable_name:
                 # path lookup returns a new ref
@@ -1859,9 +2778,15 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         #call self.layout_container(border=False)
             <p>$bar $baz($quux, $bal)
         #end call
-        the effect will be to execute the enclosed code against a fresh transaction,
-        then concatenate the transaction and pass the resulting string as the first
-        argument to self.layout_container. It's an exotic but useful convenience.
+        the effect will be to execute the enclosed code, concatenate everything it wrote,
+        and pass the resulting string as the first argument to self.layout_container.
+        It's an exotic but useful convenience.
+
+        Rather than swapping in a fresh transaction list, the enclosed code writes
+        to the end of the current transaction as usual; we remember where the
+        captured region starts, concatenate just that region, then truncate the
+        transaction back to where it was. This saves a list allocation per #call
+        and keeps nested #calls writing into a single buffer.
 
         Since Python itself has no 'call' statement, we encode #call in Python ASTs
         by transforming it into a with statement. See tmpl2py for details.
@@ -1873,30 +2798,28 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         with self.block_scope():
             exception_handler = 'HANDLE_EXCEPTIONS_%d' % (self.unique_id_counter.next(),)
 
-            # this will hold the old value of this->transaction:
-            transaction_tempvar = self._make_tempvar()
+            # this will hold the index at which the captured region begins:
+            region_start_tempvar = self._make_tempvar()
             # this will hold the intermediate result of the #call block execution:
             raw_result_tempvar = self._make_tempvar()
             self._declare_and_initialize([raw_result_tempvar])
-            # save the old transaction
-            self.add_line('PyObject *%s = this->transaction;' % (transaction_tempvar,))
-            # create a new one
-            self.add_line('if (!(this->transaction = PyList_New(0))) { goto %s; };'
-                    % (self.exception_handler_stack[-1],))
+            self.add_line('Py_ssize_t %s = PyList_GET_SIZE(this->%s);' %
+                    (region_start_tempvar, TRANSACTION_NAME))
 
             self.exception_handler_stack.append(exception_handler)
             # compile the body of the #call statement
             for stmt in with_node.body:
                 self.visit(stmt)
             self.exception_handler_stack.pop()
-            # concatenate the temporary transaction
-            self.add_line('%s = ezio_concatenate(this->transaction);' % (raw_result_tempvar,))
+            # concatenate the captured region
+            self.add_line('%s = ezio_concatenate_range(this->%s, %s);' %
+                    (raw_result_tempvar, TRANSACTION_NAME, region_start_tempvar))
 
-            # on exceptional or unexceptional exit, clean up the temporary transaction:
+            # on exceptional or unexceptional exit, discard the captured region:
             self.add_line('%s:' % (exception_handler,))
-            self.add_line('Py_DECREF(this->transaction);')
-            self.add_line('this->transaction = %s;' % (transaction_tempvar,))
-            # if we did not successfully concatenate the temporary transaction, fail:
+            self.add_line('truncate_transaction(this->%s, %s);' %
+                    (TRANSACTION_NAME, region_start_tempvar))
+            # if we did not successfully concatenate the captured region, fail:
             self.add_line('if (!%s) { goto %s; }' % (raw_result_tempvar,
                 self.exception_handler_stack[-1]))
 
@@ -1911,7 +2834,7 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
                     fake_arg_node = _ast.Name(id=raw_result_tempvar, ctx=_ast.Load())
                     munged_call_node.args = [fake_arg_node] + call_node.args
                     # compile the call to the postprocessing function, and have it write the result
-                    # to the transaction (which has been reset to be the original transaction)
+                    # to the transaction (from which the captured region has been discarded)
                     self.visit(munged_call_node)
 
             # dispose of the raw result, on both exceptional and unexceptional paths
@@ -2075,4 +2998,4 @@ class CodeGenerator(LineBufferMixin, NodeVisitor):
         """
         self.visit(parsetree)
         return generate_c_file(module_name, self.registry, self.path_registry,
-                self.import_registry, self.expression_registry, [self])
+                self.import_registry, self.expression_registry, [self], shared_runtime=self.shared_runtime)
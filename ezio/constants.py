@@ -36,3 +36,34 @@ class CompilerSettings(object):
     # and with it off, it should be a generalized Python AST compiler
     # (although clearly most functionality is not implemented yet)
     template_mode = True
+
+    # build the AST of each template directly in the lexer (tmpl2py.tmpl2ast),
+    # rather than by generating Python source and parsing it:
+    direct_ast_frontend = True
+
+    # precede the code generated for each statement with a #line directive naming
+    # the template line it came from, so that compiler messages, debuggers, and
+    # profilers point at the template:
+    line_directives = True
+
+    # keep native counters of the renders of each template class (count, time,
+    # output size), exposed by the module's stats() and reset_stats(); off, the
+    # hooks don't so much as read the clock:
+    render_stats = False
+
+    # time every native method and every call to a Python callable, keyed by
+    # template line, for the module's profile() report:
+    profile = False
+
+    # count, for each display name and each element of each dotted path in the
+    # templates, how often it's found by dict lookup, found by getattr, or missed,
+    # and the types it's looked up on, for the module's lookup_stats() report.
+    # Paths are resolved as with use_variadic_path_resolution:
+    lookup_telemetry = False
+
+    # rather than raising KeyError or AttributeError, make display names and dotted
+    # paths that aren't there evaluate to missing_lookup_default, logging each miss
+    # in the module, for its drain_missing_lookups(). Paths are resolved as with
+    # use_variadic_path_resolution:
+    default_missing_lookups = False
+    missing_lookup_default = ''
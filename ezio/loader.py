@@ -0,0 +1,118 @@
+"""
+Registry of compiled templates, imported on demand.
+
+Importing a template module runs its initialization (creating all its
+literals, performing its imports, evaluating its default arguments), so
+rather than importing every module at startup, register them with a
+TemplateLoader, which imports each one the first time one of its templates
+is rendered, and caches the hooks it looks up. A hot subset can be imported
+ahead of time, in a background thread, with preload.
+
+The main entry point here is TemplateLoader.
+"""
+
+from __future__ import with_statement
+
+import importlib
+import logging
+import threading
+
+from .builder import MODULE_NAME
+from .compiler import BATCH_HOOK_SUFFIX, DRAIN_MISSING_LOOKUPS_FUNCTION_NAME, MAIN_FUNCTION_NAME
+
+class TemplateLoader(object):
+    """Maps template names to compiled template modules, and renders them."""
+
+    def __init__(self):
+        # template name -> dotted name of the module containing it, and the class name within it:
+        self.templates = {}
+        # (template name, hook suffix) -> hook function:
+        self.hooks = {}
+        self._lock = threading.RLock()
+
+    def register(self, template_name, module_name, class_name=None):
+        """Register a template compiled from a single file, e.g.,
+        register('simple', 'tools.templates.simple'). The template class
+        is named `template_name`, unless `class_name` is given.
+        """
+        template = (module_name, class_name or template_name)
+        if self.templates.get(template_name) != template:
+            with self._lock:
+                self.templates[template_name] = template
+                # forget hooks from anything previously registered under this name:
+                for suffix in (MAIN_FUNCTION_NAME, BATCH_HOOK_SUFFIX):
+                    self.hooks.pop((template_name, suffix), None)
+
+    def register_project(self, package_name, class_names, prefix=''):
+        """Register the classes of a project, given the dotted name of the project
+        directory, e.g., register_project('tools.templates.simple_classes', ['simple_subclass']).
+        The templates are named after the classes, plus `prefix`.
+        """
+        module_name = '%s.%s' % (package_name, MODULE_NAME)
+        for class_name in class_names:
+            self.register(prefix + class_name, module_name, class_name)
+
+    def get_module(self, template_name):
+        """Import (if necessary) and return the module containing `template_name`."""
+        module_name, _ = self.templates[template_name]
+        return importlib.import_module(module_name)
+
+    def get_hook(self, template_name, suffix=MAIN_FUNCTION_NAME):
+        """Return the hook <class name>_<suffix> of the module containing `template_name`."""
+        key = (template_name, suffix)
+        hook = self.hooks.get(key)
+        if hook is None:
+            with self._lock:
+                hook = self.hooks.get(key)
+                if hook is None:
+                    _, class_name = self.templates[template_name]
+                    hook = getattr(self.get_module(template_name), '%s_%s' % (class_name, suffix))
+                    self.hooks[key] = hook
+        return hook
+
+    def is_loaded(self, template_name):
+        return (template_name, MAIN_FUNCTION_NAME) in self.hooks
+
+    def respond(self, template_name, display, self_ptr=None):
+        return self.get_hook(template_name)(display, self_ptr)
+
+    def respond_many(self, template_name, displays, self_ptr=None, outfile=None):
+        return self.get_hook(template_name, BATCH_HOOK_SUFFIX)(displays, self_ptr, outfile)
+
+    def log_missing_lookups(self, logger=None):
+        """Drain the missing lookups logged by the modules loaded so far (see
+        CompilerSettings.default_missing_lookups) into `logger`, as warnings,
+        and return how many there were, including any the modules had to drop.
+        """
+        logger = logger or logging.getLogger(__name__)
+        module_names = set(self.templates[template_name][0] for template_name, suffix in self.hooks.keys()
+            if template_name in self.templates)
+        total = 0
+        for module_name in sorted(module_names):
+            drain = getattr(importlib.import_module(module_name), DRAIN_MISSING_LOOKUPS_FUNCTION_NAME, None)
+            if drain is None:
+                continue
+            misses, dropped = drain()
+            for template, lineno, name in misses:
+                logger.warning('missing lookup of %s in %s, line %d', name, template, lineno)
+            if dropped:
+                logger.warning('%d more missing lookups in %s were dropped', dropped, module_name)
+            total += len(misses) + dropped
+        return total
+
+    def preload(self, template_names, background=True):
+        """Import the modules for `template_names` ahead of their first render.
+        If `background`, do it in a daemon thread, and return the thread.
+        """
+        def load_all():
+            for template_name in template_names:
+                self.get_hook(template_name)
+
+        if not background:
+            load_all()
+            return None
+
+        thread = threading.Thread(target=load_all, name='ezio-preload')
+        thread.daemon = True
+        thread.start()
+        return thread
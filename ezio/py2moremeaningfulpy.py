@@ -29,10 +29,10 @@ from _ast import (
 
 from ezio.constants import BLOCK_TAG
 
-def py2moremeaningfulpy(tmpl_name, ast_):
+def py2moremeaningfulpy(tmpl_name, ast_, copy=True):
     """Convenience function for using AstGen."""
 
-    gen = AstGen(tmpl_name, ast_)
+    gen = AstGen(tmpl_name, ast_, copy)
     gen.translate()
     return gen.modnode
 
@@ -45,7 +45,8 @@ class AstGen(object):
     """After initializing a new instance, call its translate() method to
     perform the conversion and get the resulting AST. The transformation is
     destructive to the AST that is operated on, but a (deep) copy is made to
-    hide this from the end user.
+    hide this from the end user, unless `copy` is False (e.g., because the AST
+    was built for the occasion, by tmpl2py.tmpl2ast).
 
     Here are the transformations made:
         1. process ``import foo as __extends__`` into the class statement
@@ -57,10 +58,10 @@ class AstGen(object):
         respond method.
     """
 
-    def __init__(self, tmpl_name, ast_):
+    def __init__(self, tmpl_name, ast_, copy=True):
 
         # this is mutated throughout the conversion process
-        self.ast_ = deepcopy(ast_)
+        self.ast_ = deepcopy(ast_) if copy else ast_
 
         # the final module
         self.modnode = Module(body=[]) # list is mutable, we'll rely on that
@@ -32,7 +32,8 @@
     chunks respective to their namesakes.
 
     The main entry points to this module are ``tmpl2py()`` and
-    ``tmpl2PyOut()``.
+    ``tmpl2PyOut()``, and ``tmpl2ast()``, which skips the Python source and
+    builds its AST directly.
 """
 
 import ast
@@ -87,14 +88,65 @@ def sanitize_dollars(string, munge_pair=IDENTITY_MUNGEPAIR):
     whether an ``elif`` line is valid, it must be put in a context with an
     ``if`` before it.
 
-    Repeatedly call ast.parse() on the string, and strip out dollar signs for
-    which it throws a SyntaxError. Raise an exception if the SyntaxError wasn't
-    caused by a dollar sign.
+    Tokenize the string once and delete every '$' outside of string literals
+    and comments (which is where the tokenizer can't make sense of them),
+    then check that the result parses. If it doesn't, fall back to
+    ``strip_dollars_by_parsing``, which raises an exception for errors that
+    aren't caused by dollar signs.
     """
 
     munge, unmunge = munge_pair
     string = munge(string)
 
+    if '$' not in string:
+        return unmunge(strip_dollars_by_parsing(string))
+
+    offsets = placeholder_dollar_offsets(string)
+    if offsets is not None:
+        pieces = []
+        start = 0
+        for offset in offsets:
+            pieces.append(string[start:offset])
+            start = offset + 1
+        pieces.append(string[start:])
+        sanitized = ''.join(pieces)
+        try:
+            ast.parse(sanitized)
+        except SyntaxError:
+            pass
+        else:
+            return unmunge(sanitized)
+
+    return unmunge(strip_dollars_by_parsing(string))
+
+def placeholder_dollar_offsets(string):
+    """Return the offsets in ``string`` of the '$'s that Python's tokenizer
+    rejects, i.e., those outside of string literals and comments, or None if
+    ``string`` can't be tokenized at all.
+    """
+    # tokenize reports (row, column); lines are split on '\n' only, as by readline
+    line_offsets = [0]
+    for line in string.split('\n'):
+        line_offsets.append(line_offsets[-1] + len(line) + 1)
+
+    offsets = []
+    try:
+        for token_type, token_string, (row, col), _, _ in tokenize.generate_tokens(StringIO(string).readline):
+            if token_type == tokenize.ERRORTOKEN and token_string == '$':
+                offsets.append(line_offsets[row - 1] + col)
+    except (tokenize.TokenError, IndentationError):
+        return None
+    return offsets
+
+def strip_dollars_by_parsing(string):
+    """Repeatedly call ast.parse() on the string, and strip out dollar signs for
+    which it throws a SyntaxError. Raise an exception if the SyntaxError wasn't
+    caused by a dollar sign.
+
+    This costs a full parse per dollar sign; ``sanitize_dollars`` only uses it
+    when its single pass over the tokens didn't produce valid Python.
+    """
+
     # while ast.parse(string) raises a SyntaxError on a '$', delete that '$'
     while True:
 
@@ -116,7 +168,7 @@ def sanitize_dollars(string, munge_pair=IDENTITY_MUNGEPAIR):
         else:
             break # all invalid dollar signs are gone, string is valid
 
-    return unmunge(string)
+    return string
 
 def idempotent_de_dollar(string):
     """Remove Cheetah placeholder '$'s from otherwise valid Python (making
@@ -157,76 +209,78 @@ class LiteralTextStrategy(object):
     # LiteralTextStrategy consumes anything *except* the things that
     # LineDirectiveSuperStrategy and PlaceholderSuperStrategy should consume.
     def consume(self, py_out, driver):
-        consumed = ''
+        # collect the pieces of the literal text, and join them once at the end
+        pieces = []
 
         # loop until we encounter the end of of literal text
         while True:
+            # Only one line is ever in driver.head during this loop;
+            # scan it from an offset rather than advancing past each piece.
+            head = driver.head
+            pos = 0
 
             # search for any of our special characters
-            metacharacter_match = METACHARACTER_REGEX.search(driver.head)
-
-            # read "continue" as "we're still in literal text" and "break" as "we're now outside it"
-            if metacharacter_match:
+            for metacharacter_match in METACHARACTER_REGEX.finditer(head):
                 metacharacter = metacharacter_match.group(0)
                 start_pos = metacharacter_match.start(0)
-                before_metacharacter = driver.head[:start_pos]
+                if start_pos < pos:
+                    # the escaped character of a backslash escape; already consumed
+                    continue
                 # TODO if a line begins with whitespace and a #, should we suppress the whitespace?
-                consumed += before_metacharacter
+                pieces.append(head[pos:start_pos])
 
                 # read the character following the metacharacter
                 subsequent_pos = start_pos + 1
-                subsequent_char = driver.head[subsequent_pos] if subsequent_pos < len(driver.head) \
+                subsequent_char = head[subsequent_pos] if subsequent_pos < len(head) \
                         else None
 
-                # OK, skip over the consumed text; leave the metacharacter for now
-                driver.advance_past(before_metacharacter)
-
                 if metacharacter == "\\":
                     if subsequent_char in ("#", "$"):
                         # subsequent char is an escaped metacharacter, consume and skip it
                         # i.e., \# means #, and \$ means $
-                        driver.advance_past(driver.head[:2])
-                        consumed += subsequent_char
-                        continue
+                        pieces.append(subsequent_char)
+                        pos = start_pos + 2
                     else:
                         # next char is not a metacharacter; write the backslash
                         # i.e., \a means \a, and \<newline> means \<newline>
-                        driver.advance_past(driver.head[:1])
-                        consumed += "\\"
-                        continue
+                        pieces.append("\\")
+                        pos = start_pos + 1
                 elif metacharacter == "#":
-                    # unescaped # --- break out into directive mode
-                    py_out.commit_line(repr(consumed) + '\n')
-                    break
+                    # unescaped # --- break out into directive mode;
+                    # skip over the consumed text, but leave the metacharacter
+                    driver.advance_past(head[:start_pos])
+                    py_out.commit_literal(''.join(pieces))
+                    return
                 elif metacharacter == "$":
                     if subsequent_char.isalpha() or subsequent_char in ('_', '(', '[', '{'):
                         # this is the start of a valid Python identifer,
                         # or a Cheetah placeholder block. break out:
-                        py_out.commit_line(repr(consumed) + '\n')
-                        break
+                        driver.advance_past(head[:start_pos])
+                        py_out.commit_literal(''.join(pieces))
+                        return
                     else:
                         # this is just a $, e.g., $100.00
-                        driver.advance_past(driver.head[:1])
-                        consumed += "$"
-                        continue
+                        pieces.append("$")
+                        pos = start_pos + 1
                 else:
                     # regex matched a non-metacharacter; this should never happen
                     raise ValueError(metacharacter)
 
-            # Consume the current line.
-            # Only one line is ever in driver.head during this loop.
-            consumed += driver.head
-            driver.advance_past(driver.head)
+            # Consume the rest of the current line.
+            pieces.append(head[pos:])
+            driver.advance_past(head)
             #invariant: at this point, driver.head is empty
             assert driver.head == ''
 
-            # get a new line
-            if driver.extend_head() is not None: # i.e. we have reached EOF
+            # get new lines; any without metacharacters are all literal text
+            pieces.extend(driver.take_lines_without(METACHARACTER_REGEX))
+            if driver.done:
                 # Make sure we consumed something.
                 # When a directive is the last line in the file, this will
                 # terminate us without adding a spurious newline.
+                consumed = ''.join(pieces)
                 if consumed != '':
-                    py_out.commit_line(repr(consumed) + '\n')
+                    py_out.commit_literal(consumed)
                 break
 
             # else continue (implicitly)
@@ -326,14 +380,19 @@ class LinewisePurePythonStrategy(object):
         if kwd in ('else', 'elif', 'except', 'finally'):
             py_out.dedent()
 
-        for prefix in driver.increasing_prefixes('#\n'):
-            munged = munge_pair.munge(prefix)
-            try:
-                ast.parse(idempotent_de_dollar(munged))
-            except SyntaxError:
-                continue
-            else:
-                break
+        balanced = driver.balanced_prefix('#\n')
+        if balanced is not None and SynErr_idx(idempotent_de_dollar(munge_pair.munge(balanced))) is None:
+            prefix = balanced
+        else:
+            # no luck in one pass; try every candidate
+            for prefix in driver.increasing_prefixes('#\n'):
+                munged = munge_pair.munge(prefix)
+                try:
+                    ast.parse(idempotent_de_dollar(munged))
+                except SyntaxError:
+                    continue
+                else:
+                    break
 
         py_out.commit_line(sanitize_dollars(prefix, munge_pair))
         if kwd not in simple_stmts:
@@ -533,6 +592,38 @@ def verified_SynErr_idx(string, verify_char):
         return index
 
 MATCHING_DELIMS = { '(': ')', '[': ']', '{': '}' }
+CLOSING_DELIMS = frozenset(MATCHING_DELIMS.itervalues())
+# what EzioTemplateDriver.balanced_prefix has to look at, besides its delimiters:
+BALANCED_PREFIX_CHARS = '()[]{}\'"#'
+
+def skip_string_or_comment(string, pos, at_eof):
+    """Return the index just past the string literal or comment starting at
+    ``string[pos]`` (a comment ends before its newline), None if it may continue
+    past the end of ``string``, or -1 if it's an unterminated string literal.
+    """
+    char = string[pos]
+    if char == '#':
+        end = string.find('\n', pos)
+        if end < 0:
+            return len(string) if at_eof else None
+        return end
+
+    quote = string[pos:pos + 3]
+    if quote != char * 3:
+        if len(quote) < 3 and quote == char * len(quote) and not at_eof:
+            # it could still turn out to be a triple quote
+            return None
+        quote = char
+
+    # backslash escapes, newlines, and the closing quote:
+    regex = re.compile(r'\\.|\n|' + re.escape(quote), re.DOTALL)
+    for match in regex.finditer(string, pos + len(quote)):
+        token = match.group(0)
+        if token == quote:
+            return match.end()
+        elif token == '\n' and len(quote) == 1:
+            return -1
+    return -1 if at_eof else None
 
 class DollarBracketStrategy(object):
     """Process placeholders of the form $(foo), $[foo], ${foo}."""
@@ -547,12 +638,17 @@ class DollarBracketStrategy(object):
 
         end_delim = MATCHING_DELIMS[driver.head[0]]
 
-        for prefix in driver.increasing_prefixes(end_delim):
-            start_bracket_stripped = prefix[1:]
-            if verified_SynErr_idx(
-                    idempotent_de_dollar(start_bracket_stripped),
-                    end_delim):
-                break
+        balanced = driver.balanced_prefix(end_delim)
+        if balanced is not None and verified_SynErr_idx(idempotent_de_dollar(balanced[1:]), end_delim):
+            prefix = balanced
+        else:
+            # no luck in one pass; try every candidate
+            for prefix in driver.increasing_prefixes(end_delim):
+                start_bracket_stripped = prefix[1:]
+                if verified_SynErr_idx(
+                        idempotent_de_dollar(start_bracket_stripped),
+                        end_delim):
+                    break
 
         py_out.commit_line(sanitize_dollars(prefix[1:-1]) + '\n')
         driver.advance_past(prefix)
@@ -590,6 +686,13 @@ class DollarNoBracketStrategy(object):
                 continue
 
             if driver.head and driver.head[0] in '[(':
+                balanced = driver.balanced_prefix(MATCHING_DELIMS[driver.head[0]])
+                if balanced is not None and SynErr_idx(idempotent_de_dollar(dummy_ident + balanced)) is None:
+                    consumed += balanced
+                    driver.advance_past(balanced)
+                    continue
+
+                # no luck in one pass; try every candidate
                 for prefix in driver.increasing_prefixes(MATCHING_DELIMS[driver.head[0]]):
 
                     # foo[<inner_slice_or_subscription>] is syntactically valid
@@ -649,6 +752,15 @@ def tmpl2PyOut(filelike, strategies=[LineDirectiveSuperStrategy(),
     py_out = PyOut(filelike, strategies)
     return py_out
 
+def tmpl2ast(filelike, strategies=[LineDirectiveSuperStrategy(),
+                                  PlaceholderSuperStrategy(),
+                                  LiteralTextStrategy()]):
+    """Given a template, return the AST of the converted Python, i.e., what
+    ast.parse(tmpl2py(filelike)) would, but numbered with template lines.
+    """
+    ast_out = AstOut(filelike, strategies)
+    return ast_out.mainloop()
+
 def cleanse_whitespace(string):
     """Remove unnecessary whitespace and fit everything on one line."""
 
@@ -719,9 +831,10 @@ class PyOut(object):
         # Python, to be able to give more informative messages farther down the
         # pipeline.
         #
-        # keys: .py position
-        # values: .tmpl position
+        # keys: .py position where a committed line starts
+        # values: .tmpl position of the statement it comes from
         self.pos_map = {}
+        self.statement_pos = self.driver.pos
 
     def commit_line(self, line):
         """Commit a line to the output buffer.
@@ -729,9 +842,17 @@ class PyOut(object):
         Strings passed to this should have a terminating newline.
         """
         cleansed = cleanse_whitespace(line)
+        self.pos_map[self.out_buf.pos] = self.statement_pos
         self.out_buf.add_to_buf(self.indent_with * self.cur_indent + cleansed)
 
-        self.pos_map[self.out_buf.pos] = self.driver.pos
+    def commit_literal(self, text):
+        """Commit a line of literal text to the output buffer.
+
+        This is what commit_line(repr(text) + '\\n') would commit, without
+        the trip through the tokenizer.
+        """
+        self.pos_map[self.out_buf.pos] = self.statement_pos
+        self.out_buf.add_to_buf(self.indent_with * self.cur_indent + repr(text) + ' \n')
 
     def indent(self):
         self.cur_indent += 1
@@ -748,12 +869,206 @@ class PyOut(object):
                 self.driver.extend_head()
                 # TODO: could detect EOF here
             strat = get_accepting_strategy(self.driver.head, self.strategies)
+            # where in the template whatever the strategy commits comes from:
+            self.statement_pos = self.driver.pos
             strat.consume(self, self.driver)
-        self.final_python = self.out_buf.result()
+        self.final_python = self.result()
         if self.cur_indent != 0: # didn't dedent enough!
             raise EzioUnmatchedDirectivesError()
         return self.final_python
 
+    def result(self):
+        return self.out_buf.result()
+
+    def renumber(self, tree):
+        """Renumber the AST parsed from the result with the template lines
+        it comes from, as tmpl2ast numbers its AST.
+        """
+        lines = dict((py_pos.lineno, tmpl_pos.lineno) for py_pos, tmpl_pos in self.pos_map.iteritems())
+        for node in ast.walk(tree):
+            if 'lineno' in node._attributes and hasattr(node, 'lineno'):
+                node.lineno = lines.get(node.lineno, node.lineno)
+        return tree
+
+
+# the keyword (or @) that a committed line starts with, if any:
+STATEMENT_KEYWORD = re.compile(r'\s*(@|[A-Za-z_][A-Za-z0-9_]*)?')
+
+COMPOUND_KEYWORDS = frozenset(('if', 'for', 'while', 'with', 'def', 'class', 'try'))
+
+# the context each clause continuing a compound statement parses in, and how to
+# find it in the result:
+CLAUSE_PARSERS = {
+    'elif': ('if True:\n\tpass\n%s\tpass', lambda module: module.body[0].orelse[0]),
+    'except': ('try:\n\tpass\n%s\tpass', lambda module: module.body[0].handlers[0]),
+}
+
+class AstOut(PyOut):
+    """Coordinate building the AST of a template directly, rather than Python
+    source to be reparsed. Literal text becomes string nodes as is, and each
+    other committed line is parsed on its own and fitted into the statement
+    it belongs to. Statements are numbered with the template lines they
+    come from.
+    """
+
+    def __init__(self, filelike, strategies, indent_with='\t'):
+        super(AstOut, self).__init__(filelike, strategies, indent_with)
+
+        self.module = ast.Module(body=[])
+        self.statement_pos = self.driver.pos
+
+        # the statement lists that each level of indentation is building:
+        self.suites = [self.module.body]
+        # the compound statement at each level that an else/elif/except/finally
+        # would continue, if any:
+        self.continuable = [None]
+        # what the next indent() opens, i.e., the suite of the last compound header:
+        self.next_suite = None
+        # decorators waiting for their def or class:
+        self.decorators = []
+        # try statements; each must end up with an except clause, or be replaced by a try-finally:
+        self.try_nodes = []
+
+    def commit_line(self, line):
+        keyword = STATEMENT_KEYWORD.match(line).group(1)
+        line = line.lstrip()
+
+        if keyword in CLAUSE_PARSERS or keyword in ('else', 'finally'):
+            self._continue_compound(keyword, line)
+        elif keyword == '@':
+            decorated = self._parse(line + 'def foo():\n\tpass')[0]
+            self.decorators.extend(decorated.decorator_list)
+        elif keyword in COMPOUND_KEYWORDS:
+            if keyword == 'try':
+                node = self._parse(line + '\tpass\nexcept:\n\tpass')[0]
+                node.handlers = []
+                self.try_nodes.append(node)
+            else:
+                node = self._parse(line + '\tpass')[0]
+            if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                node.decorator_list = self._take_decorators()
+            else:
+                self._refuse_decorators()
+            node.body = []
+            self.suites[self.cur_indent].append(node)
+            self.continuable[self.cur_indent] = node if keyword in ('if', 'for', 'while', 'try') else None
+            self.next_suite = node.body
+        else:
+            self._refuse_decorators()
+            self.suites[self.cur_indent].extend(self._parse(line))
+            self.continuable[self.cur_indent] = None
+
+    def commit_literal(self, text):
+        self._refuse_decorators()
+        node = ast.Expr(value=ast.Str(s=text))
+        self.suites[self.cur_indent].append(node)
+        self.continuable[self.cur_indent] = None
+        self._locate(node, 1)
+
+    def indent(self):
+        assert self.next_suite is not None, "indent without a compound statement"
+        super(AstOut, self).indent()
+        self.suites.append(self.next_suite)
+        self.continuable.append(None)
+        self.next_suite = None
+
+    def dedent(self):
+        self._refuse_decorators()
+        super(AstOut, self).dedent()
+        if not self.suites.pop():
+            self._syntax_error('expected an indented block')
+        self.continuable.pop()
+
+    def result(self):
+        self._refuse_decorators()
+        for node in self.try_nodes:
+            if isinstance(node, ast.TryExcept) and not node.handlers:
+                self._syntax_error('try without except or finally', node)
+        return self.module
+
+    def _continue_compound(self, keyword, line):
+        """Attach an else, elif, except, or finally clause to the compound
+        statement it continues.
+        """
+        self._refuse_decorators()
+        suite = self.suites[self.cur_indent]
+        node = self.continuable[self.cur_indent]
+
+        if keyword == 'elif' and isinstance(node, ast.If) and not node.orelse:
+            clause = self._parse_clause(keyword, line)
+            clause.body = []
+            node.orelse = [clause]
+            self.continuable[self.cur_indent] = clause
+            self.next_suite = clause.body
+        elif keyword == 'except' and isinstance(node, ast.TryExcept) and not node.orelse:
+            clause = self._parse_clause(keyword, line)
+            clause.body = []
+            node.handlers.append(clause)
+            self.next_suite = clause.body
+        elif keyword == 'else' and isinstance(node, (ast.If, ast.For, ast.While, ast.TryExcept)) \
+                and not node.orelse and getattr(node, 'handlers', True):
+            # a try can still have a finally after its else:
+            self.continuable[self.cur_indent] = node if isinstance(node, ast.TryExcept) else None
+            self.next_suite = node.orelse
+        elif keyword == 'finally' and isinstance(node, ast.TryExcept):
+            if node.handlers:
+                body = [node]
+            else:
+                # a try-finally, rather than a try-except nested in one
+                body = node.body
+                self.try_nodes.remove(node)
+            clause = ast.TryFinally(body=body, finalbody=[])
+            ast.copy_location(clause, node)
+            suite[-1] = clause
+            self.continuable[self.cur_indent] = None
+            self.next_suite = clause.finalbody
+        else:
+            self._syntax_error('unexpected %s' % (keyword,))
+
+    def _parse(self, source):
+        """Parse a line (or a line, in context), and number the resulting
+        statements with the current template line.
+        """
+        try:
+            statements = ast.parse(source).body
+        except SyntaxError as e:
+            self._syntax_error(e.msg)
+        for statement in statements:
+            self._locate(statement, 1)
+        return statements
+
+    def _parse_clause(self, keyword, line):
+        template, find_clause = CLAUSE_PARSERS[keyword]
+        try:
+            clause = find_clause(ast.parse(template % (line,)))
+        except SyntaxError as e:
+            self._syntax_error(e.msg)
+        self._locate(clause, clause.lineno)
+        return clause
+
+    def _locate(self, node, lineno):
+        """Renumber `node` and its children, which start on line `lineno`, with
+        the line in the template they come from.
+        """
+        offset = self.statement_pos.lineno - lineno
+        for child in ast.walk(node):
+            if 'lineno' in child._attributes:
+                child.lineno = getattr(child, 'lineno', lineno) + offset
+                child.col_offset = getattr(child, 'col_offset', 0)
+
+    def _take_decorators(self):
+        decorators, self.decorators = self.decorators, []
+        return decorators
+
+    def _refuse_decorators(self):
+        """Anything but a def or class after a decorator is a syntax error."""
+        if self.decorators:
+            self._syntax_error('decorator without a def or class')
+
+    def _syntax_error(self, msg, node=None):
+        lineno = node.lineno if node is not None else self.statement_pos.lineno
+        raise SyntaxError(msg, ('<template>', lineno, None, None))
+
 
 class EzioTemplateDriver(object):
     """Present an interface tailored for picking apart template files.
@@ -804,6 +1119,75 @@ class EzioTemplateDriver(object):
 
         self.head += line
 
+    def take_lines_without(self, regex):
+        """Read lines until one that `regex` matches, which becomes the head,
+        and return the lines before it. This reads in bulk what would
+        otherwise go through the head a line at a time.
+        """
+
+        assert self.head == '' and not self.in_directive_mode
+
+        lines = []
+        for line in iter(self.file.readline, ''):
+            if regex.search(line):
+                self.head = line
+                break
+            lines.append(line)
+        else:
+            self.done = True
+
+        self.pos = calculate_new_pos(''.join(lines), self.pos)
+        return lines
+
+    def read_more(self):
+        """Extend the head by a line; return whether there was one."""
+        length = len(self.head)
+        self.extend_head()
+        return len(self.head) > length
+
+    def balanced_prefix(self, chars):
+        """Return the shortest prefix ending with a char in `chars` that isn't
+        inside brackets, a string literal, or a comment, or None if the brackets
+        don't match or the input runs out first.
+
+        Finds in one pass the prefix that the callers of increasing_prefixes()
+        would get to by parsing each candidate in turn, when the Python in it is
+        valid; they still have to check that.
+        """
+
+        # skip straight to the characters that matter
+        regex = re.compile('[%s]' % (re.escape(BALANCED_PREFIX_CHARS + chars),))
+        closers = []
+        pos = 0
+        while True:
+            match = regex.search(self.head, pos)
+            if match is None:
+                pos = len(self.head)
+                if not self.read_more():
+                    return None
+                continue
+            pos = match.start()
+            char = self.head[pos]
+
+            if char in MATCHING_DELIMS:
+                closers.append(MATCHING_DELIMS[char])
+            elif char in CLOSING_DELIMS:
+                if not closers or closers.pop() != char:
+                    return None
+            elif char in '\'"' or (char == '#' and (closers or char not in chars)):
+                end = skip_string_or_comment(self.head, pos, self.done)
+                while end is None and self.read_more():
+                    end = skip_string_or_comment(self.head, pos, self.done)
+                if end is None or end < 0:
+                    return None
+                # continue from the end of the string or comment
+                pos = end
+                continue
+
+            pos += 1
+            if not closers and char in chars:
+                return self.head[:pos]
+
     def increasing_prefixes(self, chars):
         """Return increasing prefixes ending with a char in `chars`.
 
@@ -0,0 +1,274 @@
+"""
+Drives the C++ compiler and linker directly to build extension modules,
+with a persistent cache of object files.
+
+The compiler and flags are the ones Python itself was built with (as
+distutils would use them), read once from sysconfig. Objects are cached under
+a key covering the preprocessed source, the full compile command, and the
+compiler binary, so recompiling an unchanged translation unit (e.g., an
+unchanged class of a project) is a cache hit, wherever its source was
+regenerated: the directory of the source is left out of the file names in the
+preprocessor's linemarkers (including those from #line directives), so the
+same project in another checkout hits the cache too. (Debugging information
+in an object from the cache names the files where it was first compiled.)
+
+Builds can also use a named profile of optimization flags (BUILD_PROFILES),
+and profile-guided optimization: build_extension_with_pgo builds an
+instrumented module, runs a workload against it, then rebuilds it using the
+collected profile.
+
+The main entry points here are build_extension and build_extension_with_pgo.
+"""
+
+from __future__ import with_statement
+
+import distutils.spawn
+import distutils.sysconfig
+import hashlib
+import multiprocessing.pool
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+_dirname, _filename = os.path.split(__file__)
+EZIO_DIR = os.path.abspath(_dirname)
+
+# overrides the default location of the object cache:
+OBJECT_CACHE_ENV_VAR = 'EZIO_OBJECT_CACHE'
+DEFAULT_OBJECT_CACHE_DIR = os.path.join('~', '.cache', 'ezio', 'objects')
+
+# C-only flags in Python's CFLAGS, which g++ warns about:
+C_ONLY_FLAGS = frozenset(['-Wstrict-prototypes'])
+
+# profile name -> (extra compile args, extra link args); these follow Python's own CFLAGS,
+# so they override its -O option:
+BUILD_PROFILES = {
+    'default': ([], []),
+    'debug': (['-O0', '-g', '-UNDEBUG'], []),
+    'release': (['-O3'], []),
+    'size': (['-Os'], []),
+    'lto': (['-O3', '-flto'], ['-O3', '-flto']),
+}
+
+PGO_GENERATE_ARGS = ['-fprofile-generate']
+# -fprofile-correction tolerates the inconsistent counts that threaded workloads can produce:
+PGO_USE_ARGS = ['-fprofile-use', '-fprofile-correction', '-Wno-missing-profile']
+
+def _config_words(name):
+    return shlex.split(distutils.sysconfig.get_config_var(name) or '')
+
+class Toolchain(object):
+    """Compile and link commands for C++ extension modules."""
+
+    def __init__(self, profile='default', extra_compile_args=(), extra_link_args=()):
+        assert profile in BUILD_PROFILES, 'Unknown build profile %s' % (profile,)
+        profile_compile_args, profile_link_args = BUILD_PROFILES[profile]
+
+        cxx = os.environ.get('CXX') or distutils.sysconfig.get_config_var('CXX')
+        self.cxx = shlex.split(cxx)
+        self.compile_flags = [flag for flag in _config_words('CFLAGS') + _config_words('CCSHARED')
+            if flag not in C_ONLY_FLAGS]
+        self.compile_flags.extend(['-I' + distutils.sysconfig.get_python_inc(), '-I' + EZIO_DIR])
+        self.compile_flags.extend(profile_compile_args)
+        self.compile_flags.extend(extra_compile_args)
+
+        # LDSHARED is a whole command line, e.g., `gcc -shared ...`; link C++ with the C++ driver:
+        self.link_flags = _config_words('LDSHARED')[1:]
+        if distutils.sysconfig.get_config_var('Py_ENABLE_SHARED'):
+            self.link_flags.extend(['-L' + distutils.sysconfig.get_config_var('LIBDIR'),
+                '-lpython' + distutils.sysconfig.get_config_var('VERSION')])
+        self.link_flags.extend(profile_link_args)
+        self.link_flags.extend(extra_link_args)
+
+        self.extension_suffix = distutils.sysconfig.get_config_var('SO')
+        self._compiler_identity = None
+
+    def compiler_identity(self):
+        """Identify the compiler binary, so that upgrading it invalidates cached objects."""
+        if self._compiler_identity is None:
+            path = distutils.spawn.find_executable(self.cxx[0]) or self.cxx[0]
+            try:
+                stat = os.stat(path)
+                self._compiler_identity = '%s:%d:%d' % (path, stat.st_size, stat.st_mtime)
+            except OSError:
+                self._compiler_identity = path
+        return self._compiler_identity
+
+    def preprocess_command(self, source):
+        return self.cxx + self.compile_flags + ['-E', source]
+
+    def compile_command(self, source, object_file):
+        return self.cxx + self.compile_flags + ['-c', source, '-o', object_file]
+
+    def link_command(self, object_files, output):
+        return self.cxx + self.link_flags + list(object_files) + ['-o', output]
+
+class ObjectCache(object):
+    """Directory of compiled object files, named by their cache keys."""
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get(OBJECT_CACHE_ENV_VAR) or DEFAULT_OBJECT_CACHE_DIR
+        self.directory = os.path.expanduser(directory)
+
+    def path_for_key(self, key):
+        # fan out over subdirectories, as git does with loose objects:
+        return os.path.join(self.directory, key[:2], key[2:] + '.o')
+
+    def make_room_for(self, path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # somebody else (maybe another thread) got there first:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+def _temp_filename(filename):
+    """Scratch name next to `filename`, unique to this process and thread."""
+    return '%s.tmp.%d.%d' % (filename, os.getpid(), threading.current_thread().ident)
+
+def normalize_preprocessed(preprocessed, source):
+    """Remove the directory of `source` (as given, and as an absolute path)
+    from the file names in the linemarkers of its preprocessed output.
+    """
+    directories = set([os.path.dirname(os.path.abspath(source)), os.path.dirname(source)])
+    prefixes = '|'.join(re.escape(directory + os.sep) for directory in sorted(directories, reverse=True) if directory)
+    return re.sub(r'^(# \d+ ")(?:%s)' % (prefixes,), r'\1', preprocessed, flags=re.MULTILINE)
+
+def compile_source(toolchain, object_cache, source, object_dir=None):
+    """Compile `source` to an object file in the cache, unless it's already there;
+    or, if `object_dir` is given, compile it to `object_dir`, bypassing the cache.
+
+    Returns: report dict with the object file path, whether it was a cache hit,
+    and the time taken to preprocess and compile
+    """
+    start = time.time()
+    if object_dir is not None:
+        object_file = os.path.join(object_dir, os.path.splitext(os.path.basename(source))[0] + '.o')
+        subprocess.check_call(toolchain.compile_command(source, object_file))
+        return {
+            'source': source,
+            'object': object_file,
+            'cache_hit': False,
+            'preprocess_seconds': 0.0,
+            'compile_seconds': time.time() - start,
+        }
+
+    preprocessed = subprocess.check_output(toolchain.preprocess_command(source))
+    hasher = hashlib.sha1(normalize_preprocessed(preprocessed, source))
+    hasher.update(repr(toolchain.compile_flags))
+    hasher.update(toolchain.compiler_identity())
+    object_file = object_cache.path_for_key(hasher.hexdigest())
+    preprocessed_at = time.time()
+
+    cache_hit = os.path.exists(object_file)
+    if not cache_hit:
+        object_cache.make_room_for(object_file)
+        temp_object_file = _temp_filename(object_file)
+        try:
+            subprocess.check_call(toolchain.compile_command(source, temp_object_file))
+            # publish the object atomically, so concurrent builds never see a partial file:
+            os.rename(temp_object_file, object_file)
+        finally:
+            if os.path.exists(temp_object_file):
+                os.unlink(temp_object_file)
+
+    return {
+        'source': source,
+        'object': object_file,
+        'cache_hit': cache_hit,
+        'preprocess_seconds': preprocessed_at - start,
+        'compile_seconds': time.time() - preprocessed_at,
+    }
+
+def link_extension(toolchain, object_files, output):
+    """Link object files into an extension module; replaces `output` atomically."""
+    temp_output = _temp_filename(output)
+    try:
+        subprocess.check_call(toolchain.link_command(object_files, temp_output))
+        os.rename(temp_output, output)
+    finally:
+        if os.path.exists(temp_output):
+            os.unlink(temp_output)
+
+def build_extension(sources, output, toolchain=None, object_cache=None, jobs=None, object_dir=None):
+    """Compile C++ source files (in parallel, through the object cache unless
+    `object_dir` is given) and link them into the extension module `output`.
+
+    Returns: report dict with a list of per-source compile reports under 'compile',
+    and the time taken to link under 'link_seconds'
+    """
+    if toolchain is None:
+        toolchain = Toolchain()
+    if object_cache is None:
+        object_cache = ObjectCache()
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs > 1 and len(sources) > 1:
+        # the compiler runs in a subprocess, so threads are enough to run several at once:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(sources)))
+        try:
+            compile_reports = pool.map(lambda source: compile_source(toolchain, object_cache, source, object_dir),
+                sources)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        compile_reports = [compile_source(toolchain, object_cache, source, object_dir) for source in sources]
+
+    start = time.time()
+    link_extension(toolchain, [report['object'] for report in compile_reports], output)
+    return {
+        'compile': compile_reports,
+        'link_seconds': time.time() - start,
+    }
+
+def build_extension_with_pgo(sources, output, workload, profile='release', jobs=None):
+    """Build `output` with profile-guided optimization: build it instrumented,
+    run the command line `workload` (which should import and exercise `output`),
+    then rebuild it using the profile the workload produced.
+
+    The profile data is named after the object files, so both builds compile to
+    the same scratch directory rather than through the object cache.
+
+    Returns: report dict as for build_extension, with the reports of the
+    instrumented build under 'instrumented' and the time taken by the workload
+    under 'workload_seconds'
+    """
+    object_dir = tempfile.mkdtemp(prefix='ezio_pgo_')
+    try:
+        instrumented_report = build_extension(sources, output,
+            toolchain=Toolchain(profile, PGO_GENERATE_ARGS, PGO_GENERATE_ARGS),
+            jobs=jobs, object_dir=object_dir)
+
+        start = time.time()
+        subprocess.check_call(workload)
+        workload_seconds = time.time() - start
+
+        report = build_extension(sources, output, toolchain=Toolchain(profile, PGO_USE_ARGS),
+            jobs=jobs, object_dir=object_dir)
+    finally:
+        shutil.rmtree(object_dir)
+
+    report['instrumented'] = instrumented_report
+    report['workload_seconds'] = workload_seconds
+    return report
+
+def format_build_report(report):
+    """Render the report from build_extension as lines of text."""
+    lines = []
+    for compile_report in report['compile']:
+        lines.append('%s: preprocess %.2fs, compile %.2fs%s' % (compile_report['source'],
+            compile_report['preprocess_seconds'], compile_report['compile_seconds'],
+            ' (cached)' if compile_report['cache_hit'] else ''))
+    lines.append('link: %.2fs' % (report['link_seconds'],))
+    if 'instrumented' in report:
+        lines = ['instrumented ' + line for line in format_build_report(report['instrumented'])] + \
+            ['workload: %.2fs' % (report['workload_seconds'],)] + lines
+    return lines
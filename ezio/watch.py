@@ -0,0 +1,251 @@
+"""
+Watch mode: rebuild a project whenever its templates change, and hot-swap
+the rebuilt module into running processes.
+
+ProjectWatcher keeps the parsed templates and the generated code for every
+class in memory between builds. When templates change, only they and their
+subclasses (per the #extends graph) are parsed and compiled again; every class
+has registries of its own, so the code for the other classes stays valid and
+byte-identical, and their object files come straight out of the object cache.
+
+Extension modules can't be reloaded, so every build gets a new module name,
+templates_v<N>; a manifest file next to it names the latest build, and
+HotReloader (in the running process) imports that and swaps in its hooks.
+
+The main entry points here are watch and HotReloader.
+"""
+
+from __future__ import with_statement
+
+import copy
+import distutils.sysconfig
+import imp
+import json
+import os
+import sys
+import threading
+import time
+
+from . import builder
+from .builder import MODULE_NAME
+from .compiler import CodeGenerator, MAIN_FUNCTION_NAME
+
+MANIFEST_FILENAME = MODULE_NAME + '_manifest.json'
+
+EXTENSION_SUFFIX = distutils.sysconfig.get_config_var('SO')
+
+# builds older than this many versions are deleted:
+KEEP_VERSIONS = 2
+
+def _versioned_module_name(version):
+    return '%s_v%d' % (MODULE_NAME, version)
+
+def read_manifest(project_dir):
+    """Read the manifest describing the latest build of `project_dir`, or return None."""
+    try:
+        with open(os.path.join(project_dir, MANIFEST_FILENAME)) as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return None
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+class ProjectWatcher(object):
+    """Incrementally rebuilds a project directory."""
+
+    def __init__(self, project_dir, compiler_settings=None, jobs=None, profile='default'):
+        self.project_dir = project_dir
+        self.compiler_settings = compiler_settings
+        self.jobs, self.profile = jobs, profile
+
+        # continue the numbering of any earlier watcher, so that processes that imported
+        # its builds can tell ours apart:
+        manifest = read_manifest(project_dir)
+        self.version = manifest['version'] if manifest else 0
+        # classname -> (mtime, size) of the .tmpl file, at the time it was parsed:
+        self.class_to_stamp = {}
+        self.class_to_tree = {}
+        self.class_to_generator = {}
+        self.class_to_superclass = {}
+        # the stamps of all the .tmpl files when a rebuild last failed, if it did:
+        self.failed_stamps = None
+
+    def _stamps(self):
+        stamps = {}
+        for entry in os.listdir(self.project_dir):
+            if entry.endswith('.tmpl'):
+                classname, _, _ = entry.partition('.')
+                stamps[classname] = _file_stamp(os.path.join(self.project_dir, entry))
+        return stamps
+
+    def poll(self):
+        """Return the set of classes that were added, changed, or removed since the last
+        successful rebuild; or nothing, if no file has changed since a failed one.
+        """
+        stamps = self._stamps()
+        if stamps == self.failed_stamps:
+            return set()
+
+        changed = set(classname for classname, stamp in stamps.iteritems()
+            if self.class_to_stamp.get(classname) != stamp)
+        changed.update(set(self.class_to_stamp) - set(stamps))
+        return changed
+
+    def _descendants(self, classnames, class_to_superclass):
+        """All classes that extend any of `classnames`, directly or not, and those classes themselves."""
+        affected = set(classnames)
+        grew = True
+        while grew:
+            subclasses = set(classname for classname, superclass_name in class_to_superclass.iteritems()
+                if superclass_name in affected)
+            grew = not subclasses <= affected
+            affected |= subclasses
+        return affected
+
+    def rebuild(self, changed):
+        """Recompile the changed classes and their subclasses, and build a new version of the module.
+
+        Returns: the name of the new module, and the build report from builder.buildext
+
+        The watcher's state is only updated once the build succeeds, so a class
+        that failed to parse or compile counts as changed, along with everything
+        that changed with it, until it does.
+        """
+        stamps = self._stamps()
+        try:
+            return self._rebuild(changed)
+        except Exception:
+            self.failed_stamps = stamps
+            raise
+
+    def _rebuild(self, changed):
+        build_order, class_to_superclass = builder.produce_dependency_ordering(self.project_dir)
+        assert len(build_order) > 0, "Can't build empty project."
+
+        class_to_stamp = dict(self.class_to_stamp)
+        class_to_tree = dict(self.class_to_tree)
+        class_to_generator = dict(self.class_to_generator)
+
+        removed = set(class_to_tree) - set(build_order)
+        reparented = set(classname for classname in build_order if classname in class_to_tree
+            and class_to_superclass.get(classname) != self.class_to_superclass.get(classname))
+        if removed or reparented:
+            # the class hierarchy changed shape; start over
+            for classname in removed:
+                class_to_tree.pop(classname, None)
+                class_to_stamp.pop(classname, None)
+            class_to_generator.clear()
+
+        for classname in changed & set(build_order):
+            pathname = os.path.join(self.project_dir, classname + '.tmpl')
+            class_to_stamp[classname] = _file_stamp(pathname)
+            with open(pathname) as infile:
+                class_to_tree[classname] = builder.tmpl2moremeaningfulpy(classname, infile,
+                    compiler_settings=self.compiler_settings)
+
+        affected = self._descendants(changed, class_to_superclass) | (set(build_order) - set(class_to_generator))
+        for classname in build_order:
+            if classname not in affected:
+                continue
+            superclass_name = class_to_superclass.get(classname)
+            superclass_def = class_to_generator[superclass_name].class_definition if superclass_name else None
+            generator = CodeGenerator(superclass_definition=superclass_def, compiler_settings=self.compiler_settings,
+                template_filename=os.path.abspath(os.path.join(self.project_dir, classname + '.tmpl')))
+            # code generation mutates the tree, and we may need it again:
+            generator.visit(copy.deepcopy(class_to_tree[classname]))
+            class_to_generator[classname] = generator
+
+        version = self.version + 1
+        module_name = _versioned_module_name(version)
+        c_file_names = builder.write_project_files(self.project_dir, module_name,
+            [class_to_generator[classname] for classname in build_order],
+            shared_c_file_name=os.path.join(self.project_dir, module_name + '.cpp'))
+        build_report = builder.buildext(c_file_names, jobs=self.jobs, profile=self.profile)
+
+        self.version, self.failed_stamps = version, None
+        self.class_to_stamp, self.class_to_tree = class_to_stamp, class_to_tree
+        self.class_to_generator, self.class_to_superclass = class_to_generator, class_to_superclass
+        self._write_manifest(module_name, build_order)
+        self._remove_old_versions()
+        return module_name, build_report
+
+    def _write_manifest(self, module_name, classnames):
+        manifest = {
+            'version': self.version,
+            'module': module_name,
+            'filename': module_name + EXTENSION_SUFFIX,
+            'classes': classnames,
+        }
+        manifest_filename = os.path.join(self.project_dir, MANIFEST_FILENAME)
+        temp_filename = manifest_filename + '.tmp'
+        with open(temp_filename, 'w') as outfile:
+            json.dump(manifest, outfile)
+        # readers see either the old manifest or the new one:
+        os.rename(temp_filename, manifest_filename)
+
+    def _remove_old_versions(self):
+        for version in xrange(1, self.version - KEEP_VERSIONS + 1):
+            base_name = os.path.join(self.project_dir, _versioned_module_name(version))
+            for filename in (base_name + '.cpp', base_name + EXTENSION_SUFFIX):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+def watch(project_dir, poll_interval=0.5, compiler_settings=None, jobs=None, profile='default', out=sys.stderr):
+    """Rebuild `project_dir` every time its templates change, forever."""
+    watcher = ProjectWatcher(project_dir, compiler_settings=compiler_settings, jobs=jobs, profile=profile)
+    while True:
+        changed = watcher.poll()
+        if changed:
+            start = time.time()
+            try:
+                module_name, build_report = watcher.rebuild(changed)
+            except Exception, e:
+                # keep serving the last good build; the next change will trigger another attempt
+                print >>out, '** build failed: %s: %s **' % (e.__class__.__name__, e)
+            else:
+                recompiled = [report['source'] for report in build_report['compile'] if not report['cache_hit']]
+                print >>out, '** built %s in %.2fs (changed: %s; recompiled: %s) **' % (module_name,
+                    time.time() - start, ', '.join(sorted(changed)), ', '.join(recompiled))
+        time.sleep(poll_interval)
+
+class HotReloader(object):
+    """Renders templates from the latest build of a watched project,
+    switching to new builds as they appear.
+    """
+
+    def __init__(self, project_dir, check_interval=1.0):
+        self.project_dir = project_dir
+        self.check_interval = check_interval
+        self.version = None
+        self.module = None
+        # class name -> respond hook; replaced wholesale, never mutated:
+        self.hooks = {}
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    def reload_if_changed(self):
+        """Import the latest build, if it's newer than the current one. Returns whether it was."""
+        with self._lock:
+            self._last_check = time.time()
+            manifest = read_manifest(self.project_dir)
+            if manifest is None or manifest['version'] == self.version:
+                return False
+
+            module = imp.load_dynamic(str(manifest['module']), os.path.join(self.project_dir, manifest['filename']))
+            hooks = dict((classname, getattr(module, '%s_%s' % (classname, MAIN_FUNCTION_NAME)))
+                for classname in manifest['classes'])
+            # single assignments, so concurrent renders see either the old hooks or the new ones:
+            self.module = module
+            self.hooks = hooks
+            self.version = manifest['version']
+            return True
+
+    def get_hook(self, class_name):
+        if time.time() - self._last_check >= self.check_interval:
+            self.reload_if_changed()
+        return self.hooks[class_name]
+
+    def respond(self, class_name, display, self_ptr=None):
+        return self.get_hook(class_name)(display, self_ptr)
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+"""
+Tests for ezio.batch, which renders across a pool of worker processes.
+"""
+
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+
+import testify
+from testify import teardown
+from testify.assertions import assert_equal, assert_raises
+
+from ezio import batch
+from tools.tests.test_case import EZIOTestCase
+from tools.tests.simple import display, make_bag
+
+displays = [display, {'bags': []}, {'bags': [make_bag()]}] * 10
+
+class TestCase(EZIOTestCase):
+
+    target_template = 'simple'
+
+    def get_display(self):
+        return display
+
+    @teardown
+    def remove_tempdir(self):
+        if getattr(self, 'tempdir', None):
+            shutil.rmtree(self.tempdir)
+
+    def test(self):
+        expected_results = [self.responder(item, None) for item in displays]
+        results = batch.render(self.template_module, 'simple', iter(displays),
+                processes=2, chunk_size=4, max_in_flight=2)
+        assert_equal(list(results), expected_results)
+
+    def test_render_to_files(self):
+        self.tempdir = tempfile.mkdtemp()
+        paths_and_displays = [(os.path.join(self.tempdir, '%d.html' % (i,)), item)
+                for i, item in enumerate(displays)]
+        # by name; compile_string has already imported it under that name:
+        paths = batch.render_to_files(self.template_module.__name__, 'simple', paths_and_displays,
+                processes=2, chunk_size=7)
+        assert_equal(list(paths), [path for path, _ in paths_and_displays])
+
+        for path, item in paths_and_displays:
+            with open(path) as infile:
+                assert_equal(infile.read(), self.responder(item, None))
+
+    def test_missing_template(self):
+        # raised before any worker starts, rather than hanging the pool:
+        assert_raises(ImportError, batch.render, 'tools.templates.no_such_template', 'simple', displays)
+        assert_raises(AttributeError, batch.render_to_files, self.template_module, 'no_such_class', [])
+
+    def test_missing_template_in_worker(self):
+        # a worker that can't import the template fails the task, not the pool:
+        chunks = batch._map_chunks(batch._render_chunk, 'tools.templates.no_such_template', 'simple',
+                displays, 2, 4, None, None)
+        assert_raises(ImportError, list, chunks)
+
+    def test_exception(self):
+        results = batch.render(self.template_module, 'simple', [display, {}], processes=2)
+        assert_raises(KeyError, list, results)
+
+if __name__ == '__main__':
+    testify.run()
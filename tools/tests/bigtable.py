@@ -1,4 +1,5 @@
 import testify
+from testify.assertions import assert_equal, assert_gt
 
 from tools.tests.test_case import EZIOTestCase
 
@@ -25,5 +26,17 @@ class TestCase(EZIOTestCase):
     def get_refcountables(self):
         return [display, display['table'], display.keys()[0]]
 
+    def test_render_history(self):
+        # the module may have been imported (and used) by an earlier test:
+        initial_renders = self.template_module.render_history()['bigtable']['renders']
+        self.run_templating(quiet=True)
+        self.run_templating(quiet=True)
+        history = self.template_module.render_history()['bigtable']
+        assert_equal(history['renders'], initial_renders + 2)
+        # the output is the same every time, so the estimates should be exact:
+        assert_equal(history['length'], len(self.result))
+        assert_gt(history['fragments'], len(display['table']))
+        assert_equal(sorted(history), ['fragments', 'length', 'renders'])
+
 if __name__ == '__main__':
     testify.run()
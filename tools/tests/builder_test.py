@@ -0,0 +1,299 @@
+#!/usr/bin/python
+
+from __future__ import with_statement
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import testify
+from testify import assert_equal, assert_in, assert_not_equal
+
+from ezio import builder
+from ezio import toolchain
+from ezio.constants import CompilerSettings
+
+class ProjectCopyTestCase(testify.TestCase):
+    """Base class for tests that work on a scratch copy of a project."""
+
+    thisdir = os.path.dirname(__file__)
+    project_source = os.path.join(thisdir, '..', 'templates', 'simple_classes')
+
+    @testify.setup
+    def copy_project(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tempdir, 'simple_classes')
+        shutil.copytree(self.project_source, self.project_dir)
+
+    @testify.teardown
+    def remove_project(self):
+        shutil.rmtree(self.tempdir)
+
+    def _append(self, classname, text):
+        with open(os.path.join(self.project_dir, classname + '.tmpl'), 'a') as outfile:
+            outfile.write(text)
+
+class BuildKeyTest(ProjectCopyTestCase):
+    """Test the content hashes that decide whether a build can be skipped."""
+
+    def test_superclass_changes_propagate(self):
+        keys = builder.class_build_keys(self.project_dir)
+        assert_equal(builder.class_build_keys(self.project_dir), keys)
+
+        self._append('simple_superclass', 'one more line\n')
+        new_keys = builder.class_build_keys(self.project_dir)
+        assert_not_equal(new_keys['simple_superclass'], keys['simple_superclass'])
+        assert_not_equal(new_keys['simple_subclass'], keys['simple_subclass'])
+
+        keys = new_keys
+        self._append('simple_subclass', 'one more line\n')
+        new_keys = builder.class_build_keys(self.project_dir)
+        assert_equal(new_keys['simple_superclass'], keys['simple_superclass'])
+        assert_not_equal(new_keys['simple_subclass'], keys['simple_subclass'])
+
+    def test_settings_change_key(self):
+        settings = CompilerSettings()
+        key = builder.target_build_key(self.project_dir, settings)
+        settings.use_variadic_path_resolution = not settings.use_variadic_path_resolution
+        assert_not_equal(builder.target_build_key(self.project_dir, settings), key)
+
+    def test_is_up_to_date(self):
+        key = builder.target_build_key(self.project_dir)
+        # no extension module yet:
+        assert not builder.is_up_to_date(self.project_dir, key)
+
+        open(builder.target_to_extension_filename(self.project_dir), 'w').close()
+        assert not builder.is_up_to_date(self.project_dir, key)
+        builder.record_build(self.project_dir, key)
+        assert builder.is_up_to_date(self.project_dir, key)
+
+        self._append('simple_subclass', 'one more line\n')
+        assert not builder.is_up_to_date(self.project_dir, builder.target_build_key(self.project_dir))
+
+class SplitBuildTest(ProjectCopyTestCase):
+    """Test that projects are generated as one C++ file per class."""
+
+    def test_build_project(self):
+        c_file_names = builder.build_project(self.project_dir)
+        assert_equal(c_file_names, builder.project_dirname_to_c_filenames(self.project_dir))
+        assert_equal(sorted(os.path.basename(name) for name in c_file_names),
+            ['templates.cpp', 'templates_simple_subclass.cpp', 'templates_simple_superclass.cpp'])
+        assert os.path.exists(builder.project_dirname_to_header_filename(self.project_dir))
+
+        for classname in ('simple_superclass', 'simple_subclass'):
+            with open(builder.project_class_to_c_filename(self.project_dir, classname)) as infile:
+                class_code = infile.read()
+            assert '#include "templates_%s.h"' % (classname,) in class_code
+            assert '%s_respond(PyObject *self' % (classname,) in class_code
+
+        # each class header includes its superclass's, and the root header is at the top:
+        [subclass_header, superclass_header] = self._read_files([
+            builder.project_class_to_header_filename(self.project_dir, classname)
+            for classname in ('simple_subclass', 'simple_superclass')])
+        assert_in('#include "templates_simple_superclass.h"', subclass_header)
+        assert_in('#include "templates.h"', superclass_header)
+
+    def test_edits_stay_in_their_class(self):
+        """An edit to a subclass leaves its superclass's object file in the cache."""
+        object_cache = toolchain.ObjectCache(os.path.join(self.tempdir, 'objects'))
+        superclass_c_file = builder.project_class_to_c_filename(self.project_dir, 'simple_superclass')
+        builder.buildext(builder.build_project(self.project_dir), object_cache=object_cache)
+
+        # new literals, paths, and methods:
+        self._append('simple_subclass', '#def footer($page)\nPage $page.number of $page.total\n#end def\n')
+        build_report = builder.buildext(builder.build_project(self.project_dir), object_cache=object_cache)
+        cache_hits = dict((report['source'], report['cache_hit']) for report in build_report['compile'])
+        assert cache_hits[superclass_c_file]
+        assert not cache_hits[builder.project_class_to_c_filename(self.project_dir, 'simple_subclass')]
+
+    def test_build_stats(self):
+        stats = builder.BuildStats()
+        c_file_names = builder.build_project(self.project_dir, stats=stats)
+
+        assert_equal(sorted(stats.template_phases), ['simple_subclass', 'simple_superclass'])
+        for phases in stats.template_phases.itervalues():
+            assert_equal(sorted(phases), ['codegen', 'py2moremeaningfulpy', 'tmpl2ast'])
+        assert_in('get_lines', stats.module_phases)
+        for c_file_name in c_file_names:
+            with open(c_file_name) as infile:
+                assert_equal(stats.c_file_lines[c_file_name], len(infile.read().split('\n')))
+        assert stats.registry_sizes['literals'] > 0
+        assert_equal(sorted(stats.report()), ['c_file_lines', 'module', 'registries', 'templates'])
+
+        # nothing changed, but every class is measured again if asked:
+        stats = builder.BuildStats()
+        c_file_names = builder.build_project(self.project_dir, stats=stats, reuse_classes=False)
+        assert_equal(sorted(stats.template_phases), ['simple_subclass', 'simple_superclass'])
+        assert stats.registry_sizes['literals'] > 0
+        # and compiled again, rather than taken from the object cache:
+        object_dir = os.path.join(self.tempdir, 'objects')
+        os.mkdir(object_dir)
+        build_report = builder.buildext(c_file_names, object_dir=object_dir)
+        assert not any(report['cache_hit'] for report in build_report['compile'])
+
+    def _forget_classes(self):
+        """Make the next build compile every class again."""
+        for classname in ('simple_superclass', 'simple_subclass'):
+            os.unlink(builder.project_class_to_summary_filename(self.project_dir, classname))
+
+    def _generated_files(self):
+        return self._read_files([builder.project_dirname_to_header_filename(self.project_dir)] +
+            [builder.project_class_to_header_filename(self.project_dir, classname)
+                for classname in ('simple_superclass', 'simple_subclass')] +
+            builder.project_dirname_to_c_filenames(self.project_dir))
+
+    def test_unchanged_classes_are_reused(self):
+        """Only changed classes, and their subclasses, are parsed and compiled again."""
+        builder.build_project(self.project_dir)
+        self._append('simple_subclass', '#def footer($page)\nPage $page.number\n#end def\n')
+        stats = builder.BuildStats()
+        builder.build_project(self.project_dir, stats=stats)
+        assert_equal(sorted(stats.template_phases), ['simple_subclass'])
+
+        # the same code as compiling everything:
+        code = self._generated_files()
+        self._forget_classes()
+        builder.build_project(self.project_dir)
+        assert_equal(self._generated_files(), code)
+
+        self._append('simple_superclass', 'one more line\n')
+        stats = builder.BuildStats()
+        builder.build_project(self.project_dir, stats=stats)
+        assert_equal(sorted(stats.template_phases), ['simple_subclass', 'simple_superclass'])
+
+        # nor is a C file that something else has rewritten since:
+        with open(builder.project_class_to_c_filename(self.project_dir, 'simple_subclass'), 'a') as outfile:
+            outfile.write('\n')
+        stats = builder.BuildStats()
+        builder.build_project(self.project_dir, stats=stats)
+        assert_equal(sorted(stats.template_phases), ['simple_subclass'])
+
+    def _read_files(self, filenames):
+        contents = []
+        for filename in filenames:
+            with open(filename) as infile:
+                contents.append(infile.read())
+        return contents
+
+    def test_parallel_parse(self):
+        """Parsing in a process pool generates the same code as parsing serially."""
+        header_name = builder.project_dirname_to_header_filename(self.project_dir)
+        c_file_names = builder.build_project(self.project_dir, jobs=1)
+        serial_code = self._read_files([header_name] + c_file_names)
+
+        self._forget_classes()
+        stats = builder.BuildStats()
+        builder.build_project(self.project_dir, stats=stats, jobs=2)
+        assert_equal(self._read_files([header_name] + c_file_names), serial_code)
+        assert_equal(sorted(stats.template_phases['simple_subclass']), ['codegen', 'py2moremeaningfulpy', 'tmpl2ast'])
+
+    def test_line_directives(self):
+        """Each class's code is attributed to its template's lines, and the rest to the C file itself."""
+        c_file_names = builder.build_project(self.project_dir)
+        template_name = os.path.abspath(os.path.join(self.project_dir, 'simple_subclass.tmpl'))
+        c_file_name = builder.project_class_to_c_filename(self.project_dir, 'simple_subclass')
+        code = self._read_files(c_file_names)
+        [class_code] = self._read_files([c_file_name])
+        lines = class_code.split('\n')
+
+        # the #def on line 2 of the template, and the placeholder on line 9:
+        def_index = lines.index('#line 2 "%s"' % (template_name,))
+        assert lines[def_index + 1].startswith('PyObject* simple_subclass::ezio(')
+        assert_in('#line 9 "%s"' % (template_name,), lines)
+        for index, line in enumerate(lines):
+            if line.startswith('#line') and line.endswith('.cpp"'):
+                assert_equal(line, '#line %d "%s"' % (index + 2, os.path.abspath(c_file_name)))
+
+        # the text frontend numbers the same lines:
+        settings = CompilerSettings()
+        settings.direct_ast_frontend = False
+        builder.build_project(self.project_dir, compiler_settings=settings)
+        assert_equal(self._read_files(c_file_names), code)
+
+        settings.line_directives = False
+        builder.build_project(self.project_dir, compiler_settings=settings)
+        [class_code] = self._read_files([c_file_name])
+        assert '#line' not in class_code
+
+class CompileStringTest(testify.TestCase):
+    """Test compiling templates from strings, through the module cache."""
+
+    source = '#for $i in range(3)\nline $i\n#end for\n'
+
+    @testify.setup
+    def make_cache_dir(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    @testify.teardown
+    def remove_cache_dir(self):
+        for module_name in list(sys.modules):
+            if module_name.startswith('from_string_'):
+                del sys.modules[module_name]
+        shutil.rmtree(self.cache_dir)
+
+    def _module_dirs(self):
+        return [entry for entry in os.listdir(self.cache_dir) if os.path.isdir(os.path.join(self.cache_dir, entry))]
+
+    def test_concurrent_compiles(self):
+        # a source no other test compiles, so nothing is cached in this process:
+        source = self.source + '%s\n' % (self.cache_dir,)
+        modules = []
+        threads = [threading.Thread(target=lambda: modules.append(builder.compile_string(source, 'from_string',
+            cache_dir=self.cache_dir))) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_equal(len(modules), 4)
+        assert all(module is modules[0] for module in modules)
+        assert_equal(len(self._module_dirs()), 1)
+        assert_in('line 2', modules[0].from_string_respond({}, None))
+
+        # another process finds the module in the cache, rather than building it:
+        [module_dir] = self._module_dirs()
+        mtime = os.stat(os.path.join(self.cache_dir, module_dir)).st_mtime
+        subprocess.check_call([sys.executable, '-c', 'import sys; from ezio import compile_string; '
+            'compile_string(sys.argv[1], "from_string", cache_dir=sys.argv[2])', source, self.cache_dir])
+        assert_equal(self._module_dirs(), [module_dir])
+        assert_equal(os.stat(os.path.join(self.cache_dir, module_dir)).st_mtime, mtime)
+        # and nobody left their lock file behind:
+        assert_equal(os.listdir(self.cache_dir), [module_dir])
+
+    def test_same_name(self):
+        """Different sources compiled under one name are different modules, apart from any other."""
+        first = builder.compile_string('first $x\n', 'from_string', cache_dir=self.cache_dir)
+        second = builder.compile_string('second $x\n', 'from_string', cache_dir=self.cache_dir)
+        assert first is not second
+        assert_equal(first.from_string_respond({'x': 1}, None), 'first 1\n')
+        assert_equal(second.from_string_respond({'x': 1}, None), 'second 1\n')
+        assert 'from_string' not in sys.modules
+
+        # a template named after a module leaves the module alone:
+        json_module = sys.modules.get('json')
+        builder.compile_string('$x\n', 'json', cache_dir=self.cache_dir)
+        assert sys.modules.get('json') is json_module
+
+    def _compile_in_subprocess(self, source):
+        subprocess.check_call([sys.executable, '-c', 'import sys; from ezio import compile_string; '
+            'assert "line 2" in compile_string(sys.argv[1], "from_string", cache_dir=sys.argv[2]).from_string_respond({}, None)',
+            source, self.cache_dir])
+
+    def test_partial_module_dir(self):
+        """A module directory left without its module is rebuilt."""
+        source = self.source + '%s\n' % (self.cache_dir,)
+        self._compile_in_subprocess(source)
+        [module_dir] = self._module_dirs()
+        module_dir = os.path.join(self.cache_dir, module_dir)
+        [module_file] = [entry for entry in os.listdir(module_dir) if entry.endswith('.so')]
+        os.unlink(os.path.join(module_dir, module_file))
+
+        self._compile_in_subprocess(source)
+        assert_in(module_file, os.listdir(module_dir))
+        assert_equal(os.listdir(self.cache_dir), [os.path.basename(module_dir)])
+
+if __name__ == '__main__':
+    testify.run()
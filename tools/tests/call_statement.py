@@ -34,7 +34,8 @@ class TestCase(EZIOTestCase):
 
         assert_equal(self.lines,
                 ['<div>', 'hi from baltimore', '</div>',
-                 '<p>', "to king's landing!", '</p>'])
+                 '<p>', "to king's landing!", '</p>',
+                 '<ul>', '<li>', '<b>', 'nested in baltimore', '</b>', '</li>', '</ul>'])
 
 if __name__ == '__main__':
     testify.run()
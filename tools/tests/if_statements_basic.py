@@ -22,6 +22,8 @@ display = {
 class TestCase(EZIOTestCase):
 
     target_template = 'if_statements_basic'
+    # keep bin/ezio's single-file path covered:
+    build_with_ezio = True
     num_stress_test_iterations = 100
 
     def get_display(self):
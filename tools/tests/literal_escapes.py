@@ -0,0 +1,28 @@
+#!/usr/bin/python
+
+import testify
+from testify import assert_equal
+
+from tools.tests.test_case import EZIOTestCase
+
+display = {'name': 'literal_escapes'}
+
+class TestCase(EZIOTestCase):
+    """Test that literals survive being packed into a C string, byte for byte."""
+
+    target_template = 'literal_escapes'
+
+    def get_display(self):
+        return display
+
+    def test(self):
+        super(TestCase, self).test()
+        assert_equal(self.lines, [
+            'Question?? marks??= and "double" and \'single\' quotes',
+            '\ttab-indented line',
+            'caf\xc3\xa9 1234 after an octal escape',
+            'literal_escapes',
+        ])
+
+if __name__ == '__main__':
+    testify.run()
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import testify
+from testify import assert_equal, assert_in
+
+from ezio.loader import TemplateLoader
+from tools.tests.simple import display
+
+class TemplateLoaderTest(testify.TestCase):
+    """Test that templates are imported on first use, or by preload."""
+
+    thisdir = os.path.dirname(__file__)
+    template_source = os.path.join(thisdir, '..', 'templates', 'simple.tmpl')
+
+    @testify.setup
+    def build_private_copy(self):
+        # build under a name no other test imports, so we can watch it being imported:
+        self.tempdir = tempfile.mkdtemp()
+        shutil.copy(self.template_source, os.path.join(self.tempdir, 'loader_simple.tmpl'))
+        subprocess.check_call(['bin/ezio', os.path.join(self.tempdir, 'loader_simple.tmpl')])
+        sys.path.insert(0, self.tempdir)
+
+        self.loader = TemplateLoader()
+        self.loader.register('loader_simple', 'loader_simple')
+
+    @testify.teardown
+    def remove_private_copy(self):
+        sys.path.remove(self.tempdir)
+        sys.modules.pop('loader_simple', None)
+        shutil.rmtree(self.tempdir)
+
+    def test_lazy_import(self):
+        assert 'loader_simple' not in sys.modules
+        assert not self.loader.is_loaded('loader_simple')
+
+        result = self.loader.respond('loader_simple', display)
+        assert 'loader_simple' in sys.modules
+        assert self.loader.is_loaded('loader_simple')
+        assert_in('<html>', result)
+        assert_equal(self.loader.respond_many('loader_simple', [display, display]), [result, result])
+
+    def test_preload(self):
+        thread = self.loader.preload(['loader_simple'])
+        thread.join()
+        assert self.loader.is_loaded('loader_simple')
+
+if __name__ == '__main__':
+    testify.run()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+import json
+
+import testify
+from testify.assertions import assert_equal, assert_raises
+
+from ezio.constants import CompilerSettings
+from tools.tests.test_case import EZIOTestCase
+
+class Address(object):
+
+    def __init__(self, city):
+        self.city = city
+
+class User(object):
+
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+
+display = {
+    'title': 'Users',
+    'users': [
+        {'name': 'ezio', 'address': Address('Florence')},
+        User('altair', {'city': 'Masyaf'}),
+    ],
+}
+
+settings = CompilerSettings()
+settings.lookup_telemetry = True
+
+class TestCase(EZIOTestCase):
+
+    target_template = 'lookup_telemetry'
+
+    compiler_settings = settings
+
+    def get_display(self):
+        return display
+
+    def get_refcountables(self):
+        return [display, display['users']]
+
+    def _sites(self):
+        return dict((site['name'], site) for site in self.template_module.lookup_stats())
+
+    def test_lookup_stats(self):
+        self.template_module.reset_lookup_stats()
+        self.run_templating(quiet=True)
+
+        sites = self._sites()
+        assert_equal(sorted(sites), ['title', 'user.address', 'user.address.city', 'user.name', 'users'])
+        title = sites['title']
+        assert_equal((title['kind'], title['line'], title['dict_hits'], title['misses']), ('display', 1, 1, 0))
+        assert_equal(title['types'], ['dict'])
+
+        name = sites['user.name']
+        assert_equal((name['kind'], name['line'], name['dict_hits'], name['attr_hits']), ('path', 3, 1, 1))
+        assert_equal(sorted(name['types']), ['User', 'dict'])
+        city = sites['user.address.city']
+        assert_equal((city['dict_hits'], city['attr_hits'], city['misses']), (1, 1, 0))
+        assert_equal(sorted(city['types']), ['Address', 'dict'])
+
+        # a path that's missing counts as a miss, and raises as ever:
+        broken_display = dict(display, users=[User('connor', None)])
+        assert_raises(AttributeError, self.responder, broken_display, None)
+        assert_equal(self._sites()['user.address.city']['misses'], 1)
+        assert_raises(KeyError, self.responder, {}, None)
+        assert_equal(self._sites()['title']['misses'], 1)
+
+        # the report is ready to be logged:
+        assert_equal(json.loads(json.dumps(self.template_module.lookup_stats())), self.template_module.lookup_stats())
+
+        self.template_module.reset_lookup_stats()
+        for site in self.template_module.lookup_stats():
+            assert_equal((site['dict_hits'], site['attr_hits'], site['misses'], site['types']), (0, 0, 0, []))
+
+if __name__ == '__main__':
+    testify.run()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+import testify
+from testify.assertions import assert_equal, assert_in, assert_raises
+
+from ezio import compile_string
+from ezio.constants import CompilerSettings
+from ezio.loader import TemplateLoader
+from tools.tests.test_case import EZIOTestCase, MODULE_CACHE_DIR
+
+class Address(object):
+
+    def __init__(self, city):
+        self.city = city
+
+class User(object):
+
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+
+class BrokenUser(object):
+
+    @property
+    def name(self):
+        raise ValueError('not a missing attribute')
+
+display = {
+    'users': [
+        {'name': 'ezio', 'address': Address('Florence')},
+        User('altair', None),
+        {'address': {'city': 'Paris'}},
+    ],
+}
+
+settings = CompilerSettings()
+settings.default_missing_lookups = True
+
+class TestCase(EZIOTestCase):
+
+    target_template = 'missing_lookups'
+
+    compiler_settings = settings
+
+    def get_display(self):
+        return display
+
+    def get_refcountables(self):
+        return [display, display['users']]
+
+    def test_defaults(self):
+        self.template_module.drain_missing_lookups()
+        self.run_templating(quiet=True)
+
+        assert_equal(self.result.split('\n')[:4], ['<h1></h1>', '<p>ezio: Florence</p>', '<p>altair: </p>', '<p>: Paris</p>'])
+        misses, lost = self.template_module.drain_missing_lookups()
+        assert_equal(misses, [('missing_lookups', 1, 'title'), ('missing_lookups', 3, 'user.address.city'),
+            ('missing_lookups', 3, 'user.name')])
+        assert_equal(lost, 0)
+        assert_equal(self.template_module.drain_missing_lookups(), ([], 0))
+
+    def test_errors_still_raise(self):
+        assert_raises(ValueError, self.responder, {'users': [BrokenUser()]}, None)
+
+    def test_overflow(self):
+        self.template_module.drain_missing_lookups()
+        for _ in xrange(1100):
+            self.responder({'users': []}, None)
+        self.responder({'users': [], 'title': 'last'}, None)
+        self.responder({'users': [{}]}, None)
+
+        misses, lost = self.template_module.drain_missing_lookups()
+        # only the most recent misses are kept:
+        assert_equal(len(misses) + lost, 1103)
+        assert lost > 0
+        assert_equal(misses[-3:], [('missing_lookups', 1, 'title'), ('missing_lookups', 3, 'user.name'), ('missing_lookups', 3, 'user.address.city')])
+
+    def test_loader(self):
+        self.template_module.drain_missing_lookups()
+        loader = TemplateLoader()
+        loader.register('missing_lookups', self.template_module.__name__)
+        loader.respond('missing_lookups', {'users': [{}]})
+
+        class Logger(object):
+            messages = []
+            def warning(self, message, *args):
+                self.messages.append(message % args)
+
+        logger = Logger()
+        assert_equal(loader.log_missing_lookups(logger), 3)
+        assert_equal(logger.messages[0], 'missing lookup of title in missing_lookups, line 1')
+        assert_equal(loader.log_missing_lookups(logger), 0)
+
+    def test_custom_default(self):
+        custom_settings = CompilerSettings()
+        custom_settings.default_missing_lookups = True
+        custom_settings.missing_lookup_default = '?'
+        with open('tools/templates/missing_lookups.tmpl') as infile:
+            module = compile_string(infile.read(), 'missing_lookups_custom', compiler_settings=custom_settings,
+                cache_dir=MODULE_CACHE_DIR)
+        assert_in('<h1>?</h1>', module.missing_lookups_custom_respond({'users': []}, None))
+
+if __name__ == '__main__':
+    testify.run()
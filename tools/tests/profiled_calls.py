@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import time
+
+import testify
+from testify.assertions import assert_equal, assert_gt, assert_gte
+
+from ezio.constants import CompilerSettings
+from tools.tests.test_case import EZIOTestCase
+
+class Item(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def price(self):
+        # an expensive property, e.g. one that queries the database:
+        time.sleep(0.001)
+        return '9.99'
+
+def footer(total):
+    return '<p>%d items</p>' % (total,)
+
+display = {'items': [Item('ezio'), Item('altair')], 'footer': footer}
+
+settings = CompilerSettings()
+settings.profile = True
+
+class TestCase(EZIOTestCase):
+
+    target_template = 'profiled_calls'
+
+    compiler_settings = settings
+
+    def get_display(self):
+        return display
+
+    def get_refcountables(self):
+        return [display, display['items']]
+
+    def test_profile(self):
+        self.template_module.reset_profile()
+        self.run_templating(quiet=True)
+
+        report = self.template_module.profile()
+        # slowest first:
+        assert_equal([row['self_ns'] for row in report], sorted((row['self_ns'] for row in report), reverse=True))
+        rows = dict(((row['kind'], row['name']), row) for row in report)
+        assert_equal(sorted(rows), [('call', 'footer'), ('call', 'item.price'), ('call', 'len'),
+            ('def', 'respond'), ('def', 'row')])
+        for row in report:
+            assert_equal(row['template'], 'profiled_calls')
+
+        price = rows['call', 'item.price']
+        assert_equal((price['line'], price['calls']), (2, 2))
+        assert_gte(price['inclusive_ns'], 2 * 1000000)
+        assert_equal(price['self_ns'], price['inclusive_ns'])
+        assert_equal(report[0], price)
+
+        row = rows['def', 'row']
+        assert_equal((row['line'], row['calls']), (1, 2))
+        # the method's own time leaves out the callables it calls:
+        assert_equal(row['self_ns'], row['inclusive_ns'] - price['inclusive_ns'])
+        respond = rows['def', 'respond']
+        assert_equal(respond['calls'], 1)
+        assert_gt(respond['inclusive_ns'], row['inclusive_ns'])
+
+        self.template_module.reset_profile()
+        assert all(row['calls'] == 0 for row in self.template_module.profile())
+
+if __name__ == '__main__':
+    testify.run()
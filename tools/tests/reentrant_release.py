@@ -0,0 +1,39 @@
+#!/usr/bin/python
+
+import testify
+from testify.assertions import assert_equal
+
+from tools.tests.test_case import EZIOTestCase
+
+class Fragment(str):
+    """Output that renders the template again, twice over, when it's freed."""
+
+    responder = None
+
+    def __del__(self):
+        if self.responder is not None:
+            render_inner = lambda: self.responder({'fragment': lambda: 'innermost'}, None)
+            self.responder({'fragment': render_inner}, None)
+
+class TestCase(EZIOTestCase):
+    """Fragments freed while a transaction is released can render the same
+    class, and fill its pool, without overrunning it.
+    """
+
+    target_template = 'reentrant_release'
+
+    def get_display(self):
+        def fragment():
+            result = Fragment('outer')
+            result.responder = self.responder
+            return result
+        return {'fragment': fragment}
+
+    def test(self):
+        for _ in xrange(5):
+            self.run_templating(quiet=True)
+            assert_equal(self.result, 'outer\n')
+        assert_equal(self.responder({'fragment': lambda: 'plain'}, None), 'plain\n')
+
+if __name__ == '__main__':
+    testify.run()
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+import testify
+from testify.assertions import assert_equal, assert_gt, assert_gte
+
+from ezio import compile_string
+from ezio.constants import CompilerSettings
+from tools.tests.test_case import EZIOTestCase, MODULE_CACHE_DIR
+
+display = {'names': ['ezio', 'altair', 'connor']}
+
+settings = CompilerSettings()
+settings.render_stats = True
+
+class TestCase(EZIOTestCase):
+
+    target_template = 'render_stats'
+
+    compiler_settings = settings
+
+    def get_display(self):
+        return display
+
+    def get_refcountables(self):
+        return [display, display['names']]
+
+    def test_stats(self):
+        self.template_module.reset_stats()
+        assert_equal(self.template_module.stats()['render_stats']['renders'], 0)
+
+        self.run_templating(quiet=True)
+        self.run_templating(quiet=True)
+        self.template_module.render_stats_respond_many([display] * 3, None)
+
+        stats = self.template_module.stats()['render_stats']
+        assert_equal(stats['renders'], 5)
+        assert_equal(stats['length'], 5 * len(self.result))
+        # the output of the #def counts too, a fragment or more per name:
+        assert_gt(stats['fragments'], 5 * len(display['names']))
+        assert_gt(stats['max_ns'], 0)
+        assert_gte(stats['total_ns'], stats['max_ns'])
+
+        self.template_module.reset_stats()
+        assert_equal(self.template_module.stats()['render_stats'],
+            dict(renders=0, total_ns=0, max_ns=0, length=0, fragments=0))
+
+    def test_disabled(self):
+        """Without the setting, the module has the functions, but keeps no counters."""
+        with open('tools/templates/render_stats.tmpl') as infile:
+            default_module = compile_string(infile.read(), 'render_stats_default', cache_dir=MODULE_CACHE_DIR)
+        default_module.render_stats_default_respond(display, None)
+        assert_equal(default_module.stats(), {})
+        assert_equal(default_module.reset_stats(), None)
+
+if __name__ == '__main__':
+    testify.run()
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+"""
+Tests and benchmark for the batch hook, <class>_respond_many, which renders
+a whole sequence of displays in one call.
+"""
+
+import sys
+import time
+from cStringIO import StringIO
+
+import testify
+from testify.assertions import assert_equal, assert_raises
+
+from tools.tests.test_case import EZIOTestCase
+from tools.tests.simple import display, make_bag
+
+displays = [display, {'bags': []}, {'bags': [make_bag()]}] * 100
+
+class TestCase(EZIOTestCase):
+
+    target_template = 'simple'
+
+    num_benchmark_iterations = 20
+
+    def get_display(self):
+        return display
+
+    def test(self):
+        super(TestCase, self).test()
+        self.respond_many = getattr(self.template_module, 'simple_respond_many')
+
+        expected_results = [self.responder(item, None) for item in displays]
+        assert_equal(self.respond_many(displays, None), expected_results)
+        assert_equal(self.respond_many((), None), [])
+
+        outfile = StringIO()
+        assert_equal(self.respond_many(displays, None, outfile), None)
+        assert_equal(outfile.getvalue(), ''.join(expected_results))
+
+    def test_mutated_displays(self):
+        """Emptying the list of displays mid-batch doesn't affect the batch."""
+        respond_many = getattr(self.template_module, 'simple_respond_many')
+        batch = [dict(display) for display in displays[:3]]
+        expected_results = [self.responder(item, None) for item in batch]
+        written = []
+        class EmptyingFile(object):
+            def write(self, output):
+                written.append(output)
+                del batch[:]
+        respond_many(batch, None, EmptyingFile())
+        assert_equal(written, expected_results)
+
+    def test_exception(self):
+        respond_many = getattr(self.template_module, 'simple_respond_many')
+        assert_raises(TypeError, respond_many, None, None)
+        # the third display is missing `bags`:
+        assert_raises(KeyError, respond_many, [display, display, {}], None)
+
+    def test_benchmark(self):
+        """Compare the per-display cost of calling the respond hook in a loop
+        against a single call to the batch hook.
+        """
+        responder = self.responder
+        respond_many = getattr(self.template_module, 'simple_respond_many')
+
+        start_time = time.time()
+        for _ in xrange(self.num_benchmark_iterations):
+            for item in displays:
+                responder(item, None)
+        loop_time = time.time() - start_time
+
+        start_time = time.time()
+        for _ in xrange(self.num_benchmark_iterations):
+            respond_many(displays, None)
+        batch_time = time.time() - start_time
+
+        num_renders = float(self.num_benchmark_iterations * len(displays))
+        print >>sys.stderr, "Microseconds per display, respond loop: %f" % (loop_time / num_renders * 1e6,)
+        print >>sys.stderr, "Microseconds per display, respond_many: %f" % (batch_time / num_renders * 1e6,)
+
+if __name__ == '__main__':
+    testify.run()
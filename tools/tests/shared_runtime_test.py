@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+from __future__ import with_statement
+
+import os
+import shutil
+import sys
+import tempfile
+
+import testify
+from testify import assert_equal, assert_in, assert_raises
+
+from ezio import builder
+from ezio.constants import BUILTIN_MODULE_NAME, BUILTINS_WHITELIST
+from tools.tests.simple import display
+
+class SharedRuntimeTest(testify.TestCase):
+    """Test templates that take their common literals and imports from a shared runtime module."""
+
+    thisdir = os.path.dirname(__file__)
+    templates_dir = os.path.join(thisdir, '..', 'templates')
+    module_names = ['runtime_simple', 'runtime_imports', 'runtime_runtime']
+
+    @testify.setup
+    def make_tempdir(self):
+        self.tempdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.tempdir)
+
+    @testify.teardown
+    def remove_tempdir(self):
+        sys.path.remove(self.tempdir)
+        for module_name in self.module_names:
+            sys.modules.pop(module_name, None)
+        shutil.rmtree(self.tempdir)
+
+    def _copy_template(self, source_name, name):
+        filename = os.path.join(self.tempdir, name + '.tmpl')
+        shutil.copy(os.path.join(self.templates_dir, source_name + '.tmpl'), filename)
+        return filename
+
+    def _build_runtime(self, filenames):
+        c_file_name, shared_runtime = builder.build_shared_runtime(filenames, 'runtime_runtime')
+        builder.buildext(c_file_name)
+        return shared_runtime
+
+    def _build_template(self, filename, shared_runtime):
+        c_file_name = builder.compile_single_file(filename, shared_runtime=shared_runtime)
+        builder.buildext(c_file_name)
+        with open(c_file_name) as infile:
+            return infile.read()
+
+    def test_shared_runtime(self):
+        simple_filename = self._copy_template('simple', 'runtime_simple')
+        imports_filename = self._copy_template('imports', 'runtime_imports')
+        shared_runtime = self._build_runtime([simple_filename, imports_filename])
+        # both import the builtins:
+        assert shared_runtime.import_indices(('from', BUILTIN_MODULE_NAME, tuple(BUILTINS_WHITELIST)))
+        # the description round-trips:
+        _, description_filename = builder.shared_runtime_filenames(self.tempdir, 'runtime_runtime')
+        assert_equal(builder.load_shared_runtime(description_filename).key, shared_runtime.key)
+
+        simple_code = self._build_template(simple_filename, shared_runtime)
+        assert_in('bind_shared_objects(string_literals', simple_code)
+        assert_in('bind_shared_objects(imported_names', simple_code)
+        self._build_template(imports_filename, shared_runtime)
+
+        import runtime_simple, runtime_imports
+        assert_in('<html>', runtime_simple.runtime_simple_respond(display, None))
+        assert_in('bisect', runtime_imports.runtime_imports_respond({}, None))
+
+    def test_stale_runtime(self):
+        simple_filename = self._copy_template('simple', 'runtime_simple')
+        imports_filename = self._copy_template('imports', 'runtime_imports')
+        shared_runtime = self._build_runtime([simple_filename, imports_filename])
+        self._build_template(simple_filename, shared_runtime)
+
+        # the runtime changes underneath the compiled template:
+        self._build_runtime([simple_filename, simple_filename])
+        assert_raises(ImportError, __import__, 'runtime_simple')
+
+if __name__ == '__main__':
+    testify.run()
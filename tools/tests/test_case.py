@@ -4,21 +4,37 @@
 Base test class for templates.
 """
 
+import atexit
 import os.path
 import re
+import shutil
 import time
 import subprocess
 import sys
+import tempfile
 
 import testify
 from testify import setup
 from testify.assertions import assert_equal, assert_raises
 
-from ezio.builder import MODULE_NAME
+from ezio import compile_string
+from ezio.builder import MODULE_CACHE_ENV_VAR
+from ezio.compiler import MAIN_FUNCTION_NAME
+from ezio.loader import TemplateLoader
 
 TEMPLATES_DIR = 'tools/templates'
 TEMPLATES_DOTTEDPATH = re.sub('/', '.', TEMPLATES_DIR)
 
+# shared by all the tests, since the compiled modules are cached anyway by the import machinery:
+template_loader = TemplateLoader()
+
+# templates compiled from strings go in $EZIO_MODULE_CACHE if it's set (to keep them between runs),
+# and otherwise in a scratch cache, rather than the user's:
+MODULE_CACHE_DIR = os.environ.get(MODULE_CACHE_ENV_VAR)
+if not MODULE_CACHE_DIR:
+    MODULE_CACHE_DIR = tempfile.mkdtemp(prefix='ezio_modules_')
+    atexit.register(shutil.rmtree, MODULE_CACHE_DIR, True)
+
 class EZIOTestCase(testify.TestCase):
 
     # set this to compile a full project
@@ -26,6 +42,13 @@ class EZIOTestCase(testify.TestCase):
 
     target_template = None
 
+    # CompilerSettings for templates compiled from a string (defaults to the defaults)
+    compiler_settings = None
+
+    # set this to compile a single-file template with bin/ezio, next to its source,
+    # rather than from a string
+    build_with_ezio = False
+
     verbose = True
 
     __test__ = False
@@ -50,22 +73,30 @@ class EZIOTestCase(testify.TestCase):
         """Recompile the template module, import it, and set self.responder
         to be the templating function.
         """
+        if not self.project_name and not self.build_with_ezio:
+            # compiled in memory, and cached by content, outside the source tree:
+            with open(os.path.join(TEMPLATES_DIR, '%s.tmpl' % self.template_name)) as infile:
+                self.template_module = compile_string(infile.read(), self.template_name,
+                    compiler_settings=self.compiler_settings, cache_dir=MODULE_CACHE_DIR)
+            self.responder = getattr(self.template_module, '%s_%s' % (self.template_name, MAIN_FUNCTION_NAME))
+            return
+
         if self.project_name:
             target = os.path.join(TEMPLATES_DIR, self.project_name)
-            module = "%s.%s" % (self.project_name, MODULE_NAME)
-            from_item = MODULE_NAME
+            # different projects can have classes with the same name:
+            loader_name = '%s.%s' % (self.project_name, self.template_name)
+            template_loader.register_project('%s.%s' % (TEMPLATES_DOTTEDPATH, self.project_name),
+                [self.template_name], prefix=self.project_name + '.')
         else:
             target = os.path.join(TEMPLATES_DIR, '%s.tmpl' % self.template_name)
-            module = self.template_name
-            from_item = self.template_name
+            loader_name = self.template_name
+            template_loader.register(self.template_name,
+                '%s.%s' % (TEMPLATES_DOTTEDPATH, self.template_name))
 
         subprocess.check_call(['bin/ezio', target])
 
-        full_module_path = '%s.%s' % (TEMPLATES_DOTTEDPATH, module)
-        template_module = __import__(full_module_path, globals(), locals(), [from_item])
-        # XXX this is repeated but it's wrong anyway
-        responder_name = "%s_respond" % (self.template_name,)
-        self.responder = getattr(template_module, responder_name)
+        self.template_module = template_loader.get_module(loader_name)
+        self.responder = template_loader.get_hook(loader_name)
 
     def get_display(self):
         """Uninteresting toy display dict."""
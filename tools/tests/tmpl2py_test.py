@@ -6,6 +6,7 @@ import os
 import sys
 
 import testify
+from StringIO import StringIO
 
 from ezio import tmpl2py
 
@@ -48,6 +49,84 @@ class Tmpl2PyTest(testify.TestCase):
         for filename in glob.iglob(tmplglob):
             self._test_a_file(filename)
 
+    def test_sanitize_dollars(self):
+        """Placeholder dollars go, dollars in strings and comments stay, as when parsing repeatedly."""
+        testify.assert_equal(tmpl2py.sanitize_dollars("$a + $b.c('$d') # $e"), "a + b.c('$d') # $e")
+        testify.assert_equal(tmpl2py.sanitize_dollars("$$x"), "x")
+
+        cases = ["$f($g, **$h['k'])", "[$i for $i in $xs] and u'$m'", '"$$" if $q else $r', 'x']
+        for case in cases:
+            testify.assert_equal(tmpl2py.sanitize_dollars(case), tmpl2py.strip_dollars_by_parsing(case))
+
+        call_munge_pair = tmpl2py.mk_mungepair('foo(', ')')
+        testify.assert_equal(tmpl2py.sanitize_dollars('$a, b=$c', call_munge_pair), 'a, b=c')
+
+        testify.assert_raises(tmpl2py.EzioNotDollarSignError, tmpl2py.sanitize_dollars, '$a ? $b')
+
+    def test_balanced_prefix(self):
+        """Brackets in strings and comments don't count; the prefix may span lines."""
+        driver = tmpl2py.EzioTemplateDriver(StringIO("(f(')', \"\"\"]\n\"\"\"), # )\n[1])tail\n"))
+        driver.extend_head()
+        testify.assert_equal(driver.balanced_prefix(')'), "(f(')', \"\"\"]\n\"\"\"), # )\n[1])")
+
+        driver = tmpl2py.EzioTemplateDriver(StringIO("set x = ('#', 1)#tail\n"))
+        driver.extend_head()
+        testify.assert_equal(driver.balanced_prefix('#\n'), "set x = ('#', 1)#")
+
+        for text in ['(a]', '(a', "('a)\n"]:
+            driver = tmpl2py.EzioTemplateDriver(StringIO(text))
+            driver.extend_head()
+            testify.assert_equal(driver.balanced_prefix(')'), None)
+
+        # a long placeholder comes out the same as ever:
+        args = ',\n'.join("$f($x[%d], '(%%s]')" % (i,) for i in xrange(20))
+        testify.assert_in("f ( x [ 19 ] , '(%s]' ) )", tmpl2py.tmpl2py(StringIO('$g(\n%s)\n' % (args,))))
+
+    def test_literal_text(self):
+        """Literal text, escapes and all, comes out in one string per run."""
+        text = "a \\$b \\#c \\d $1.00 $\nnext line\n#set $x = 1\nlast\n"
+        expected = ["'a $b #c \\\\d $1.00 $\\nnext line\\n' ", "x = 1 ", "'last\\n' "]
+        testify.assert_equal(tmpl2py.tmpl2py(StringIO(text)).splitlines(), expected)
+
+        out = tmpl2py.PyOut(StringIO(''), [])
+        out.commit_literal("it's \\ a\n")
+        out.commit_line(repr("it's \\ a\n") + '\n')
+        lines = out.out_buf.result().splitlines()
+        testify.assert_equal(lines[0], lines[1])
+
+    def _assert_same_ast(self, text):
+        testify.assert_equal(ast.dump(tmpl2py.tmpl2ast(StringIO(text))),
+            ast.dump(ast.parse(tmpl2py.tmpl2py(StringIO(text)))))
+
+    def test_tmpl2ast_matches_tmpl2py(self):
+        """tmpl2ast builds the AST that parsing the output of tmpl2py would."""
+
+        for filename in glob.glob(os.path.join(self.thisdir, '../templates/*.tmpl')) + \
+                [os.path.join(self.thisdir, 'parser_stresstest.tmpl')]:
+            with open(filename) as infile:
+                self._assert_same_ast(infile.read())
+
+        self._assert_same_ast(
+            "#@staticmethod\n#def f($x)\n#try\n#while $x\nloop\n#else\ndone\n#end while\n"
+            "#except KeyError, e\n$e\n#except\n#pass\n#else\nelse\n#finally\n$f($x,\n  1)\n#end try\n"
+            "#try\n#if $a\na\n#elif $b#b#else#c#end if\n#finally\n#for $i in $x\n$i\n#else\nnone\n#end for\n#end try\n"
+            "#end def\n#call $self.layout $x, y=1\ncalled\n#end call\n#block body\nbody\n#end block\n")
+
+    def test_tmpl2ast_line_numbers(self):
+        module = tmpl2py.tmpl2ast(StringIO("text\n#if $a\n$b\n#else\n$c(\n  1)\n#end if\n"))
+        literal, if_node = module.body
+        testify.assert_equal((literal.lineno, if_node.lineno), (1, 2))
+        testify.assert_equal(if_node.body[0].lineno, 3)
+        call = if_node.orelse[0].value
+        testify.assert_equal((call.lineno, call.args[0].lineno), (5, 6))
+
+    def test_tmpl2ast_syntax_errors(self):
+        for text in ["#def f()\n#if $a\na\n#end if\nb\n#else\n", "#if $a\n#else\n#else\n#end if\n", "#if $a\n#end if\n",
+                "#try\nx\n#end try\n", "#for $x in $y\n#except\n#end for\n",
+                # a decorator must be followed by a def or class:
+                "#@staticmethod\ntext\n", "#@staticmethod\n#set $x = 1\n", "#@staticmethod\n#if $a\n#end if\n",
+                "#@staticmethod\n"]:
+            testify.assert_raises(SyntaxError, tmpl2py.tmpl2ast, StringIO(text))
 
 if __name__ == '__main__':
     testify.run()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+from __future__ import with_statement
+
+import imp
+import os
+import shutil
+import tempfile
+
+import testify
+from testify import assert_equal
+
+from ezio import toolchain
+
+MODULE_SOURCE = """
+#include "Python.h"
+
+static PyMethodDef k_module_methods[] = {{NULL, NULL, 0, NULL}};
+
+PyMODINIT_FUNC initcached_module(void) {
+    PyObject *module = Py_InitModule("cached_module", k_module_methods);
+    if (module) { PyModule_AddIntConstant(module, "answer", %d); }
+}
+"""
+
+class ObjectCacheTest(testify.TestCase):
+
+    @testify.setup
+    def make_tempdir(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.object_cache = toolchain.ObjectCache(os.path.join(self.tempdir, 'objects'))
+        self.source = os.path.join(self.tempdir, 'cached_module.cpp')
+        self.output = os.path.join(self.tempdir, 'cached_module.so')
+
+    @testify.teardown
+    def remove_tempdir(self):
+        shutil.rmtree(self.tempdir)
+
+    def _build(self, answer, profile='default'):
+        with open(self.source, 'w') as outfile:
+            outfile.write(MODULE_SOURCE % (answer,))
+        report = toolchain.build_extension([self.source], self.output, toolchain=toolchain.Toolchain(profile),
+            object_cache=self.object_cache)
+        assert_equal([compile_report['source'] for compile_report in report['compile']], [self.source])
+        return report['compile'][0]['cache_hit']
+
+    def test_cache_hit(self):
+        assert not self._build(42)
+        # an identical source compiles to the identical object:
+        assert self._build(42)
+        assert not self._build(43)
+
+        module = imp.load_dynamic('cached_module', self.output)
+        assert_equal(module.answer, 43)
+
+    def test_relocated_source(self):
+        """The same source, with #line directives and includes, in another directory is a cache hit."""
+        source = '#include "answer.h"\n#line 1 "%s"\n' + MODULE_SOURCE
+        report_hits = []
+        for directory in ('checkout_a', os.path.join('elsewhere', 'checkout_b')):
+            directory = os.path.join(self.tempdir, directory)
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'answer.h'), 'w') as outfile:
+                outfile.write('#define ANSWER 42\n')
+            source_filename = os.path.join(directory, 'cached_module.cpp')
+            with open(source_filename, 'w') as outfile:
+                outfile.write(source % (os.path.join(directory, 'answer.tmpl'), 42))
+            report = toolchain.compile_source(toolchain.Toolchain(), self.object_cache, source_filename)
+            report_hits.append(report['cache_hit'])
+        assert_equal(report_hits, [False, True])
+
+    def test_profiles(self):
+        assert not self._build(42)
+        # each profile compiles with different flags, so gets its own objects:
+        assert not self._build(42, profile='size')
+        assert self._build(42, profile='size')
+        assert self._build(42)
+
+if __name__ == '__main__':
+    testify.run()
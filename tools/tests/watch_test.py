@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+
+import testify
+from testify import assert_equal, assert_in, assert_raises
+
+from ezio import builder
+from ezio import watch
+from ezio.tmpl2py import EzioUnmatchedDirectivesError
+from tools.tests.simple import display
+
+class WatchTest(testify.TestCase):
+    """Test incremental rebuilds and hot reloading of a project."""
+
+    thisdir = os.path.dirname(__file__)
+    project_source = os.path.join(thisdir, '..', 'templates', 'simple_classes')
+
+    @testify.setup
+    def copy_project(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tempdir, 'simple_classes')
+        shutil.copytree(self.project_source, self.project_dir)
+        self.watcher = watch.ProjectWatcher(self.project_dir)
+        self.reloader = watch.HotReloader(self.project_dir, check_interval=0)
+
+    @testify.teardown
+    def remove_project(self):
+        shutil.rmtree(self.tempdir)
+
+    def _recompiled_classes(self, build_report):
+        recompiled = []
+        for classname in ('simple_superclass', 'simple_subclass'):
+            c_file_name = builder.project_class_to_c_filename(self.project_dir, classname)
+            if any(report['source'] == c_file_name and not report['cache_hit']
+                    for report in build_report['compile']):
+                recompiled.append(classname)
+        return recompiled
+
+    def test_rebuild_and_reload(self):
+        changed = self.watcher.poll()
+        assert_equal(changed, set(['simple_superclass', 'simple_subclass']))
+        module_name, _ = self.watcher.rebuild(changed)
+        assert_equal(module_name, 'templates_v1')
+        assert_equal(self.watcher.poll(), set())
+
+        assert self.reloader.reload_if_changed()
+        assert not self.reloader.reload_if_changed()
+        superclass_result = self.reloader.respond('simple_superclass', display)
+        assert_in('from the subclass', self.reloader.respond('simple_subclass', display))
+
+        subclass_filename = os.path.join(self.project_dir, 'simple_subclass.tmpl')
+        with open(subclass_filename) as infile:
+            source = infile.read()
+        with open(subclass_filename, 'w') as outfile:
+            outfile.write(source.replace('from the subclass', 'from the hot-swapped subclass'))
+        changed = self.watcher.poll()
+        assert_equal(changed, set(['simple_subclass']))
+        module_name, build_report = self.watcher.rebuild(changed)
+        assert_equal(module_name, 'templates_v2')
+        # the superclass's code is unchanged, so its object file came from the cache:
+        assert 'simple_superclass' not in self._recompiled_classes(build_report)
+
+        assert_in('from the hot-swapped subclass', self.reloader.respond('simple_subclass', display))
+        assert_equal(self.reloader.version, 2)
+        assert_equal(self.reloader.respond('simple_superclass', display), superclass_result)
+
+    def _edit(self, classname, old, new):
+        filename = os.path.join(self.project_dir, classname + '.tmpl')
+        with open(filename) as infile:
+            source = infile.read()
+        with open(filename, 'w') as outfile:
+            outfile.write(source.replace(old, new))
+
+    def test_failed_rebuild(self):
+        """A class that changed along with one that failed to build is rebuilt with it later."""
+        self.watcher.rebuild(self.watcher.poll())
+        self._edit('simple_superclass', 'from the superclass', 'from the edited superclass')
+        self._edit('simple_subclass', '#end for', '#end for\n#if $bags')
+        changed = self.watcher.poll()
+        assert_equal(changed, set(['simple_superclass', 'simple_subclass']))
+        assert_raises(EzioUnmatchedDirectivesError, self.watcher.rebuild, changed)
+        # nothing to retry until something changes:
+        assert_equal(self.watcher.poll(), set())
+
+        self._edit('simple_subclass', '#end for\n#if $bags', '#end for')
+        changed = self.watcher.poll()
+        assert_equal(changed, set(['simple_superclass', 'simple_subclass']))
+        module_name, _ = self.watcher.rebuild(changed)
+        assert_equal(module_name, 'templates_v2')
+        assert self.reloader.reload_if_changed()
+        assert_in('from the edited superclass', self.reloader.respond('simple_superclass', display))
+        assert_equal(self.watcher.poll(), set())
+
+    def test_line_directives(self):
+        """Watch builds point back at the templates, like bin/ezio's."""
+        self.watcher.rebuild(self.watcher.poll())
+        c_file_name = builder.project_class_to_c_filename(self.project_dir, 'simple_subclass')
+        with open(c_file_name) as infile:
+            code = infile.read()
+        assert_in('#line 2 "%s"' % (os.path.abspath(os.path.join(self.project_dir, 'simple_subclass.tmpl')),), code)
+        assert_in('"%s"' % (os.path.abspath(c_file_name),), code)
+
+if __name__ == '__main__':
+    testify.run()